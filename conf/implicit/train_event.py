@@ -16,3 +16,6 @@ c.Basic.train_in = os.path.join(base, raw_corpus_name, 'hashed')
 c.Basic.debug_dir = os.path.join(base, raw_corpus_name, 'debug')
 c.Basic.train_cache_dir = os.path.join(base, raw_corpus_name, 'train_cache')
 c.Basic.train_cache_size = 1000
+
+# Mix the documents across the data shards while streaming.
+c.Basic.shuffle_buffer_size = 10000
@@ -15,3 +15,6 @@ raw_corpus_name = 'gigaword_frames'
 c.Basic.train_in = os.path.join(base, raw_corpus_name, 'hashed')
 c.Basic.debug_dir = os.path.join(base, raw_corpus_name, 'debug')
 c.Basic.train_factor_role = 'fe'
+
+# Mix the documents across the data shards while streaming.
+c.Basic.shuffle_buffer_size = 10000
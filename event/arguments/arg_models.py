@@ -1,7 +1,8 @@
 import logging
 import math
-import pdb
+import warnings
 
+import numpy as np
 from torch import nn
 from torch.nn import functional as F
 import torch
@@ -10,7 +11,7 @@ from texar.torch.modules.embedders import EmbedderBase
 
 from event import util
 from event.arguments.implicit_arg_resources import ImplicitArgResources
-from event.nn.models import KernelPooling
+from event.nn.models import KernelPooling, FrozenEmbedding
 from conf.implicit import texar_config
 from event.arguments.implicit_arg_params import ArgModelPara
 
@@ -25,11 +26,85 @@ def parse_activation(activation_name: str):
     return activation
 
 
+def selected_products(tensor_l, tensor_r, positions=None, block_size=32):
+    """The dot products of each row of tensor_l with the rows of tensor_r at
+    its positions.
+
+    The rows of tensor_l are sorted by their first position and split into
+    blocks, then each block is multiplied with the band of tensor_r rows
+    covering its positions, instead of all the rows. When the bands are not
+    much shorter than tensor_r (short or scattered contexts), or the call is
+    traced (the band width depends on the data), all the products are
+    computed and gathered, which is faster then.
+
+    Args:
+      tensor_l: batch x size_l x dim
+      tensor_r: batch x size_r x dim
+      positions: The positions in tensor_r for each row of tensor_l, batch x
+        size_l x num_selected, all the rows of tensor_r if not given.
+      block_size: Number of tensor_l rows multiplied together.
+
+    Returns:
+      The products, batch x size_l x num_selected (or size_r).
+
+    """
+    if positions is None:
+        return torch.bmm(tensor_l, tensor_r.transpose(-2, -1))
+
+    if torch.jit.is_tracing():
+        return torch.bmm(tensor_l, tensor_r.transpose(-2, -1)).gather(
+            2, positions)
+
+    batch_size, size_l, dim = tensor_l.shape
+    size_r = tensor_r.shape[1]
+    num_selected = positions.shape[-1]
+
+    # Sort the rows by their first position, so the rows in a block select
+    # nearby positions. The last row is repeated to fill the last block.
+    order = positions.min(-1).values.argsort(-1)
+    num_blocks = -(-size_l // block_size)
+    num_extra = num_blocks * block_size - size_l
+    if num_extra:
+        order = torch.cat([order, order[:, -1:].expand(-1, num_extra)], 1)
+    batch_offsets = torch.arange(batch_size, device=positions.device)
+    flat_order = (order + batch_offsets.unsqueeze(-1) * size_l).view(-1)
+
+    block_positions = positions.reshape(-1, num_selected).index_select(
+        0, flat_order).view(batch_size * num_blocks, -1)
+    band_start = block_positions.min(-1).values
+    band_width = int((block_positions.max(-1).values - band_start).max()) + 1
+
+    if band_width * 4 > size_r:
+        return torch.bmm(tensor_l, tensor_r.transpose(-2, -1)).gather(
+            2, positions)
+
+    # The tensor_r rows of each band, batch * num_blocks x band_width x dim.
+    band_rows = band_start.unsqueeze(-1) + torch.arange(
+        band_width, device=positions.device)
+    band_rows = band_rows.clamp(max=size_r - 1).view(
+        batch_size, -1) + batch_offsets.unsqueeze(-1) * size_r
+    bands = tensor_r.reshape(-1, dim).index_select(
+        0, band_rows.view(-1)).view(-1, band_width, dim)
+
+    blocks = tensor_l.reshape(-1, dim).index_select(0, flat_order).view(
+        -1, block_size, dim)
+    products = torch.bmm(blocks, bands.transpose(-2, -1)).gather(
+        2, (block_positions - band_start.unsqueeze(-1)).view(
+            -1, block_size, num_selected))
+
+    # Back to the original order, the repeated rows are dropped.
+    inverse = torch.empty_like(flat_order[:batch_size * size_l])
+    inverse[flat_order] = torch.arange(flat_order.shape[0],
+                                       device=positions.device)
+    return products.view(-1, num_selected).index_select(0, inverse).view(
+        batch_size, size_l, num_selected)
+
+
 class ArgCompatibleModel(nn.Module):
     """ """
 
     def __init__(self, para: ArgModelPara, resources: ImplicitArgResources,
-                 device, model_name):
+                 device, model_name, shared_embeddings=False):
         super(ArgCompatibleModel, self).__init__()
         self.para = para
 
@@ -43,7 +118,9 @@ class ArgCompatibleModel(nn.Module):
 
         self.name = model_name
 
-        self.__load_embeddings(resources)
+        # The models that are not trained, such as the baselines, share the
+        # frozen pretrained embeddings.
+        self.__load_embeddings(resources, shared_embeddings)
 
     def self_event_mask(self, batch_event_indices, context_size):
         """Return a matrix to mask out the scores from the current event.
@@ -64,11 +141,59 @@ class ArgCompatibleModel(nn.Module):
         one_zeros.scatter_(-1, selector, 0)
         return one_zeros
 
-    def make_embedding(self, embedding_path, extra_size, padded: bool):
-        # Add padding or extra weights.
+    def context_positions(self, batch_event_indices, context_size):
+        """Return the positions of the context events that each instance
+        votes with in the sparse voting, they are the events around the
+        current event in the document order, the current event excluded.
+
+        Args:
+          batch_event_indices: A tensor containing the current event indices
+          context_size: The number of context events (padded).
+
+        Returns:
+          The positions of shape batch x instance_size x num_votes, and a mask
+          of the same shape that is zero at the positions outside the context.
+
+        """
+        size = self.para.vote_context_size
+        if self.para.vote_context == 'window':
+            offsets = torch.cat([torch.arange(-size, 0),
+                                 torch.arange(1, size + 1)])
+        elif self.para.vote_context == 'nearest_positions':
+            # The candidates ordered by the distance: 1, -1, 2, -2 ...
+            offsets = torch.arange(1, size + 1).repeat_interleave(2)
+            offsets[1::2] *= -1
+        else:
+            raise ValueError(
+                f"Unknown vote context {self.para.vote_context}")
+
+        positions = batch_event_indices.unsqueeze(-1) + offsets.to(
+            batch_event_indices.device)
+        in_context = (positions >= 0) & (positions < context_size)
+
+        if self.para.vote_context == 'nearest_positions':
+            # Take the first size candidates inside the context, there are
+            # enough of them unless the context is shorter than size.
+            priority = in_context * torch.arange(
+                offsets.shape[0], 0, -1, device=positions.device)
+            _, nearest = priority.topk(size, -1)
+            positions = positions.gather(-1, nearest)
+            in_context = in_context.gather(-1, nearest)
 
-        event_emb = torch.from_numpy(embedding_path)
+        return positions.clamp(0, context_size - 1), in_context.float()
 
+    def extra_rows(self, extra_size, padded: bool):
+        """Create the rows before the pretrained embedding: the zero padding
+        and the extra vocab.
+
+        Args:
+          extra_size: Number of the extra vocab.
+          padded: Whether to add the zero padding.
+
+        Returns:
+          The rows.
+
+        """
         # Add extra event vocab at beginning.
         extras = torch.rand(extra_size, self.para.event_embedding_dim)
 
@@ -77,50 +202,121 @@ class ArgCompatibleModel(nn.Module):
             zero = torch.zeros(1, self.para.event_embedding_dim)
             extras = torch.cat([zero, extras])
 
-        return nn.Parameter(torch.cat((extras, event_emb)))
+        return extras
 
-    def __load_embeddings(self, resources: ImplicitArgResources):
+    def make_embedding(self, embedding, extra_size, padded: bool):
+        """Create the embedding table: the zero padding, the extra vocab and
+        then the pretrained embedding, which may be memory-mapped, it is only
+        copied once into the table.
+
+        Args:
+          embedding: The pretrained embedding array.
+          extra_size: Number of the extra vocab.
+          padded: Whether to add the zero padding.
+
+        Returns:
+          The embedding table.
+
+        """
+        extras = self.extra_rows(extra_size, padded)
+
+        num_extras = extras.shape[0]
+        table = torch.empty(num_extras + embedding.shape[0],
+                            self.para.event_embedding_dim)
+        table[:num_extras] = extras
+        table.numpy()[num_extras:] = embedding
+        return table
+
+    def __shared_embedding(self, resources, name, vocab):
+        """The frozen embedding shared by the models that are not trained.
+
+        The tables are created once per resources and device: on the CPU,
+        the pretrained rows are the memory-mapped array itself (unless it is
+        not float32, then it is converted once); on another device, they are
+        copied there once for all the models. The tables must then not be
+        modified.
+
+        Args:
+          resources: The resources holding the pretrained embedding.
+          name: The name of the pretrained embedding.
+          vocab: The vocabulary of the embedding.
+
+        Returns:
+          A FrozenEmbedding.
+
+        """
+        tables = resources.shared_embedding_tables
+        key = (name, str(self.device))
+        if key not in tables:
+            if (name, 'cpu') not in tables:
+                embedding = np.asarray(getattr(resources, name),
+                                       dtype=np.float32)
+                with warnings.catch_warnings():
+                    # The array is read only, and so is the table.
+                    warnings.simplefilter('ignore', UserWarning)
+                    pretrained = torch.from_numpy(embedding)
+                tables[(name, 'cpu')] = (
+                    self.extra_rows(vocab.extra_size(), vocab.padded),
+                    pretrained)
+            tables[key] = tuple(
+                t.to(self.device) for t in tables[(name, 'cpu')])
+        return FrozenEmbedding(*tables[key])
+
+    def __load_embeddings(self, resources: ImplicitArgResources, shared):
         logger.info("Loading %d x %d event embedding." % (
             resources.event_embed_vocab.get_size(),
             self.para.event_embedding_dim
         ))
 
-        # Add additional dimension for extra event vocab.
-        self.event_embedding = nn.Embedding(
-            resources.event_embed_vocab.get_size(),
-            self.para.event_embedding_dim, padding_idx=0
-        )
+        if shared and resources.event_embedding_path is not None:
+            self.event_embedding = self.__shared_embedding(
+                resources, 'event_embedding', resources.event_embed_vocab)
+        else:
+            # Add additional dimension for extra event vocab.
+            self.event_embedding = nn.Embedding(
+                resources.event_embed_vocab.get_size(),
+                self.para.event_embedding_dim, padding_idx=0,
+                sparse=self.para.sparse_embeddings
+            )
 
         logger.info("Loading %d x %d word embedding." % (
             resources.word_embed_vocab.get_size(),
             self.para.word_embedding_dim,
         ))
 
-        self.word_embedding = nn.Embedding(
-            resources.word_embed_vocab.get_size(),
-            self.para.word_embedding_dim, padding_idx=0
-        )
+        if shared and resources.word_embedding_path is not None:
+            self.word_embedding = self.__shared_embedding(
+                resources, 'word_embedding', resources.word_embed_vocab)
+        else:
+            self.word_embedding = nn.Embedding(
+                resources.word_embed_vocab.get_size(),
+                self.para.word_embedding_dim, padding_idx=0,
+                sparse=self.para.sparse_embeddings
+            )
+
+        if shared:
+            return
 
         if resources.word_embedding_path is not None:
-            self.word_embedding.weight = self.make_embedding(
+            self.word_embedding.weight = nn.Parameter(self.make_embedding(
                 resources.word_embedding,
                 resources.word_embed_vocab.extra_size(),
-                resources.word_embed_vocab.padded)
+                resources.word_embed_vocab.padded))
 
         if resources.event_embedding_path is not None:
-            self.event_embedding.weight = self.make_embedding(
+            self.event_embedding.weight = nn.Parameter(self.make_embedding(
                 resources.event_embedding,
                 resources.event_embed_vocab.extra_size(),
-                resources.event_embed_vocab.padded
-            )
+                resources.event_embed_vocab.padded))
 
 
 class RandomBaseline(ArgCompatibleModel):
     """ """
 
     def __init__(self, para, resources, device):
-        super(RandomBaseline, self).__init__(para, resources, device,
-                                             'random_baseline')
+        super(RandomBaseline, self).__init__(
+            para, resources, device, 'random_baseline',
+            shared_embeddings=True)
 
     def forward(self, batch_event_data, batch_info):
         """
@@ -141,8 +337,9 @@ class MostFrequentModel(ArgCompatibleModel):
     """ """
 
     def __init__(self, para, resources, device):
-        super(MostFrequentModel, self).__init__(para, resources, device,
-                                                'most_freq_baseline')
+        super(MostFrequentModel, self).__init__(
+            para, resources, device, 'most_freq_baseline',
+            shared_embeddings=True)
         self.para = para
 
     def forward(self, batch_event_data, batch_info):
@@ -164,8 +361,9 @@ class BaselineEmbeddingModel(ArgCompatibleModel):
     """ """
 
     def __init__(self, para, resources, device):
-        super(BaselineEmbeddingModel, self).__init__(para, resources, device,
-                                                     'w2v_baseline')
+        super(BaselineEmbeddingModel, self).__init__(
+            para, resources, device, 'w2v_baseline',
+            shared_embeddings=True)
         self.para = para
 
         self._score_method = para.w2v_baseline_method
@@ -224,13 +422,22 @@ class BaselineEmbeddingModel(ArgCompatibleModel):
             raise ValueError("Unknown arg representation method.")
 
         _, context_size, _ = nom_context_emb.shape
-        self_mask = self.self_event_mask(batch_info['event_indices'],
-                                         context_size)
 
         # Cosine similarities to the context.
-        # batch x instance_size x context_size
-        trans = torch.bmm(nom_event_emb, nom_context_emb.transpose(-2, -1))
-        trans *= self_mask
+        if self.para.vote_context == 'all':
+            # batch x instance_size x context_size
+            trans = torch.bmm(nom_event_emb,
+                              nom_context_emb.transpose(-2, -1))
+            self_mask = self.self_event_mask(batch_info['event_indices'],
+                                             context_size)
+            trans *= self_mask
+        else:
+            # Only the similarities to the context events around the
+            # current one, batch x instance_size x num_votes
+            positions, vote_mask = self.context_positions(
+                batch_info['event_indices'], context_size)
+            trans = selected_products(nom_event_emb, nom_context_emb,
+                                      positions) * vote_mask
 
         # batch x instance_size
         if self._score_method == 'max_sim':
@@ -533,17 +740,21 @@ class Biaffine(nn.Module):
 
         self._m_affine = nn.Linear(size_l, size_b)
 
-    def forward(self, tensor_l: torch.Tensor, tensor_r: torch.Tensor):
+    def forward(self, tensor_l: torch.Tensor, tensor_r: torch.Tensor,
+                positions=None):
         """
 
         Args:
           tensor_l: torch.Tensor:
           tensor_r: torch.Tensor:
+          positions: Only compute the scores with the tensor_r rows at these
+            positions, see `selected_products`.
 
         Returns:
 
         """
-        return torch.bmm(self._m_affine(tensor_l), tensor_r.transpose(-2, -1))
+        return selected_products(self._m_affine(tensor_l), tensor_r,
+                                 positions)
 
 
 class PredicateWindowModule(nn.Module):
@@ -615,12 +826,15 @@ class EventContextAttentionPool(nn.Module):
         elif self._vote_method == 'mlp':
             raise NotImplementedError("MLP not yet supported when voting.")
 
-    def _context_vote(self, nom_event_emb, nom_context_emb):
+    def _context_vote(self, nom_event_emb, nom_context_emb,
+                      context_positions=None):
         """
 
         Args:
           nom_event_emb: 
           nom_context_emb: 
+          context_positions: Only vote with the context events at these
+            positions, all of them if not given.
 
         Returns:
 
@@ -628,9 +842,11 @@ class EventContextAttentionPool(nn.Module):
         # First compute the trans matrix between events and the context.
         if self._vote_method == 'cosine':
             # Normalized dot product is cosine.
-            trans = torch.bmm(nom_event_emb, nom_context_emb.transpose(-2, -1))
+            trans = selected_products(nom_event_emb, nom_context_emb,
+                                      context_positions)
         elif self._vote_method == 'biaffine':
-            trans = self.event_vote_layer(nom_event_emb, nom_context_emb)
+            trans = self.event_vote_layer(nom_event_emb, nom_context_emb,
+                                          context_positions)
         elif self._vote_method == 'mlp':
             raise NotImplementedError("MLP not yet supported when voting.")
         else:
@@ -639,7 +855,8 @@ class EventContextAttentionPool(nn.Module):
             )
         return trans
 
-    def forward(self, event_emb, context_emb, self_avoid_mask):
+    def forward(self, event_emb, context_emb, self_avoid_mask,
+                context_positions=None):
         """Compute the contextual scores in the attentive way, i.e., computing
         some cross scores between the two representations.
 
@@ -648,17 +865,35 @@ class EventContextAttentionPool(nn.Module):
           context_emb:
           self_avoid_mask: mask of shape event_size x context_size, each
             row is contain only one zero that indicate which context should not
-            be used.
+            be used. With the context positions, it is the mask of the
+            positions instead.
+          context_positions: The positions of the context events to vote
+            with, of shape batch x instance_size x num_votes, all the context
+            events vote if not given.
 
         Returns:
 
         """
+        # The votes are always computed in full precision, even under
+        # autocast: the exact match kernel (sigma 1e-3) is narrower than the
+        # resolution of the half precision cosine around 1.
+        with torch.autocast(device_type=event_emb.device.type, enabled=False):
+            return self._vote_and_pool(
+                event_emb.float(), context_emb.float(), self_avoid_mask,
+                context_positions)
+
+    def _vote_and_pool(self, event_emb, context_emb, self_avoid_mask,
+                       context_positions=None):
         nom_event_emb = F.normalize(event_emb, 2, -1)
         nom_context_emb = F.normalize(context_emb, 2, -1)
 
-        trans = self._context_vote(nom_event_emb, nom_context_emb)
+        # With the context positions, only the votes with the context events
+        # at the positions are computed, so the pooling is over these votes
+        # only.
+        trans = self._context_vote(nom_event_emb, nom_context_emb,
+                                   context_positions)
 
-        # Make the self score zero.
+        # Make the self score, or the scores outside the context, zero.
         trans = trans * self_avoid_mask
 
         if self._vote_pool_type == 'kernel':
@@ -672,9 +907,9 @@ class EventContextAttentionPool(nn.Module):
                 pooled_value, _ = trans.topk(self._pool_topk, 2,
                                              largest=True)
             else:
-                added = torch.zeros(
+                added = trans.new_zeros(
                     (trans.shape[0], trans.shape[1],
-                     self._pool_topk - trans.shape[2])).to(self.device)
+                     self._pool_topk - trans.shape[2]))
                 pooled_value = torch.cat((trans, added), -1)
         else:
             raise ValueError(
@@ -735,23 +970,26 @@ class EventCoherenceModel(ArgCompatibleModel):
         else:
             self.normalize_score = False
 
-    def event_repr(self, batch_event_data, batch_info):
+    def event_repr(self, batch_event_data):
+        """Compute the representation of the candidate events.
+
+        Args:
+          batch_event_data: The instance data of the batch.
+
+        Returns:
+          The predicate embedding and the event representation.
+
+        """
         if self.para.arg_representation_method == 'fix_slots':
             # batch x instance_size x event_component
             batch_event_rep = batch_event_data['event_component']
-            # batch x context_size x event_component
-            batch_context = batch_info['context_event_component']
-
-            context_emb = self.event_embedding(batch_context)
             event_emb = self.event_embedding(batch_event_rep)
 
             event_repr = self.arg_composition_model(event_emb)
-            context_repr = self.arg_composition_model(context_emb)
 
             pred_emb = event_emb[:, :, 1, :]
         elif self.para.arg_representation_method == 'role_dynamic':
             batch_event_repr_data = {}
-            batch_context_event_repr_data = {}
 
             # Each value is of shape batch x instance_size,
             # and will become embeddings:
@@ -759,14 +997,10 @@ class EventCoherenceModel(ArgCompatibleModel):
             for k in 'predicate', 'slot_value', 'slot':
                 batch_event_repr_data[k] = self.event_embedding(
                     batch_event_data[k])
-                batch_context_event_repr_data[k] = self.event_embedding(
-                    batch_info["context_" + k])
 
             # batch x instance_size
             for k in ('slot_length',):
                 batch_event_repr_data[k] = batch_event_data[k]
-                batch_context_event_repr_data[k] = \
-                    batch_info["context_" + k]
 
             batch_pred_rep = batch_event_repr_data['predicate']
 
@@ -774,14 +1008,44 @@ class EventCoherenceModel(ArgCompatibleModel):
             pred_emb = batch_pred_rep[:, :, 1, :]
 
             event_repr = self.arg_composition_model(batch_event_repr_data)
-
-            context_repr = self.arg_composition_model(
-                batch_context_event_repr_data)
         else:
             raise ValueError(
                 f"Unknown compose method {self.para.arg_representation_method}")
 
-        return pred_emb, event_repr, context_repr
+        return pred_emb, event_repr
+
+    def encode_context(self, batch_info):
+        """Compute the representation of the context events. It only depends
+        on the document, so it can be computed once and shared by all the
+        test cases of the document, see score.
+
+        Args:
+          batch_info: The common data of the batch.
+
+        Returns:
+          The context representation, batch x context_size x dim.
+
+        """
+        if self.para.arg_representation_method == 'fix_slots':
+            # batch x context_size x event_component
+            batch_context = batch_info['context_event_component']
+            context_emb = self.event_embedding(batch_context)
+            return self.arg_composition_model(context_emb)
+        elif self.para.arg_representation_method == 'role_dynamic':
+            batch_context_event_repr_data = {}
+
+            for k in 'predicate', 'slot_value', 'slot':
+                batch_context_event_repr_data[k] = self.event_embedding(
+                    batch_info["context_" + k])
+
+            for k in ('slot_length',):
+                batch_context_event_repr_data[k] = \
+                    batch_info["context_" + k]
+
+            return self.arg_composition_model(batch_context_event_repr_data)
+        else:
+            raise ValueError(
+                f"Unknown compose method {self.para.arg_representation_method}")
 
     def __slot_indicator(self, slot_indicator):
         if self.para.arg_representation_method == 'fix_slots':
@@ -803,8 +1067,22 @@ class EventCoherenceModel(ArgCompatibleModel):
         Returns:
 
         """
-        pdb.set_trace()
+        return self.score(batch_event_data, batch_info,
+                          self.encode_context(batch_info))
+
+    def score(self, batch_event_data, batch_info, context_repr):
+        """Score the candidates with a pre-computed context representation.
+
+        Args:
+          batch_event_data: The instance data of the batch.
+          batch_info: The common data of the batch, the context data is not
+            used here.
+          context_repr: The context representation from encode_context.
+
+        Returns:
+          The scores, batch x instance_size.
 
+        """
         # batch x instance_size x n_features
         batch_features = batch_event_data['features']
 
@@ -819,9 +1097,8 @@ class EventCoherenceModel(ArgCompatibleModel):
 
         l_extracted = [batch_features, slot_features]
 
-        # Compute the representation of events and context events.
-        pred_emb, event_repr, context_repr = self.event_repr(
-            batch_event_data, batch_info)
+        # Compute the representation of events.
+        pred_emb, event_repr = self.event_repr(batch_event_data)
 
         # Compute the distance features using the predicate embedding.
         if self._use_distance:
@@ -834,20 +1111,30 @@ class EventCoherenceModel(ArgCompatibleModel):
 
         # Now compute the coherent features with all context events.
         _, context_size, _ = context_repr.shape
-        self_mask = self.self_event_mask(batch_event_indices, context_size)
-
-        coh_features = self.context_vote_layer(event_repr, context_repr,
-                                               self_mask)
+        if self.para.vote_context == 'all':
+            self_mask = self.self_event_mask(batch_event_indices, context_size)
+            coh_features = self.context_vote_layer(event_repr, context_repr,
+                                                   self_mask)
+        else:
+            # Only vote with the context events around the current one.
+            positions, vote_mask = self.context_positions(batch_event_indices,
+                                                          context_size)
+            coh_features = self.context_vote_layer(event_repr, context_repr,
+                                                   vote_mask, positions)
 
         l_extracted.append(coh_features)
 
         # batch x instance_size x feature_size
         all_features = torch.cat(l_extracted, -1)
 
-        # batch x instance_size x 1
-        scores = self._linear_combine(all_features).squeeze(-1)
+        # The final combination and the sigmoid are kept in full precision,
+        # the scores are fed to the loss directly.
+        with torch.autocast(device_type=all_features.device.type,
+                            enabled=False):
+            # batch x instance_size x 1
+            scores = self._linear_combine(all_features.float()).squeeze(-1)
 
-        if self.normalize_score:
-            scores = torch.nn.Sigmoid()(scores)
+            if self.normalize_score:
+                scores = torch.nn.Sigmoid()(scores)
 
         return scores
@@ -1,13 +1,11 @@
-import pdb
 import logging
 import math
 import os
 import pickle
 import shutil
-from collections import Counter
+from collections import Counter, deque
 import json
 from time import localtime, strftime
-import random
 from typing import Dict
 
 from smart_open import open
@@ -32,8 +30,15 @@ from event.arguments.arg_models import (
     RandomBaseline,
 )
 from event.arguments.implicit_arg_resources import ImplicitArgResources
-from event.arguments.evaluation import ImplicitEval
+from event.arguments.evaluation import ImplicitEval, case_scores
+from event.arguments.scripted_scorer import export_scorer
+from event.arguments.quantization import quantize_for_inference
 from event.arguments.data.cloze_gen import ClozeSampler
+from event.arguments.data.batch_cache import BatchCacheReader, BatchCacheWriter
+from event.arguments.data.prefetch import BatchPrefetcher
+from event.arguments.data.shuffle import ShuffleBuffer
+from event.arguments.data.hashed_io import data_gen
+from event.nn.optim import LazyAdam
 from event.util import load_mixed_configs
 from event.util import (
     set_file_log, set_basic_log, ensure_dir, append_num_to_path
@@ -42,114 +47,368 @@ from event.util import (
 logger = logging.getLogger(__name__)
 
 
-def data_gen(data_path, from_line=None, until_line=None):
-    line_num = 0
-
-    if os.path.isdir(data_path):
-        last_file = None
-        for f in sorted(os.listdir(data_path)):
-            if not f.startswith('.') and f.endswith('.gz'):
-                with open(os.path.join(data_path, f)) as fin:
-                    for line in fin:
-                        line_num += 1
-                        if from_line and line_num <= from_line:
-                            continue
-                        if until_line and line_num > until_line:
-                            break
-
-                        if not last_file == f:
-                            logger.info("Reading from {}".format(f))
-                            last_file = f
-                        yield line
-    else:
-        with open(data_path) as fin:
-            logger.info("Reading from {}".format(data_path))
-            for line in fin:
-                line_num += 1
-                if from_line and line_num <= from_line:
-                    continue
-                if until_line and line_num > until_line:
-                    break
-                yield line
-
-
-def to_device(data, device):
+def to_device(data, device, non_blocking=False):
     if isinstance(data, Dict):
         for key, d in data.items():
-            data[key] = d.to(device)
+            data[key] = to_device(d, device, non_blocking)
         return data
+    elif non_blocking:
+        # Asynchronous copy only works from pinned memory.
+        return data.pin_memory().to(device, non_blocking=True)
     else:
         return data.to(device)
 
 
+def batch_to_device(data_batch, device, non_blocking=False):
+    labels, instances, common_data, b_size, mask, metadata = data_batch
+    return (
+        to_device(labels, device, non_blocking),
+        to_device(instances, device, non_blocking),
+        to_device(common_data, device, non_blocking),
+        b_size,
+        to_device(mask, device, non_blocking),
+        metadata
+    )
+
+
+class DocStream:
+    """The training documents read by data_gen, optionally passed through a
+    shuffle buffer. Each document is emitted with its doc id, the line number
+    after `from_line`. The stream records how many documents are read, the
+    ones held in the shuffle buffer, and the ones emitted but not consumed
+    yet (see `consume`), so it can be restarted from a recorded position
+    without losing or repeating documents.
+
+    Args:
+      data_path: The training data path.
+      from_line: Skip this number of lines (e.g. the validation lines).
+      use_index: Whether to seek with the line index.
+      shuffle_buffer: A ShuffleBuffer, or None to read in the data order.
+    """
+
+    def __init__(self, data_path, from_line=0, use_index=False,
+                 shuffle_buffer=None):
+        self.data_path = data_path
+        self.from_line = from_line or 0
+        self.use_index = use_index
+        self.shuffle_buffer = shuffle_buffer
+        self.num_read = 0
+        # The ids of the documents emitted but not consumed, in the emitted
+        # order (the values are not used).
+        self.__unconsumed = {}
+
+    def __count(self, lines):
+        for line in lines:
+            # Counted before emitting, the shuffle buffer reads ahead.
+            self.num_read += 1
+            yield self.num_read - 1, line
+
+    def __emit(self, docs):
+        for doc_id, line in docs:
+            self.__unconsumed[doc_id] = None
+            yield doc_id, line
+
+    def consume(self, doc_ids):
+        """Mark the documents as consumed, they are not replayed when
+        restarted from a later position.
+
+        Args:
+          doc_ids: The ids of the consumed documents.
+
+        Returns:
+
+        """
+        for doc_id in doc_ids:
+            self.__unconsumed.pop(doc_id, None)
+
+    def position(self):
+        return {
+            'num_read': self.num_read,
+            'shuffle_state': None if self.shuffle_buffer is None else
+            self.shuffle_buffer.rng.getstate(),
+            'buffered': [] if self.shuffle_buffer is None else
+            [doc_id for doc_id, _ in self.shuffle_buffer.buffer],
+            'unconsumed': list(self.__unconsumed),
+        }
+
+    def __saved_docs(self, doc_ids):
+        """Read the saved documents again, they are all read before the
+        recorded position.
+
+        Args:
+          doc_ids: The ids of the documents.
+
+        Returns:
+          A map from the doc id to the line.
+
+        """
+        if not doc_ids:
+            return {}
+
+        first = min(doc_ids)
+        wanted = set(doc_ids)
+        lines = data_gen(self.data_path,
+                         from_line=self.from_line + first,
+                         until_line=self.from_line + self.num_read,
+                         use_index=self.use_index)
+        return dict((doc_id, line) for doc_id, line in
+                    enumerate(lines, start=first) if doc_id in wanted)
+
+    def documents(self, position=None):
+        """Read the documents as (doc id, line) pairs.
+
+        Args:
+          position: A position from `position()` to restart from. The
+            documents emitted but not consumed at that time are emitted
+            again first, then the ones in the shuffle buffer continue to be
+            shuffled with the new ones.
+
+        Returns:
+
+        """
+        self.__unconsumed = {}
+
+        if position:
+            self.num_read = position['num_read']
+            unconsumed = position['unconsumed']
+            buffered = position['buffered']
+        else:
+            self.num_read = 0
+            unconsumed = []
+            buffered = []
+
+        saved = self.__saved_docs(unconsumed + buffered)
+        if saved:
+            logger.info(f"Replaying {len(unconsumed)} unconsumed documents "
+                        f"and {len(buffered)} buffered documents.")
+
+        yield from self.__emit((doc_id, saved[doc_id])
+                               for doc_id in unconsumed)
+
+        docs = self.__count(data_gen(self.data_path,
+                                     from_line=self.from_line + self.num_read,
+                                     use_index=self.use_index))
+
+        if self.shuffle_buffer is not None:
+            if position:
+                self.shuffle_buffer.rng.setstate(position['shuffle_state'])
+            docs = self.shuffle_buffer.shuffle(
+                docs, [(doc_id, saved[doc_id]) for doc_id in buffered])
+
+        yield from self.__emit(docs)
+
+
+class DocContextCache:
+    """Share the encoded context of a document across its test cases. The
+    test cases of a document are read consecutively, so only the documents in
+    the last batch are kept.
+
+    Args:
+      model: The EventCoherenceModel to encode the contexts.
+    """
+
+    def __init__(self, model: EventCoherenceModel):
+        self.model = model
+        # Map from the doc id to the (context data, context representation).
+        self.__entries = {}
+
+        self.num_encoded = 0
+        self.num_reused = 0
+
+    def context_repr(self, common_data, metadata):
+        """The context representation of a test batch.
+
+        Args:
+          common_data: The common data of the batch (on the model device).
+          metadata: The metadata of the batch.
+
+        Returns:
+          The context representation, batch x context_size x dim.
+
+        """
+        context_keys = [k for k in common_data if k.startswith('context_')]
+
+        entries = {}
+        rows = []
+        for index, instance_meta in enumerate(metadata['instance']):
+            docid = instance_meta['docid']
+            context = dict((k, common_data[k][index: index + 1]) for k in
+                           context_keys)
+
+            entry = entries.get(docid, self.__entries.get(docid))
+
+            # The doc id is only a hint, the context must be the same.
+            if entry is None or not all(
+                    torch.equal(entry[0][k], v) for k, v in context.items()):
+                entry = (context, self.model.encode_context(context))
+                self.num_encoded += 1
+            else:
+                self.num_reused += 1
+
+            entries[docid] = entry
+            rows.append(entry[1])
+
+        self.__entries = entries
+        return torch.cat(rows)
+
+
 class CachableDataSource:
     def __init__(self, reader, data_iter, train_sampler, device,
-                 cache_size=-1, dump_dir=None):
+                 cache_size=-1, dump_dir=None, non_blocking=False):
         self.data_source = data_iter
         self.train_sampler = train_sampler
         self.dump_dir = dump_dir
         self.reader = reader
         self.cache_size = cache_size
         self.device = device
+        self.non_blocking = non_blocking
+
+        # The ids of the documents read but not reached the batcher, and the
+        # sampler state before reading each unconsumed document.
+        self.__read_ids = deque()
+        self.__doc_states = {}
+
+    def __sampled_docs(self, start=None):
+        """The document lines from the stream, the sampler state before
+        reading each one is recorded, the documents replayed from `start` are
+        read with their recorded states.
+
+        Args:
+          start: Resume from this data position.
+
+        Returns:
+
+        """
+        replay_states = {}
+        resume_state = None
+        if start:
+            replay_states = dict(start['doc_sampler_states'])
+            resume_state = start['sampler_state']
+
+        for doc_id, line in self.data_source.documents(
+                start and start['stream']):
+            if doc_id in replay_states:
+                self.train_sampler.rng.setstate(replay_states.pop(doc_id))
+            elif resume_state is not None:
+                # Continue the random stream from the recorded position.
+                self.train_sampler.rng.setstate(resume_state)
+                resume_state = None
+
+            self.__read_ids.append(doc_id)
+            self.__doc_states[doc_id] = self.train_sampler.rng.getstate()
+            yield line
+
+    def __consume(self, batch_doc_ids):
+        """Mark the documents of a batch as consumed.
+
+        Args:
+          batch_doc_ids: The `doc_ids` of the batch metadata.
+
+        Returns:
+          The data position after the batch.
+
+        """
+        for doc_ids in batch_doc_ids:
+            self.data_source.consume(doc_ids)
+            for doc_id in doc_ids:
+                self.__doc_states.pop(doc_id, None)
+
+        return {
+            'stream': self.data_source.position(),
+            'sampler_state': self.train_sampler.rng.getstate(),
+            # The documents emitted but not consumed are read again with the
+            # same sampler states.
+            'doc_sampler_states': dict(self.__doc_states),
+        }
 
     def check_dump_dir(self):
         return (self.dump_dir is not None and os.path.exists(
             self.dump_dir) and os.path.exists(
-            os.path.join(self.dump_dir, '.success')))
+            os.path.join(self.dump_dir, '.success')) and
+                len(BatchCacheReader.list_shards(self.dump_dir)) > 0)
+
+    def data(self, epoch=None, start=None):
+        """Generate the batches on the device. The metadata of each batch
+        records the data position after it (`data_position`), which can be
+        used as `start` to resume. The resumed batches have the same
+        instances, but the bucketed batches may group them differently.
 
-    def get_dump_files(self):
-        file_list = [f for f in os.listdir(self.dump_dir) if
-                     f.endswith('.cache')]
-        random.shuffle(file_list)
-        return file_list
+        Args:
+          epoch: The epoch number, which seeds the order of the cached
+            batches.
+          start: Resume from this data position.
 
-    def data(self):
+        Returns:
+
+        """
         if self.check_dump_dir():
             logger.info("Reading from dumped instances.")
-            for dump_f in self.get_dump_files():
-                with open(os.path.join(self.dump_dir, dump_f), 'rb') as f:
-                    try:
-                        while True:
-                            yield to_device(pickle.load(f), self.device)
-                    except EOFError:
-                        pass
-                    except Exception as e:
-                        print(e)
-                        pdb.set_trace()
+            cache_reader = BatchCacheReader(self.dump_dir)
+            logger.info(f"Found {cache_reader.num_batches()} batches in "
+                        f"{len(cache_reader.shard_dirs)} shards.")
+
+            num_batches = 0
+            if start:
+                if 'cache_batches' in start:
+                    num_batches = start['cache_batches']
+                else:
+                    logger.warning("The position is from the raw data, but "
+                                   "the dump is finished, restart the epoch "
+                                   "with the dumped batches.")
+            if num_batches:
+                logger.info(f"Resume after {num_batches} cached batches.")
+
+            for data_batch in cache_reader.batches(
+                    shuffle=True, seed=epoch, start=num_batches):
+                num_batches += 1
+                # The metadata is from the shard index, which is not copied.
+                meta = dict(data_batch[5])
+                meta['data_position'] = {'cache_batches': num_batches}
+                yield batch_to_device(data_batch[:5] + (meta,), self.device,
+                                      self.non_blocking)
         else:
             logger.info("Reading from raw data source.")
-            train_gen = self.reader.read_train_batch(self.data_source,
-                                                     self.train_sampler)
 
-            if self.dump_dir is not None and not os.path.exists(self.dump_dir):
-                os.makedirs(self.dump_dir)
+            docs = self.data_source
+            next_doc_id = None
+            if isinstance(self.data_source, DocStream):
+                self.__read_ids = deque()
+                self.__doc_states = {}
+                docs = self.__sampled_docs(start)
+                next_doc_id = self.__read_ids.popleft
+
+            train_gen = self.reader.read_train_batch(docs, self.train_sampler,
+                                                     next_doc_id)
 
             # TODO: All data are cached here without sampling, but we can add
             #  sampling if we don't sample inside the reader, we can do them
             #  here?
+            cache_writer = None
             if self.dump_dir is not None:
-                cache_path = os.path.join(self.dump_dir, f'dump_{0}.cache')
-                cache_file = open(cache_path, 'wb')
-                cache_pair = 0, cache_file
+                if start:
+                    logger.info("The training dump is not written in a "
+                                "resumed epoch.")
+                else:
+                    cache_writer = BatchCacheWriter(self.dump_dir,
+                                                    self.cache_size)
 
-            instance_idx = 0
             for data_batch in train_gen:
-                yield [to_device(d, self.device) for d in data_batch]
-                instance_idx += 1
-
-                if self.dump_dir is not None:
-                    cache_idx = int(instance_idx / self.cache_size)
-                    if cache_idx == cache_pair[0]:
-                        cache_file = cache_pair[1]
-                    else:
-                        cache_file = open(
-                            os.path.join(self.dump_dir,
-                                         f'dump_{cache_idx}.cache'), 'wb')
-                        cache_pair = cache_idx, cache_file
-
-                    pickle.dump(data_batch, cache_file)
-
-            if self.dump_dir is not None:
+                if cache_writer is not None:
+                    # Write before moving, the batch is modified in place.
+                    cache_writer.add(data_batch)
+
+                if isinstance(self.data_source, DocStream):
+                    # Copy the metadata, the position is not written to the
+                    # dump.
+                    meta = dict(data_batch[5])
+                    meta['data_position'] = self.__consume(meta['doc_ids'])
+                    data_batch = data_batch[:5] + (meta,)
+
+                yield batch_to_device(data_batch, self.device,
+                                      self.non_blocking)
+
+            if cache_writer is not None:
+                cache_writer.close()
                 with open(os.path.join(self.dump_dir, '.success'), 'w') as f:
                     f.write('success')
 
@@ -193,6 +452,11 @@ class ArgRunner(Configurable):
         else:
             self.device = 'cpu'
 
+        # Mixed precision uses bfloat16 on CPU, which has the float32 range,
+        # and float16 on GPU, which needs gradient scaling.
+        self.amp_dtype = torch.float16 if self.device == 'cuda' else \
+            torch.bfloat16
+
         self.nb_epochs = self.para.nb_epochs
 
         if self.para.model_type:
@@ -220,9 +484,20 @@ class ArgRunner(Configurable):
             assert self.para.event_arg_vocab_size == \
                    self.resources.event_embedding.shape[0]
 
+    def autocast(self):
+        """The autocast context of the mixed precision mode, it does nothing if
+        the mode is off."""
+        return torch.autocast(device_type=self.device, dtype=self.amp_dtype,
+                              enabled=self.para.mixed_precision)
+
     def _get_loss(self, labels, batch_instance, batch_common, mask):
-        coh = self.model(batch_instance, batch_common)
-        loss = F.binary_cross_entropy(coh * mask, labels)
+        with self.autocast():
+            coh = self.model(batch_instance, batch_common)
+        # Average over the real instances only, the number of padded cells
+        # varies with the batch composition. The loss is computed outside
+        # autocast, in float32.
+        loss = F.binary_cross_entropy(
+            coh.float() * mask, labels, reduction='sum') / mask.sum()
         return loss
 
     def __dump_stuff(self, key, obj):
@@ -291,14 +566,7 @@ class ArgRunner(Configurable):
             logger.warning(
                 "Serialized model not existing, test without loading.")
 
-    @torch.no_grad()
-    def __test(self, model, test_lines, nid_detector,
-               auto_test=False, eval_dir=None):
-        self.model.eval()
-
-        evaluator = ImplicitEval(eval_dir)
-        instance_count = 0
-
+    def __set_test_reader(self, auto_test=False):
         self.reader.auto_test = auto_test
         self.reader.factor_role = self.test_factor_role
         self.reader.use_gold_mention = True
@@ -309,29 +577,66 @@ class ArgRunner(Configurable):
             f"use gold mention: {self.reader.use_gold_mention}, "
             f"use auto mention: {self.reader.use_auto_mention}")
 
+    @torch.no_grad()
+    def __test(self, model, test_lines, nid_detector,
+               auto_test=False, eval_dir=None):
+        self.model.eval()
+
+        evaluator = ImplicitEval(eval_dir)
+        instance_count = 0
+
+        self.__set_test_reader(auto_test)
+
         logger.info(f"Evaluation result will be stored at {eval_dir}")
 
+        if self.para.int8_inference:
+            if self.device == 'cpu':
+                model = quantize_for_inference(model,
+                                               self.para.int8_embeddings)
+            else:
+                logger.warning("The int8 inference only runs on CPU, test "
+                               "in full precision.")
+
+        # The context of a document is encoded once for all its test cases.
+        context_cache = None
+        if isinstance(model, EventCoherenceModel):
+            context_cache = DocContextCache(model)
+
         for test_data in self.reader.read_test_docs(test_lines, nid_detector):
             (labels, instances, common_data, _, _, metadata) = test_data
 
-            coh = model(to_device(instances, self.device),
-                        to_device(common_data, self.device))
+            instances = to_device(instances, self.device)
+            common_data = to_device(common_data, self.device)
 
-            coh_scores = np.squeeze(coh.data.cpu().numpy()).tolist()
+            with self.autocast():
+                if context_cache is None:
+                    coh = model(instances, common_data)
+                else:
+                    coh = model.score(
+                        instances, common_data,
+                        context_cache.context_repr(common_data, metadata))
+
+            coh_scores = case_scores(coh.data.float().cpu().numpy(), metadata)
 
             evaluator.add_prediction(coh_scores, metadata)
 
-            instance_count += 1
+            for _ in coh_scores:
+                instance_count += 1
 
-            if instance_count % 1000 == 0:
-                logger.info("Tested %d instances." % instance_count)
+                if instance_count % 1000 == 0:
+                    logger.info("Tested %d instances." % instance_count)
 
-        if len(instance_count) == 0:
+        if instance_count == 0:
             logger.warning("0 instances found, check data reader.")
             print("0 instances found, check data reader!")
 
         logger.info("Finish testing %d instances." % instance_count)
 
+        if context_cache is not None:
+            logger.info(
+                f"Encoded {context_cache.num_encoded} document contexts, "
+                f"reused {context_cache.num_reused} times.")
+
         if eval_dir:
             logger.info("Writing evaluation output to %s." % eval_dir)
 
@@ -473,20 +778,65 @@ class ArgRunner(Configurable):
         self.__test(self.model, data_gen(test_in), self.nid_detector,
                     eval_dir=eval_dir)
 
+    def export(self, test_in, export_path):
+        """Export the best model as a TorchScript scorer, traced on the first
+        batch of the test data, see scripted_scorer.
+
+        Args:
+          test_in: The test data to take the example batch from.
+          export_path: Path of the exported scorer.
+
+        Returns:
+
+        """
+        if not isinstance(self.model, EventCoherenceModel):
+            raise ValueError("Only the EventCoherenceModel can be exported.")
+
+        self.__load_best()
+        self.__set_test_reader()
+
+        for test_data in self.reader.read_test_docs(data_gen(test_in),
+                                                    self.nid_detector):
+            _, instances, common_data, _, _, _ = test_data
+            export_scorer(self.model, instances, common_data, export_path)
+            logger.info(f"Exported the scorer to {export_path}.")
+            return
+
+        logger.error(f"No test case found in {test_in} to trace the model.")
+
     def train(self, basic_para, resume=False):
+        if self.basic_para.prefetch_depth > 0 and \
+                self.para.num_reader_workers > 1:
+            # The reader workers would be forked from the prefetch thread,
+            # which is unsafe while the other threads hold locks.
+            raise ValueError("The reader workers (num_reader_workers > 1) "
+                             "cannot be used with prefetch_depth > 0.")
+
+        if self.basic_para.checkpoint_steps > 0 and \
+                self.para.num_reader_workers > 1:
+            # The samplers of the reader workers live in the worker processes,
+            # their states cannot be saved to resume from.
+            raise ValueError("The checkpoints in the middle of an epoch "
+                             "(checkpoint_steps > 0) cannot be used with the "
+                             "reader workers (num_reader_workers > 1).")
+
         train_in = basic_para.train_in
         target_pred_count = Counter()
 
-        train_sampler = ClozeSampler()
+        train_sampler = ClozeSampler(seed=self.basic_para.sampler_seed)
         dev_sampler = ClozeSampler(seed=7)
 
-        self.reader.factor_role = basic_para.train_factor_role
-        self.reader.use_gold_mention = True
-        self.reader.use_auto_mention = True
+        # The training data has its own reader: the self study in the
+        # training loop switches self.reader to the test settings, while the
+        # prefetch thread may be building the training batches.
+        train_reader = HashedClozeReader(self.resources, self.para)
+        train_reader.factor_role = basic_para.train_factor_role
+        train_reader.use_gold_mention = True
+        train_reader.use_auto_mention = True
         logger.info(
-            f"During training, factor role is [{self.reader.factor_role}], "
-            f"use gold mention: {self.reader.use_gold_mention}, "
-            f"use auto mention: {self.reader.use_auto_mention}")
+            f"During training, factor role is [{train_reader.factor_role}], "
+            f"use gold mention: {train_reader.use_gold_mention}, "
+            f"use auto mention: {train_reader.use_auto_mention}")
 
         logger.info("Training with data from [%s]", train_in)
 
@@ -502,13 +852,27 @@ class ArgRunner(Configurable):
 
         self.model.train()
 
-        optimizer = torch.optim.Adam(self.model.parameters())
+        if self.para.sparse_embeddings:
+            optimizer = LazyAdam(self.model.parameters())
+        else:
+            optimizer = torch.optim.Adam(self.model.parameters())
+
+        # Scale the loss to avoid underflow of the float16 gradients, it is
+        # not needed for bfloat16, and does nothing when disabled.
+        scaler = torch.amp.GradScaler(
+            'cuda',
+            enabled=self.para.mixed_precision and self.device == 'cuda')
 
         start_epoch = 0
         best_loss = math.inf
         previous_dev_loss = math.inf
         worse = 0
 
+        # Where to resume inside the start epoch, None to start from the
+        # beginning of the epoch.
+        resume_position = None
+        resume_counts = {}
+
         if resume:
             checkpoint_path = os.path.join(self.model_dir, self.checkpoint_name)
             if os.path.isfile(checkpoint_path):
@@ -516,12 +880,18 @@ class ArgRunner(Configurable):
                 checkpoint = torch.load(checkpoint_path)
                 self.model.load_state_dict(checkpoint['state_dict'])
                 optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+                if 'scaler_state_dict' in checkpoint:
+                    scaler.load_state_dict(checkpoint['scaler_state_dict'])
 
                 start_epoch = checkpoint['epoch']
                 best_loss = checkpoint['best_loss']
                 previous_dev_loss = checkpoint['previous_dev_loss']
                 worse = checkpoint['worse']
 
+                # Only in the checkpoints saved in the middle of an epoch.
+                resume_position = checkpoint.get('data_position')
+                resume_counts = checkpoint.get('counts', {})
+
                 # https://discuss.pytorch.org/t/gpu-memory-usage-increases-by-90-after-torch-load/9213/3
                 del checkpoint
                 torch.cuda.empty_cache()
@@ -532,23 +902,30 @@ class ArgRunner(Configurable):
                     f"previous dev loss {previous_dev_loss}, "
                     f"worsen {worse} times."
                 )
+                if resume_position:
+                    logger.info(
+                        f"Resume in the middle of epoch {start_epoch}, after "
+                        f"{resume_counts.get('epoch_batch_count')} batches.")
             else:
                 logger.info(
                     "No model to resume at '{}', starting from scratch.".format(
                         checkpoint_path))
 
         # Read development lines.
+        use_index = self.basic_para.use_line_index
         dev_lines = None
         if self.basic_para.valid_in:
-            dev_lines = [l for l in data_gen(self.basic_para.valid_in)]
+            dev_lines = [l for l in data_gen(self.basic_para.valid_in,
+                                             use_index=use_index)]
         if self.basic_para.validation_size:
             dev_lines = [l for l in
                          data_gen(train_in,
-                                  until_line=self.basic_para.validation_size)]
+                                  until_line=self.basic_para.validation_size,
+                                  use_index=use_index)]
 
         all_dev_data = []
-        for dev_data in CachableDataSource(self.reader, dev_lines, dev_sampler,
-                                           self.device).data():
+        for dev_data in CachableDataSource(train_reader, dev_lines,
+                                           dev_sampler, self.device).data():
             all_dev_data.append(dev_data)
 
         if self.basic_para.pre_val:
@@ -562,19 +939,37 @@ class ArgRunner(Configurable):
             best_loss = dev_loss
             previous_dev_loss = dev_loss
 
-        batch_count = 0
-        instance_count = 0
+        batch_count = resume_counts.get('batch_count', 0)
+        instance_count = resume_counts.get('instance_count', 0)
 
         # Training stats.
-        total_loss = 0
+        total_loss = resume_counts.get('total_loss', 0)
         recent_loss = 0
         log_freq = 100
+        checkpoint_steps = self.basic_para.checkpoint_steps
+
+        # With prefetching, the batches are moved to the GPU in the background
+        # thread, where asynchronous copy can overlap with the computation.
+        prefetch_depth = self.basic_para.prefetch_depth
+
+        shuffle_buffer = None
+        if self.basic_para.shuffle_buffer_size > 1:
+            # Mix the documents across the shards while streaming.
+            logger.info(f"Shuffling the training documents with a buffer of "
+                        f"{self.basic_para.shuffle_buffer_size}.")
+            shuffle_buffer = ShuffleBuffer(self.basic_para.shuffle_buffer_size,
+                                           self.basic_para.shuffle_seed)
+
+        train_stream = DocStream(
+            train_in, from_line=self.basic_para.validation_size,
+            use_index=use_index, shuffle_buffer=shuffle_buffer)
 
         train_dataset = CachableDataSource(
-            self.reader,
-            data_gen(train_in, from_line=self.basic_para.validation_size),
+            train_reader,
+            train_stream,
             train_sampler, self.device, self.basic_para.train_cache_size,
-            self.train_cache_dir
+            self.train_cache_dir,
+            non_blocking=prefetch_depth > 0 and self.device == 'cuda'
         )
 
         for epoch in range(start_epoch, self.nb_epochs):
@@ -582,14 +977,27 @@ class ArgRunner(Configurable):
             epoch_batch_count = 0
             epoch_instance_count = 0
 
-            train_sampler.reset()
+            train_sampler.reset(epoch)
+            if shuffle_buffer is not None:
+                shuffle_buffer.reset(epoch)
+
+            start_position = None
+            if epoch == start_epoch and resume_position:
+                start_position = resume_position
+                epoch_batch_count = resume_counts['epoch_batch_count']
+                epoch_instance_count = resume_counts['epoch_instance_count']
 
             logger.info(f'Will ignore the first '
                         f'{self.basic_para.validation_size} validation lines '
                         f'for training.')
 
-            for instance_data in train_dataset.data():
-                labels, instances, batch_info, b_size, mask, _ = instance_data
+            train_batches = train_dataset.data(epoch, start_position)
+            if prefetch_depth > 0:
+                train_batches = BatchPrefetcher(train_batches, prefetch_depth)
+
+            for instance_data in train_batches:
+                labels, instances, batch_info, b_size, mask, meta = \
+                    instance_data
 
                 loss = self._get_loss(labels, instances, batch_info, mask)
 
@@ -614,14 +1022,18 @@ class ArgRunner(Configurable):
                     raise ValueError('Error in computing loss.')
 
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 # TODO: found nan in the weights.
                 nans_in_weight = torch.isnan(
                     self.model._linear_combine.weight).nonzero()
                 if nans_in_weight.shape[0] > 0:
-                    pdb.set_trace()
+                    logger.error(
+                        f"Found {nans_in_weight.shape[0]} NaN weights in the "
+                        f"final layer after batch {batch_count + 1}.")
+                    raise ValueError('NaN in the model weights.')
 
                 batch_count += 1
                 epoch_batch_count += 1
@@ -648,6 +1060,27 @@ class ArgRunner(Configurable):
 
                     recent_loss = 0
 
+                if checkpoint_steps > 0 and not batch_count % checkpoint_steps:
+                    # Resuming from here continues this epoch after the
+                    # current batch.
+                    self.__save_checkpoint({
+                        'epoch': epoch,
+                        'state_dict': self.model.state_dict(),
+                        'best_loss': best_loss,
+                        'previous_dev_loss': previous_dev_loss,
+                        'optimizer_state_dict': optimizer.state_dict(),
+                        'scaler_state_dict': scaler.state_dict(),
+                        'worse': worse,
+                        'data_position': meta.get('data_position'),
+                        'counts': {
+                            'batch_count': batch_count,
+                            'instance_count': instance_count,
+                            'epoch_batch_count': epoch_batch_count,
+                            'epoch_instance_count': epoch_instance_count,
+                            'total_loss': total_loss,
+                        },
+                    }, self.checkpoint_name)
+
             logger.info("Computing validation loss.")
             dev_loss, n_batches, n_instances = self.validation(
                 all_dev_data, dev_sampler)
@@ -682,7 +1115,13 @@ class ArgRunner(Configurable):
                 'best_loss': best_loss,
                 'previous_dev_loss': previous_dev_loss,
                 'optimizer_state_dict': optimizer.state_dict(),
+                'scaler_state_dict': scaler.state_dict(),
                 'worse': worse,
+                'counts': {
+                    'batch_count': batch_count,
+                    'instance_count': instance_count,
+                    'total_loss': total_loss,
+                },
             }, self.checkpoint_name)
 
             if new_best:
@@ -758,6 +1197,9 @@ def main(conf):
             eval_dir=result_dir,
         )
 
+    if basic_para.export_path:
+        runner.export(basic_para.test_in, basic_para.export_path)
+
 
 if __name__ == '__main__':
     class Basic(Configurable):
@@ -778,6 +1220,31 @@ if __name__ == '__main__':
             config=True)
         train_cache_size = Integer(help='Number of items per cache').tag(
             config=True)
+        use_line_index = Bool(
+            help='Seek in the training data with the line index.',
+            default_value=False).tag(config=True)
+        prefetch_depth = Integer(
+            help='Number of training batches prepared in background, '
+                 'prefetch is disabled if 0. The batches are read with a '
+                 'reader of their own, so the self study during training '
+                 'does not change their reader settings.',
+            default_value=0).tag(config=True)
+        shuffle_buffer_size = Integer(
+            help='Number of training documents buffered to shuffle the '
+                 'reading order, no shuffling if less than 2.',
+            default_value=0).tag(config=True)
+        shuffle_seed = Integer(
+            help='Random seed of the document shuffling.',
+            default_value=0).tag(config=True)
+        sampler_seed = Integer(
+            help='Random seed of the training cloze sampling, the stream of '
+                 'each epoch and each reader worker is derived from it.',
+            default_value=0).tag(config=True)
+        checkpoint_steps = Integer(
+            help='Save a checkpoint every this number of batches, which can '
+                 'resume in the middle of an epoch. Disabled if 0, and cannot '
+                 'be used with the reader workers.',
+            default_value=0).tag(config=True)
         model_dir = Unicode(help='Model directory.').tag(config=True)
         log_dir = Unicode(help='Logging directory.').tag(config=True)
         cmd_log = Bool(help='Log on command prompt only.',
@@ -792,6 +1259,9 @@ if __name__ == '__main__':
             config=True)
         debug_mode = Bool(help='Debug mode', default_value=False).tag(
             config=True)
+        export_path = Unicode(
+            help='Export the best model as a TorchScript scorer to this path, '
+                 'traced on the test data.').tag(config=True)
 
         test_factor_role = Unicode(
             help='The field name of the role that is used to '
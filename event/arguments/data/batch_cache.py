@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def batch_columns(data_batch):
+    """Flatten a batch from the ClozeBatcher into named arrays.
+
+    Args:
+      data_batch: A tuple of (labels, instance_data, common_data, data_size,
+        ins_mask, metadata).
+
+    Returns:
+
+    """
+    labels, instance_data, common_data, _, ins_mask, _ = data_batch
+
+    yield 'labels', labels
+    yield 'mask', ins_mask
+
+    for key, value in instance_data.items():
+        yield 'instance.' + key, value
+
+    for key, value in common_data.items():
+        yield 'common.' + key, value
+
+
+class BatchCacheWriter:
+    """Write the batches into columnar shards. Each column (a batch key) of a
+    shard is a flat binary file, where the batches are stored contiguously.
+    The shard index records the offset and shape of each batch in each column.
+
+    Args:
+      cache_dir: The directory to store the shards.
+      shard_size: Number of batches per shard, no limit if not positive.
+    """
+    index_name = 'index.json'
+
+    def __init__(self, cache_dir, shard_size):
+        self.cache_dir = cache_dir
+        self.shard_size = shard_size
+
+        self.shard_idx = -1
+        self.shard_dir = None
+        self.column_files = {}
+        self.column_offsets = {}
+        self.index = {}
+
+        # Remove the shards of an unfinished dump, which may have more shards.
+        for shard_dir in BatchCacheReader.list_shards(cache_dir):
+            shutil.rmtree(shard_dir)
+
+        self.__new_shard()
+
+    def __new_shard(self):
+        self.shard_idx += 1
+        self.shard_dir = os.path.join(self.cache_dir,
+                                      f'shard_{self.shard_idx}')
+        if not os.path.exists(self.shard_dir):
+            os.makedirs(self.shard_dir)
+
+        self.column_files = {}
+        self.column_offsets = {}
+        self.index = {
+            'dtypes': {},
+            'batches': [],
+        }
+
+    def __close_shard(self):
+        for f in self.column_files.values():
+            f.close()
+
+        with open(os.path.join(self.shard_dir, self.index_name), 'w') as out:
+            json.dump(self.index, out)
+
+    def add(self, data_batch):
+        if 0 < self.shard_size <= len(self.index['batches']):
+            self.__close_shard()
+            self.__new_shard()
+
+        batch_entry = {
+            'data_size': data_batch[3],
+            'meta': data_batch[5],
+            'columns': {},
+        }
+
+        for name, tensor in batch_columns(data_batch):
+            arr = np.ascontiguousarray(tensor.numpy())
+
+            if name not in self.column_files:
+                self.column_files[name] = open(
+                    os.path.join(self.shard_dir, name + '.bin'), 'wb')
+                self.column_offsets[name] = 0
+                self.index['dtypes'][name] = arr.dtype.str
+            elif not self.index['dtypes'][name] == arr.dtype.str:
+                raise ValueError(
+                    f"Column {name} has inconsistent types: "
+                    f"{self.index['dtypes'][name]} and {arr.dtype.str}")
+
+            self.column_files[name].write(arr.tobytes())
+
+            batch_entry['columns'][name] = (
+                self.column_offsets[name], arr.shape)
+            self.column_offsets[name] += arr.size
+
+        self.index['batches'].append(batch_entry)
+
+    def close(self):
+        self.__close_shard()
+
+
+class BatchCacheReader:
+    """Read the batches written by the BatchCacheWriter. The columns are
+    memory mapped, and the tensors are views of the mapped files, so no data
+    is copied until they are moved to the device.
+
+    Args:
+      cache_dir: The directory containing the shards.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.shard_dirs = self.list_shards(cache_dir)
+
+        self.indices = []
+        for shard_dir in self.shard_dirs:
+            with open(os.path.join(shard_dir,
+                                   BatchCacheWriter.index_name)) as fin:
+                self.indices.append(json.load(fin))
+
+        self.__memmaps = {}
+
+    @staticmethod
+    def list_shards(cache_dir):
+        if not os.path.isdir(cache_dir):
+            return []
+
+        return [
+            os.path.join(cache_dir, d) for d in sorted(os.listdir(cache_dir))
+            if os.path.exists(
+                os.path.join(cache_dir, d, BatchCacheWriter.index_name))
+        ]
+
+    def num_batches(self):
+        return sum(len(index['batches']) for index in self.indices)
+
+    def __column(self, shard, name):
+        key = (shard, name)
+        if key not in self.__memmaps:
+            # Copy-on-write mode gives writable arrays without touching the
+            # file, which torch.from_numpy prefers.
+            self.__memmaps[key] = np.memmap(
+                os.path.join(self.shard_dirs[shard], name + '.bin'),
+                dtype=np.dtype(self.indices[shard]['dtypes'][name]),
+                mode='c',
+            )
+        return self.__memmaps[key]
+
+    def load_batch(self, shard, batch_idx):
+        batch_entry = self.indices[shard]['batches'][batch_idx]
+
+        tensors = {}
+        for name, (offset, shape) in batch_entry['columns'].items():
+            size = int(np.prod(shape))
+            column = self.__column(shard, name)
+            tensors[name] = torch.from_numpy(
+                column[offset: offset + size].reshape(shape))
+
+        instance_data = {}
+        common_data = {}
+        for name, tensor in tensors.items():
+            if name.startswith('instance.'):
+                instance_data[name[len('instance.'):]] = tensor
+            elif name.startswith('common.'):
+                common_data[name[len('common.'):]] = tensor
+
+        return (
+            tensors['labels'], instance_data, common_data,
+            batch_entry['data_size'], tensors['mask'], batch_entry['meta']
+        )
+
+    def batches(self, shuffle=False, seed=None, start=0):
+        """Iterate the cached batches.
+
+        Args:
+          shuffle: Whether to shuffle the batches across all shards.
+          seed: The seed of the shuffling, a seeded order can be resumed.
+          start: Skip this number of batches in the order.
+
+        Returns:
+
+        """
+        order = [(shard, batch_idx)
+                 for shard, index in enumerate(self.indices)
+                 for batch_idx in range(len(index['batches']))]
+
+        if shuffle:
+            if seed is None:
+                random.shuffle(order)
+            else:
+                random.Random(seed).shuffle(order)
+
+        for shard, batch_idx in order[start:]:
+            yield self.load_batch(shard, batch_idx)
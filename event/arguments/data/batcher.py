@@ -1,12 +1,74 @@
 from collections import defaultdict
+from itertools import chain
+import logging
 import pdb
+import random
 from typing import Dict
 
 import numpy as np
+import torch
 
 from event.arguments.data.cloze_instance import ClozeInstances
-from event.util import batch_combine, to_torch
-from event.io.io_utils import pad_2d_list, pad_last_axis
+
+logger = logging.getLogger(__name__)
+
+
+def _positions(lengths):
+    """Compute the position of each item inside its own group, for groups of
+    the given lengths, e.g. [2, 3] gives [0, 1, 0, 1, 2].
+
+    Args:
+      lengths: Array of the group lengths.
+
+    Returns:
+
+    """
+    starts = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - np.repeat(starts, lengths)
+
+
+def fill_padded(docs, dim, length, dtype, width=None):
+    """Allocate a zero padded array for the batch and fill it with the
+    document data in one shot.
+
+    Args:
+      docs: A list of documents, each document is a list of values (dim=1),
+        or a list of lists of values (dim=2).
+      dim: The dimension of each document.
+      length: The padded length of the documents.
+      dtype: The numpy data type.
+      width: The padded length of the inner lists when dim=2, default to
+        the longest one.
+
+    Returns:
+      An array of shape batch x length (x width).
+
+    """
+    doc_lens = np.fromiter((len(d) for d in docs), np.int64, len(docs))
+    doc_idx = np.repeat(np.arange(len(docs)), doc_lens)
+    pos_idx = _positions(doc_lens)
+
+    if dim == 1:
+        data = np.zeros([len(docs), length], dtype=dtype)
+        values = np.fromiter(chain.from_iterable(docs), dtype,
+                             int(doc_lens.sum()))
+        data[doc_idx, pos_idx] = values
+    elif dim == 2:
+        rows = list(chain.from_iterable(docs))
+        row_lens = np.fromiter((len(r) for r in rows), np.int64, len(rows))
+
+        if width is None:
+            width = int(row_lens.max()) if len(rows) > 0 else 0
+
+        data = np.zeros([len(docs), length, width], dtype=dtype)
+        values = np.fromiter(chain.from_iterable(rows), dtype,
+                             int(row_lens.sum()))
+        data[np.repeat(doc_idx, row_lens), np.repeat(pos_idx, row_lens),
+             _positions(row_lens)] = values
+    else:
+        raise ValueError("Dimension unsupported %d" % dim)
+
+    return data
 
 
 class ClozeBatcher:
@@ -56,14 +118,44 @@ class ClozeBatcher:
     # Keep track of the slot keys, since the size here might be different.
     slot_keys = {'slot', 'slot_value', 'context_slot', 'context_slot_value'}
 
-    def __init__(self, batch_size):
+    budget_units = ('instance_context', 'instance_slot')
+
+    def __init__(self, batch_size, bucket_size=0, cell_budget=0,
+                 budget_unit='instance_context', group_key=None):
+        """
+
+        Args:
+          batch_size: Number of documents per batch.
+          bucket_size: If positive, buffer this number of batches, and group
+            the documents with similar sizes into the same batch to reduce
+            padding.
+          cell_budget: If positive, a batch is emitted before the number of
+            padded cells exceeds this budget.
+          budget_unit: The cells counted in the budget, either the
+            instance x context cells or the instance x slot cells.
+          group_key: If provided, a function of (instances, common_data),
+            only the consecutive documents with the same key are put in the
+            same batch.
+        """
+        if budget_unit not in self.budget_units:
+            raise ValueError(f"Unknown budget unit {budget_unit}")
+
         self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.cell_budget = cell_budget
+        self.budget_unit = budget_unit
+        self.group_key = group_key
 
         self.b_common_data = defaultdict(list)
         self.b_instance_data = defaultdict(list)
         self.b_meta_data = defaultdict(list)
         self.b_labels = []
 
+        # The (instance size, context size) of each document in the batch.
+        self.b_doc_sizes = []
+        # The group key of the documents in the batch.
+        self.b_group = None
+
         self.max_context_size = 0
         self.max_instance_size = 0
         self.doc_count = 0
@@ -71,11 +163,27 @@ class ClozeBatcher:
         self.max_num_slots = 0
         self.max_c_num_slots = 0
 
+        # Documents waiting to be bucketed.
+        self.pending_docs = []
+        # Used to shuffle the batches in a bucket, the fixed seed keeps the
+        # batch order reproducible.
+        self.bucket_rng = random.Random(0)
+
+        # Padding statistics, only the real cells of the instance x context
+        # matrix are useful for context voting.
+        self.padding_efficiency = 1.0
+        self.total_real_cells = 0
+        self.total_padded_cells = 0
+
     def clear(self):
         self.b_common_data.clear()
         self.b_instance_data.clear()
         self.b_labels.clear()
-        self.b_meta_data.clear()
+        self.b_doc_sizes.clear()
+
+        # The meta data is returned with the batch, so create a new one
+        # instead of clearing it.
+        self.b_meta_data = defaultdict(list)
 
         self.max_context_size = 0
         self.max_instance_size = 0
@@ -83,24 +191,95 @@ class ClozeBatcher:
         self.max_num_slots = 0
         self.max_c_num_slots = 0
 
-    def __var_pad(self, key, data, pad_length):
-        pad_last_axis(data, self.data_dim[key], pad_length)
+    @staticmethod
+    def doc_sizes(common_data: Dict):
+        """The instance size and context size of a document.
 
-    def __batch_pad(self, key, data, pad_size):
-        dim = self.data_dim[key]
+        Args:
+          common_data: The common data of the document.
 
-        if dim == 2:
-            return [pad_2d_list(v, pad_size) for v in data]
-        elif dim == 1:
-            return pad_2d_list(data, pad_size, axis=1)
-        else:
-            raise ValueError("Dimension unsupported %d" % dim)
+        Returns:
+
+        """
+        context_size = 0
+        for key, value in common_data.items():
+            if key.startswith('context_'):
+                context_size = len(value)
+                break
+        return len(common_data['event_indices']), context_size
 
     def get_batch(self, instances: ClozeInstances, common_data: Dict,
                   meta: Dict = None):
+        self.doc_count += 1
+
+        if self.bucket_size > 0:
+            self.pending_docs.append((instances, common_data, meta))
+            if len(self.pending_docs) >= self.batch_size * self.bucket_size:
+                yield from self.__emit_bucket()
+        else:
+            yield from self.__add_doc(instances, common_data, meta)
+
+    def __emit_bucket(self, last=False):
+        # Sort the documents by size, then consecutive documents have similar
+        # context and instance sizes.
+        self.pending_docs.sort(key=lambda d: self.doc_sizes(d[1]))
+
+        groups = [self.pending_docs[i: i + self.batch_size] for i in
+                  range(0, len(self.pending_docs), self.batch_size)]
+
+        if not last and len(groups[-1]) < self.batch_size:
+            # Keep the incomplete group for the next bucket.
+            self.pending_docs = groups.pop()
+        else:
+            self.pending_docs = []
+
+        # Avoid feeding the batches strictly ordered by size.
+        self.bucket_rng.shuffle(groups)
+
+        for group in groups:
+            for doc in group:
+                yield from self.__add_doc(*doc)
+            yield from self.__flush_batch()
+
+    def __padded_cells(self, common_data: Dict, instance_data: Dict):
+        """Number of padded cells of the current batch if a new document is
+        added.
+
+        Args:
+          common_data: The common data of the new document.
+          instance_data: The instance data of the new document.
+
+        Returns:
+
+        """
+        num_instances, context_size = self.doc_sizes(common_data)
+        num_instances = max(num_instances, self.max_instance_size)
+
+        if self.budget_unit == 'instance_context':
+            width = max(context_size, self.max_context_size)
+        else:
+            # In fix slot mode, each instance has one fixed size event.
+            width = max([len(l) for l in instance_data.get('slot', [])] +
+                        [self.max_num_slots, 1])
+
+        return (len(self.b_labels) + 1) * num_instances * width
+
+    def __add_doc(self, instances: ClozeInstances, common_data: Dict,
+                  meta: Dict = None):
         instance_data = instances.data
         labels = instances.label
 
+        if self.cell_budget > 0 and len(self.b_labels) > 0:
+            if self.__padded_cells(common_data,
+                                   instance_data) > self.cell_budget:
+                yield from self.__flush_batch()
+
+        if self.group_key is not None:
+            group = self.group_key(instances, common_data)
+            if len(self.b_labels) > 0 and not group == self.b_group:
+                yield from self.__flush_batch()
+            self.b_group = group
+
         for key, value in common_data.items():
             self.b_common_data[key].append(value)
 
@@ -127,69 +306,79 @@ class ClozeBatcher:
                 self.b_meta_data[key].append(value)
 
         self.b_labels.append(labels)
-        self.doc_count += 1
+        self.b_doc_sizes.append(self.doc_sizes(common_data))
 
         # Each document is computed as a whole.
-        if self.doc_count % self.batch_size == 0:
+        if len(self.b_labels) == self.batch_size:
+            yield from self.__flush_batch()
+
+    def __flush_batch(self):
+        if len(self.b_labels) > 0:
             yield self.create_batch()
             self.clear()
 
     def flush(self):
-        if len(self.b_common_data) > 0:
-            yield self.create_batch()
-            self.clear()
+        if len(self.pending_docs) > 0:
+            yield from self.__emit_bucket(last=True)
+
+        yield from self.__flush_batch()
+
+        if self.total_padded_cells > 0:
+            logger.info(
+                f"Overall padding efficiency of the instance x context cells "
+                f"is {self.total_real_cells / self.total_padded_cells:.4f}.")
+
+    def __padding_stats(self, data_size):
+        real_cells = sum(i * c for i, c in self.b_doc_sizes)
+        padded_cells = data_size * self.max_instance_size * \
+                       self.max_context_size
+
+        self.total_real_cells += real_cells
+        self.total_padded_cells += padded_cells
+        self.padding_efficiency = (
+            real_cells / padded_cells if padded_cells > 0 else 1.0)
+
+        logger.debug(f"Batch of {data_size} documents, padding efficiency "
+                     f"{self.padding_efficiency:.4f} ({real_cells} real cells "
+                     f"in {padded_cells} padded cells).")
 
     def create_batch(self):
         instance_data = {}
         common_data = {}
         # The actual instance lengths of in each batch.
         data_len = []
-        sizes = {}
+        data_size = len(self.b_labels)
+
+        assert data_size > 0
 
         for key, value in self.b_common_data.items():
-            if key in self.slot_keys:
-                [self.__var_pad(key, v, self.max_c_num_slots) for v in value]
+            width = self.max_c_num_slots if key in self.slot_keys else None
 
             if key.startswith('context_'):
-                padded = self.__batch_pad(key, value, self.max_context_size)
-                vectorized = to_torch(padded, self.data_types[key])
-                common_data[key] = batch_combine(vectorized)
+                pad_size = self.max_context_size
             else:
-                padded = self.__batch_pad(key, value, self.max_instance_size)
-                vectorized = to_torch(padded, self.data_types[key])
-                common_data[key] = batch_combine(vectorized)
+                pad_size = self.max_instance_size
 
-            sizes[key] = len(padded)
+            common_data[key] = torch.from_numpy(fill_padded(
+                value, self.data_dim[key], pad_size, self.data_types[key],
+                width))
 
         for key, value in self.b_instance_data.items():
-            if key in self.slot_keys:
-                [self.__var_pad(key, v, self.max_num_slots) for v in value]
-
+            width = self.max_num_slots if key in self.slot_keys else None
             data_len = [len(v) for v in value]
-            padded = self.__batch_pad(key, value, self.max_instance_size)
-
-            vectorized = to_torch(padded, self.data_types[key])
-            instance_data[key] = batch_combine(vectorized)
 
-            sizes[key] = len(padded)
+            instance_data[key] = torch.from_numpy(fill_padded(
+                value, self.data_dim[key], self.max_instance_size,
+                self.data_types[key], width))
 
-        labels = to_torch(
-            pad_2d_list(self.b_labels, self.max_instance_size, axis=1),
-            np.float32)
-
-        data_size = -1
-        for key, s in sizes.items():
-            if data_size < 0:
-                data_size = s
-            else:
-                assert s == data_size
-        assert data_size > 0
+        labels = torch.from_numpy(fill_padded(
+            self.b_labels, 1, self.max_instance_size, np.float32))
 
-        mask = np.zeros([data_size, self.max_instance_size], dtype=int)
-        for i, l in enumerate(data_len):
-            mask[i][0: l] = 1
+        mask = np.arange(self.max_instance_size)[None, :] < np.asarray(
+            data_len)[:, None]
+        ins_mask = torch.from_numpy(mask.astype(np.float32))
 
-        ins_mask = to_torch(mask, np.float32)
+        self.__padding_stats(data_size)
 
         return (
             labels, instance_data, common_data, data_size, ins_mask,
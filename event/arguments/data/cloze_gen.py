@@ -1,46 +1,240 @@
 import random
 import math
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+from itertools import accumulate
 from operator import itemgetter
 
 from event.arguments.prepare.event_vocab import EmbbedingVocab, TypedEventVocab
 
 
 class PredicateSampler:
-    def __init__(self, sample_pred_threshold=10e-5):
+    def __init__(self, sample_pred_threshold=10e-5, rng=None):
         self.sample_pred_threshold = sample_pred_threshold
+        self.rng = random.Random() if rng is None else rng
 
     def subsample_pred(self, pred_tf, freq):
         if freq > self.sample_pred_threshold:
             if pred_tf > self.sample_pred_threshold:
                 rate = self.sample_pred_threshold / freq
-                if random.random() < 1 - rate - math.sqrt(rate):
+                if self.rng.random() < 1 - rate - math.sqrt(rate):
                     return False
         return True
 
 
+class CrossSampleIndex:
+    """Index the arguments of a document to sample cross cloze arguments.
+
+    The arguments that share the start or the end with the origin span are
+    excluded from sampling. Instead of filtering the whole pool for each
+    draw, the arguments are grouped by their starts and ends, so that only
+    the few excluded positions are visited, and the k-th remaining argument
+    is located by skipping over them. The index is built once per document.
+
+    Args:
+      arg_pool: The list of argument mentions in the document.
+      weights: Sampling weights of the arguments, only used by the weighted
+        sampling. By default an argument is weighted by the number of
+        mentions of its entity, i.e. salient entities are sampled more often.
+    """
+
+    def __init__(self, arg_pool, weights=None):
+        self.arg_pool = arg_pool
+
+        self.by_start = defaultdict(list)
+        self.by_end = defaultdict(list)
+        self.by_sent = defaultdict(list)
+
+        for index, arg_info in enumerate(arg_pool):
+            self.by_start[arg_info['arg_start']].append(index)
+            self.by_end[arg_info['arg_end']].append(index)
+            self.by_sent[arg_info['sentence_id']].append(index)
+
+        if weights is None:
+            entity_count = Counter(a['entity_id'] for a in arg_pool)
+            weights = [entity_count[a['entity_id']] for a in arg_pool]
+        self.weights = weights
+        self.cum_weights = list(accumulate(weights))
+
+    def __len__(self):
+        return len(self.arg_pool)
+
+    def excluded(self, origin_start, origin_end):
+        """The sorted positions of the arguments excluded by the origin span.
+
+        Args:
+          origin_start: Start of the origin span.
+          origin_end: End of the origin span.
+
+        Returns:
+
+        """
+        starts = self.by_start.get(origin_start, ())
+        ends = self.by_end.get(origin_end, ())
+        if not ends:
+            return starts
+        if not starts:
+            return ends
+        return sorted(set(starts).union(ends))
+
+    def sample(self, rng, origin_start, origin_end):
+        """Sample uniformly among the remaining arguments. The random draw is
+        the same as choosing from the filtered list of remaining arguments.
+
+        Args:
+          rng: The random generator.
+          origin_start: Start of the origin span.
+          origin_end: End of the origin span.
+
+        Returns:
+          The sampled argument, or None if nothing left to sample from.
+
+        """
+        excluded = self.excluded(origin_start, origin_end)
+        num_remain = len(self.arg_pool) - len(excluded)
+        if num_remain <= 0:
+            return None
+
+        # Find the position of the k-th remaining argument.
+        position = rng.randrange(num_remain)
+        for index in excluded:
+            if index > position:
+                break
+            position += 1
+        return self.arg_pool[position]
+
+    def sample_weighted(self, rng, origin_start, origin_end):
+        """Sample among the remaining arguments proportional to their weights.
+
+        Args:
+          rng: The random generator.
+          origin_start: Start of the origin span.
+          origin_end: End of the origin span.
+
+        Returns:
+          The sampled argument, or None if nothing left to sample from.
+
+        """
+        excluded = self.excluded(origin_start, origin_end)
+        excluded_weight = sum(self.weights[i] for i in excluded)
+        total_weight = self.cum_weights[-1] if self.cum_weights else 0
+        remain_weight = total_weight - excluded_weight
+        if len(excluded) == len(self.arg_pool) or remain_weight <= 0:
+            return None
+
+        # Draw from the remaining weight, then skip over the weights of the
+        # excluded arguments.
+        target = rng.random() * remain_weight
+        for index in excluded:
+            if self.cum_weights[index] - self.weights[index] > target:
+                break
+            target += self.weights[index]
+
+        position = min(bisect_right(self.cum_weights, target),
+                       len(self.arg_pool) - 1)
+        return self.arg_pool[position]
+
+    def sample_nearby(self, rng, origin_start, origin_end, origin_sent,
+                      window):
+        """Sample a hard negative: an argument from the sentences close to
+        the origin, which is more confusable than a random one. Fall back to
+        the uniform sampling if there is no such argument.
+
+        Args:
+          rng: The random generator.
+          origin_start: Start of the origin span.
+          origin_end: End of the origin span.
+          origin_sent: The sentence id of the origin argument.
+          window: Max sentence distance of the nearby arguments.
+
+        Returns:
+          The sampled argument, or None if nothing left to sample from.
+
+        """
+        nearby = []
+        for sent in range(origin_sent - window, origin_sent + window + 1):
+            for index in self.by_sent.get(sent, ()):
+                arg_info = self.arg_pool[index]
+                if not (arg_info['arg_start'] == origin_start
+                        or arg_info['arg_end'] == origin_end):
+                    nearby.append(arg_info)
+
+        if nearby:
+            return rng.choice(nearby)
+        return self.sample(rng, origin_start, origin_end)
+
+
 class ClozeSampler:
     def __init__(self, sample_pred_threshold=10e-5, seed=None):
         self.sample_pred_threshold = sample_pred_threshold
         self.provided_seed = seed
-        random.seed(self.provided_seed)
+        # Each sampler owns its random stream, so samplers in different reader
+        # workers do not interfere with each other.
+        self.rng = random.Random(self.provided_seed)
+        self.stream_seed = self.provided_seed
 
-    def reset(self):
-        random.seed(self.provided_seed)
+    def reset(self, epoch=None):
+        """Restart the random stream.
 
-    def sample_cross(self, arg_pool, origin_start, origin_end):
-        remaining = []
-        for arg_info in arg_pool:
-            if not (arg_info['arg_start'] == origin_start
-                    or arg_info['arg_end'] == origin_end):
-                remaining.append(arg_info)
-
-        if len(remaining) > 0:
-            return random.choice(remaining)
+        Args:
+          epoch: If given, the stream is seeded for this epoch, so each epoch
+            samples differently but reproducibly.
+
+        Returns:
+
+        """
+        if self.provided_seed is None or epoch is None:
+            self.stream_seed = self.provided_seed
         else:
-            return None
+            self.stream_seed = f'{self.provided_seed}_epoch{epoch}'
+        self.rng.seed(self.stream_seed)
+
+    def spawn(self, worker_id):
+        """Create a sampler for a reader worker. The seed of the new sampler is
+        derived from the current stream seed, so the worker stream is
+        reproducible.
+
+        Args:
+          worker_id: The index of the worker.
+
+        Returns:
+
+        """
+        if self.stream_seed is None:
+            seed = None
+        else:
+            seed = f'{self.stream_seed}_{worker_id}'
+        return ClozeSampler(self.sample_pred_threshold, seed)
+
+    def sample_cross(self, arg_pool, origin_start, origin_end):
+        """Sample an argument uniformly from the pool, excluding the ones
+        sharing the start or the end with the origin span.
+
+        Args:
+          arg_pool: A CrossSampleIndex, or a list of arguments which is then
+            indexed on the fly.
+          origin_start: Start of the origin span.
+          origin_end: End of the origin span.
+
+        Returns:
+          The sampled argument, or None if nothing left to sample from.
+
+        """
+        if not isinstance(arg_pool, CrossSampleIndex):
+            arg_pool = CrossSampleIndex(arg_pool)
+        return arg_pool.sample(self.rng, origin_start, origin_end)
+
+    def sample_cross_weighted(self, arg_index, origin_start, origin_end):
+        return arg_index.sample_weighted(self.rng, origin_start, origin_end)
+
+    def sample_cross_nearby(self, arg_index, origin_start, origin_end,
+                            origin_sent, window):
+        return arg_index.sample_nearby(self.rng, origin_start, origin_end,
+                                       origin_sent, window)
 
     def sample_list(self, l):
-        return random.choice(l)
+        return self.rng.choice(l)
 
     def sample_ignore_item(self, data, ignored_item):
         """Sample one item in the list, but ignore a provided one. If the list
@@ -57,7 +251,7 @@ class ClozeSampler:
             return None
 
         while True:
-            sampled_item = random.choice(data)
+            sampled_item = self.rng.choice(data)
             if not sampled_item == ignored_item:
                 break
         return sampled_item
@@ -66,71 +260,135 @@ class ClozeSampler:
         if freq > self.sample_pred_threshold:
             if pred_tf > self.sample_pred_threshold:
                 rate = self.sample_pred_threshold / freq
-                if random.random() < 1 - rate - math.sqrt(rate):
+                if self.rng.random() < 1 - rate - math.sqrt(rate):
                     return False
         return True
 
 
-class CandidateBuilder:
-    def __init__(self, event_emb_vocab: EmbbedingVocab,
-                 typed_event_vocab: TypedEventVocab):
-        self.event_emb_vocab = event_emb_vocab
-        self.typed_event_vocab = typed_event_vocab
+class CandidateArg(Mapping):
+    """A candidate argument, the base slot with the fields of another mention
+    swapped in. Instead of copying the base slot, this is a view that reads
+    the swapped fields from the mention and the rest from the base slot, so
+    creating a candidate only allocates this small object.
 
-    def build_candidate(self, base_slot, swap_slot, replace_fe=False):
-        if len(swap_slot) == 0:
-            # Make the update slot to be empty.
-            updated_slot_info = {}
-        else:
-            # Make a copy of the slot.
-            updated_slot_info = dict((k, v) for k, v in base_slot.items())
+    The view is read only, it contains the same keys as a copy of the base
+    slot updated with the mention fields.
+
+    Args:
+      base: The base slot.
+      mention: The mention swapped into the slot.
+      arg_role: The index of the new argument representation.
+      replace_fe: Whether the frame element is also taken from the mention.
+    """
+    __slots__ = ('base', 'mention', 'arg_role', 'replace_fe')
+
+    # These fields are taken from the swapped mention.
+    swapped_fields = frozenset((
+        'entity_id', 'represent', 'text', 'arg_phrase', 'source', 'arg_start',
+        'arg_end', 'sentence_id', 'ner',
+    ))
+
+    # These attributes are harmless but confusing.
+    dropped_fields = frozenset(('resolvable', 'implicit'))
+
+    def __init__(self, base, mention, arg_role, replace_fe=False):
+        self.base = base
+        self.mention = mention
+        self.arg_role = arg_role
+        self.replace_fe = replace_fe
+
+    def __getitem__(self, key):
+        if key == 'arg_role':
+            return self.arg_role
+
+        if key in self.swapped_fields or (key == 'fe' and self.replace_fe):
+            if key == 'source':
+                return self.mention.get('source', 'automatic')
+            return self.mention[key]
+
+        if key in self.dropped_fields:
+            raise KeyError(key)
 
-            # Replace with the new information.
-            updated_slot_info['entity_id'] = swap_slot['entity_id']
-            updated_slot_info['represent'] = swap_slot['represent']
-            updated_slot_info['text'] = swap_slot['text']
-            updated_slot_info['arg_phrase'] = swap_slot['arg_phrase']
-            updated_slot_info['source'] = swap_slot.get('source', 'automatic')
-            updated_slot_info['arg_start'] = swap_slot['arg_start']
-            updated_slot_info['arg_end'] = swap_slot['arg_end']
+        return self.base[key]
 
-            if 'ner' in swap_slot:
-                updated_slot_info['ner'] = swap_slot['ner']
-            elif 'ner' in updated_slot_info:
-                updated_slot_info.pop('ner')
+    def __iter__(self):
+        for key in self.base:
+            if not (key == 'arg_role' or key in self.swapped_fields
+                    or key in self.dropped_fields
+                    or (key == 'fe' and self.replace_fe)):
+                yield key
 
-            # These attributes are harmless but confusing.
+        for key in self.swapped_fields:
+            if key == 'source' or key in self.mention:
+                yield key
 
-            updated_slot_info.pop('resolvable', None)
-            updated_slot_info.pop('implicit', None)
+        yield 'arg_role'
 
-            # Note: with the sentence Id we can have a better idea of where the
-            # argument is from, but we cannot use it to extract features.
-            updated_slot_info['sentence_id'] = swap_slot['sentence_id']
+        # Like the swapped fields, the key is only there if the mention has
+        # it, __getitem__ raises a KeyError otherwise.
+        if self.replace_fe and 'fe' in self.mention:
+            yield 'fe'
 
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self)})'
+
+
+class CandidateBuilder:
+    def __init__(self, event_emb_vocab: EmbbedingVocab,
+                 typed_event_vocab: TypedEventVocab):
+        self.event_emb_vocab = event_emb_vocab
+        self.typed_event_vocab = typed_event_vocab
+
+        # The argument role index of the (dep, represent) pairs, the same
+        # pairs are looked up repeatedly for the candidates.
+        self.__arg_roles = {}
+
+    def get_arg_role(self, dep, represent):
+        try:
+            return self.__arg_roles[(dep, represent)]
+        except KeyError:
             # TODO: now using the full dependency label here.
-            new_arg_rep = self.typed_event_vocab.get_arg_rep(
-                base_slot['dep'], swap_slot['represent']
-            )
+            new_arg_rep = self.typed_event_vocab.get_arg_rep(dep, represent)
 
-            updated_slot_info['arg_role'] = self.event_emb_vocab.get_index(
+            arg_role = self.event_emb_vocab.get_index(
                 new_arg_rep, self.typed_event_vocab.get_unk_arg_rep()
             )
+            self.__arg_roles[(dep, represent)] = arg_role
+            return arg_role
 
-            if replace_fe:
-                updated_slot_info['fe'] = swap_slot['fe']
-
-        return updated_slot_info
+    def build_candidate(self, base_slot, swap_slot, replace_fe=False):
+        if len(swap_slot) == 0:
+            # Make the update slot to be empty.
+            return {}
+
+        # Note: with the sentence Id we can have a better idea of where the
+        # argument is from, but we cannot use it to extract features.
+        return CandidateArg(
+            base_slot, swap_slot,
+            self.get_arg_role(base_slot['dep'], swap_slot['represent']),
+            replace_fe
+        )
 
 
 class ClozeGenerator:
     def __init__(self,
                  candidate_builder: CandidateBuilder,
-                 fix_slot_mode: bool = True):
+                 fix_slot_mode: bool = True,
+                 cross_sample_method: str = 'uniform',
+                 cross_sample_window: int = 1):
         self.sampler = ClozeSampler()
         self.fix_slot_mode = fix_slot_mode
         self.builder = candidate_builder
 
+        if cross_sample_method not in ('uniform', 'weighted', 'nearby'):
+            raise ValueError(
+                f"Unknown cross sample method {cross_sample_method}")
+        self.cross_sample_method = cross_sample_method
+        self.cross_sample_window = cross_sample_window
+
     def set_sampler(self, sampler: ClozeSampler):
         self.sampler = sampler
 
@@ -139,7 +397,8 @@ class ClozeGenerator:
 
         Args:
           arg_list: List of origin event arguments.
-          doc_args: List of arguments (partial info) in this doc.
+          doc_args: The CrossSampleIndex (or the list) of arguments (partial
+            info) in this doc.
           target_arg_idx: The index for the slot to be replaced
 
         Returns:
@@ -147,9 +406,23 @@ class ClozeGenerator:
         """
         _, target_arg = arg_list[target_arg_idx]
 
-        sample_res = self.sampler.sample_cross(
-            doc_args, target_arg['arg_start'], target_arg['arg_end']
-        )
+        if self.cross_sample_method == 'uniform':
+            sample_res = self.sampler.sample_cross(
+                doc_args, target_arg['arg_start'], target_arg['arg_end']
+            )
+        else:
+            if not isinstance(doc_args, CrossSampleIndex):
+                doc_args = CrossSampleIndex(doc_args)
+
+            if self.cross_sample_method == 'weighted':
+                sample_res = self.sampler.sample_cross_weighted(
+                    doc_args, target_arg['arg_start'], target_arg['arg_end']
+                )
+            else:
+                sample_res = self.sampler.sample_cross_nearby(
+                    doc_args, target_arg['arg_start'], target_arg['arg_end'],
+                    target_arg['sentence_id'], self.cross_sample_window
+                )
 
         if sample_res is None:
             return None
@@ -225,6 +498,66 @@ class ClozeGenerator:
         return neg_instance, origin_slot_info['entity_id'], swap_slot
 
 
+class SentenceMentionIndex:
+    """Index the document mentions by their sentence ids, so that the
+    mentions within a distance to a sentence are taken directly in the
+    distance order, without visiting the far ones.
+
+    The candidate lists are also cached here, they are shared by the test
+    stubs of the same predicate sentence in this document.
+
+    Args:
+      doc_args: The list of all document argument mentions.
+    """
+
+    def __init__(self, doc_args):
+        self.doc_args = doc_args
+
+        # The (position, mention) in each sentence, in the document order.
+        self.by_sent = defaultdict(list)
+        for position, mention in enumerate(doc_args):
+            self.by_sent[mention['sentence_id']].append((position, mention))
+
+        self.min_sent = min(self.by_sent, default=0)
+        self.max_sent = max(self.by_sent, default=0)
+
+        # Map from the (sentence, distance cap, test stub) to the candidates.
+        self.candidate_cache = {}
+
+    def mentions_within(self, pred_sent, distance_cap):
+        """The mentions within the distance to the sentence, ordered by the
+        distance, and by the document order for the same distance.
+
+        Args:
+          pred_sent: The sentence where the predicate is in.
+          distance_cap: The max distance to find argument.
+
+        Returns:
+          List of tuple (distance, mention).
+
+        """
+        max_dist = max(pred_sent - self.min_sent, self.max_sent - pred_sent)
+        max_dist = min(max_dist, distance_cap)
+
+        mentions = [(0, m) for _, m in self.by_sent.get(pred_sent, ())]
+
+        dist = 1
+        while dist <= max_dist:
+            before = self.by_sent.get(pred_sent - dist, [])
+            after = self.by_sent.get(pred_sent + dist, [])
+
+            if before and after:
+                # Restore the document order of the two sentences.
+                mentions.extend(
+                    (dist, m) for _, m in sorted(before + after,
+                                                 key=itemgetter(0)))
+            else:
+                mentions.extend((dist, m) for _, m in before or after)
+            dist += 1
+
+        return mentions
+
+
 class TestClozeMaker:
     def __init__(self, candidate_builder: CandidateBuilder):
         self.builder = candidate_builder
@@ -235,33 +568,41 @@ class TestClozeMaker:
 
         Args:
           test_stub: The test stub to be filled.
-          doc_args: The list of all document argument mentions.
+          doc_args: The SentenceMentionIndex (or the list) of all document
+            argument mentions.
           pred_sent: The sentence where the predicate is in.
           distance_cap: The max distance to find argument.
 
         Returns:
+          List of tuple (candidate argument, entity id), sorted by the
+          distance to the predicate sentence. The list is a copy, the caller
+          can modify it.
 
         """
-        # List of Tuple (dist, argument candidates).
-        dist_arg_list = []
+        if not isinstance(doc_args, SentenceMentionIndex):
+            doc_args = SentenceMentionIndex(doc_args)
+
+        # The candidates only depend on these, so repeated stubs of the same
+        # sentence share the list.
+        cache_key = (pred_sent, distance_cap, tuple(sorted(test_stub.items())))
+
+        try:
+            return list(doc_args.candidate_cache[cache_key])
+        except KeyError:
+            pass
 
         # NOTE: we have removed the check of "original span". It means that if
         # the system can predict the original phrase then it will be fine.
         # This might be OK since the model should not have access to the
         # original span during real test time. At self-test stage, predicting
         # the original span means the system is learning well.
-        for doc_mention in doc_args:
+        sorted_arg_list = []
+        for _, doc_mention in doc_args.mentions_within(pred_sent,
+                                                       distance_cap):
             # This is the target argument replaced by another entity mention.
             update_arg = self.builder.build_candidate(
                 test_stub, doc_mention, True)
+            sorted_arg_list.append((update_arg, doc_mention['entity_id']))
 
-            dist_arg_list.append((
-                abs(pred_sent - doc_mention['sentence_id']),
-                (update_arg, doc_mention['entity_id']),
-            ))
-
-        # Sort the rank list based on the distance to the target evm.
-        dist_arg_list.sort(key=itemgetter(0))
-        sorted_arg_list = [arg for d, arg in dist_arg_list if d <= distance_cap]
-
-        return sorted_arg_list
+        doc_args.candidate_cache[cache_key] = sorted_arg_list
+        return list(sorted_arg_list)
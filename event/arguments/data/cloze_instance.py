@@ -1,9 +1,111 @@
+import numpy as np
+
 from event.arguments.data.event_structure import EventStruct
 from event.arguments.implicit_arg_params import ArgModelPara
 
 ghost_entity_id = -1
 
 
+class EntityDistances:
+    """The sentence ids of the explicit mentions of each entity, stored as
+    consecutive segments of one NumPy array, so that the distance signatures
+    of all entities to a sentence are computed in a few vectorized calls.
+
+    Args:
+      entity_positions: A map from the entity id to its explicit mentions,
+        {span: sentence_id}.
+    """
+
+    # Now use a large distance to represent Infinity.
+    # Infinity: if the entity cannot be found again, or it is not an entity.
+    # A number is arbitrarily decided since most document is shorter than
+    # this.
+    inf = 100
+
+    def __init__(self, entity_positions):
+        # The row of each entity in the signature table, the entities without
+        # explicit mentions are mapped to the last row (infinity).
+        self.rows = {}
+
+        sent_ids = []
+        starts = []
+        for eid, positions in entity_positions.items():
+            if len(positions) == 0:
+                continue
+            self.rows[eid] = len(starts)
+            starts.append(len(sent_ids))
+            sent_ids.extend(positions.values())
+
+        self.sent_ids = np.array(sent_ids, dtype=np.int64)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.counts = np.diff(np.append(self.starts, len(sent_ids)))
+
+        # The instances of the same event share the sentence, so keep the
+        # table of the last sentence.
+        self.__table_sent = None
+        self.__table = None
+        self.__table_rows = None
+
+    def signature_table(self, sent_id):
+        """Compute the (max, min, mean) distances of every entity to the
+        sentence.
+
+        Args:
+          sent_id: The sentence to compute the distance to.
+
+        Returns:
+          An array of shape (num_entities + 1, 3), the last row is for the
+          entities without explicit mentions.
+
+        """
+        if sent_id == self.__table_sent:
+            return self.__table
+
+        table = np.full((len(self.starts) + 1, 3), self.inf, dtype=np.float64)
+
+        if len(self.starts) > 0:
+            # We make a ceiling for the distance calculation.
+            dist = np.minimum(np.abs(self.sent_ids - sent_id), self.inf - 1)
+            table[:-1, 0] = np.maximum.reduceat(dist, self.starts)
+            table[:-1, 1] = np.minimum.reduceat(dist, self.starts)
+            table[:-1, 2] = np.add.reduceat(dist, self.starts) / self.counts
+
+        self.__table_sent = sent_id
+        self.__table = table
+        # Looking up a Python list is much cheaper for single instances.
+        self.__table_rows = table.tolist()
+        return table
+
+    def signatures(self, filler_eids, sent_id):
+        """The distance signatures of the fillers to the sentence.
+
+        Args:
+          filler_eids: The entity ids of the fillers.
+          sent_id: The sentence to compute the distance to.
+
+        Returns:
+          An array of shape (len(filler_eids), 3).
+
+        """
+        rows = [self.rows.get(eid, -1) for eid in filler_eids]
+        return self.signature_table(sent_id)[rows]
+
+    def signature(self, filler_eid, sent_id):
+        """The distance signature of a filler to the sentence.
+
+        Args:
+          filler_eid: The entity id of the filler.
+          sent_id: The sentence to compute the distance to.
+
+        Returns:
+          A new list of the (max, min, mean) distances.
+
+        """
+        self.signature_table(sent_id)
+        # Copy the row, the cached rows are shared by the instances.
+        return list(self.__table_rows[self.rows.get(filler_eid, -1)])
+
+
 class ClozeInstances:
     def __init__(self,
                  para: ArgModelPara,
@@ -35,8 +137,44 @@ class ClozeInstances:
     def label(self):
         return self.__labels
 
-    def assemble_instance(self, features_by_eid, entity_positions, sent_id,
+    def assemble_instance(self, features_by_eid,
+                          entity_distances: EntityDistances, sent_id,
                           event_repr, filler_eid, label=1):
+        if filler_eid == ghost_entity_id:
+            distance = None
+        else:
+            distance = entity_distances.signature(filler_eid, sent_id)
+
+        self.__add_instance(features_by_eid, event_repr, filler_eid, distance,
+                            label)
+
+    def assemble_instances(self, features_by_eid,
+                           entity_distances: EntityDistances, sent_id,
+                           event_reprs, filler_eids, labels):
+        """Assemble the instances of all the candidates of a cloze, the
+        distances of the candidates are computed in one call.
+
+        Args:
+          features_by_eid: The extracted features of the entities.
+          entity_distances: The mention positions of the entities.
+          sent_id: The sentence of the predicate.
+          event_reprs: The event representations of the candidates.
+          filler_eids: The entity ids of the candidates.
+          labels: The labels of the candidates.
+
+        Returns:
+
+        """
+        # The distances are added as lists, like the single instances.
+        distances = entity_distances.signatures(filler_eids, sent_id).tolist()
+
+        for event_repr, filler_eid, distance, label in zip(
+                event_reprs, filler_eids, distances, labels):
+            self.__add_instance(features_by_eid, event_repr, filler_eid,
+                                distance, label)
+
+    def __add_instance(self, features_by_eid, event_repr, filler_eid,
+                       distance, label):
         if filler_eid == ghost_entity_id:
             self.add_ghost_instance()
         else:
@@ -45,11 +183,7 @@ class ClozeInstances:
                 self.__data[key].append(value)
 
             self.__data['features'].append(features_by_eid[filler_eid])
-
-            self.__data['distances'].append(
-                self.get_target_distance_signature(entity_positions, sent_id,
-                                                   filler_eid)
-            )
+            self.__data['distances'].append(distance)
 
         self.__labels.append(label)
 
@@ -77,55 +211,3 @@ class ClozeInstances:
             [0.0] * self.num_distance_features)
 
         self.__labels.append(label)
-
-    def get_target_distance_signature(self, entity_positions, sent_id,
-                                      filler_eid):
-        """Compute the distance signature of the instance's other mentions to
-        the sentence.
-
-        Args:
-          entity_positions: sent_id:
-          filler_eid:
-          sent_id:
-
-        Returns:
-
-        """
-        distances = []
-
-        # Now use a large distance to represent Infinity.
-        # Infinity: if the entity cannot be found again, or it is not an entity.
-        # A number is arbitrarily decided since most document is shorter than
-        # this.
-        inf = 100
-
-        max_dist = -1
-        min_dist = inf
-        total_dist = 0.0
-        total_pair = 0.0
-
-        # print(f'current event is {current_evm_id}')
-
-        for mention_span, sid in entity_positions[filler_eid].items():
-            distance = abs(sid - sent_id)
-
-            # We make a ceiling for the distance calculation.
-            distance = min(distance, inf - 1)
-
-            if distance < min_dist:
-                min_dist = distance
-            if distance > max_dist:
-                max_dist = distance
-
-            total_dist += distance
-            total_pair += 1.0
-
-        if total_pair > 0:
-            distances.append((max_dist, min_dist, total_dist / total_pair))
-        else:
-            # This argument is not seen elsewhere, it should be a special
-            # distance label.
-            distances.append((inf, inf, inf))
-
-        # Flatten the (argument x type) distances into a flat list.
-        return [d for l in distances for d in l]
@@ -1,19 +1,22 @@
 import copy
-import json
 import logging
-import pdb
 from pprint import pprint
 from collections import Counter
 from collections import defaultdict
-from typing import Dict
 
 from event.arguments.NIFDetector import NullArgDetector
 from event.arguments.data.batcher import ClozeBatcher
 from event.arguments.data.cloze_gen import ClozeGenerator, PredicateSampler, \
-    TestClozeMaker, CandidateBuilder
-from event.arguments.data.cloze_instance import ClozeInstances
+    TestClozeMaker, CandidateBuilder, ClozeSampler, CrossSampleIndex, \
+    SentenceMentionIndex
+from event.arguments.data.cloze_instance import ClozeInstances, \
+    EntityDistances
+from event.arguments.data.doc_cache import DocCache
 from event.arguments.data.event_structure import EventStruct
 from event.arguments.data.frame_data import FrameSlots
+from event.arguments.data.hashed_doc import HashedDoc, ArgMention
+from event.arguments.data.hashed_io import HashedDocDecoder
+from event.arguments.data.reader_workers import ParallelClozeMaker
 from event.arguments.implicit_arg_params import ArgModelPara
 from event.arguments.implicit_arg_resources import ImplicitArgResources
 
@@ -23,6 +26,22 @@ ghost_entity_text = '__ghost_component__'
 ghost_entity_id = -1
 
 
+class PreparedDoc:
+    """The part of a training document independent of the sampling, see
+    HashedClozeReader.prepare_training_doc."""
+
+    def __init__(self, features_by_eid, entity_distances, t_doc_args,
+                 eid_count, event_subset, context_data):
+        self.features_by_eid = features_by_eid
+        self.entity_distances = entity_distances
+        self.t_doc_args = t_doc_args
+        # Index the arguments once to sample the cross clozes.
+        self.cross_index = CrossSampleIndex(t_doc_args)
+        self.eid_count = eid_count
+        self.event_subset = event_subset
+        self.context_data = context_data
+
+
 class HashedClozeReader:
     """Reading the hashed dataset into cloze tasks.
 
@@ -73,27 +92,68 @@ class HashedClozeReader:
             resources.typed_event_vocab
         )
         self.cloze_gen = ClozeGenerator(self.candidate_builder,
-                                        self.fix_slot_mode)
+                                        self.fix_slot_mode,
+                                        para.cross_sample_method,
+                                        para.cross_sample_window)
 
         # These default values need to be set at test time.
         self.factor_role = None
         self.use_gold_mention = False
         self.use_auto_mention = True
 
-    def read_train_batch(self, data_in, sampler):
-        logger.info("Reading data as training batch.")
+        self.decode_doc = HashedDocDecoder(para.json_decoder)
 
+        # Cache the sampling independent part of the training documents.
+        self.doc_cache = None
+        if para.doc_cache_size > 0:
+            self.doc_cache = DocCache(para.doc_cache_size)
+
+    def set_sampler(self, sampler: ClozeSampler):
         self.cloze_gen.set_sampler(sampler)
+        # Predicates are sub-sampled with the same random stream.
+        self.predicate_sampler.rng = sampler.rng
+
+    def read_train_batch(self, data_in, sampler, next_doc_id=None):
+        """Generate the training batches from the data lines.
+
+        Args:
+          data_in: The hashed data lines.
+          sampler: The cloze sampler.
+          next_doc_id: Called when the output of each line reaches the
+            batcher, returns the id of the line, which is in the input order
+            unless the reader workers are not ordered. The ids of the lines
+            in a batch are then listed in the `doc_ids` of its metadata,
+            the lines without output are listed with the next line.
 
-        train_batcher = ClozeBatcher(self.para.batch_size)
+        Returns:
+
+        """
+        logger.info("Reading data as training batch.")
 
-        for line in data_in:
-            parsed_output = self.create_training_data(line)
+        train_batcher = ClozeBatcher(
+            self.para.batch_size, self.para.batch_bucket_size,
+            self.para.batch_cell_budget, self.para.batch_budget_unit)
+
+        if self.para.num_reader_workers > 1:
+            cloze_maker = ParallelClozeMaker(
+                self, self.para.num_reader_workers, self.para.ordered_reading)
+            parsed_docs = cloze_maker.training_data(data_in, sampler)
+        else:
+            self.set_sampler(sampler)
+            parsed_docs = (self.create_training_data(l) for l in data_in)
+
+        skipped_ids = []
+        for parsed_output in parsed_docs:
+            meta = None
+            if next_doc_id is not None:
+                skipped_ids.append(next_doc_id())
+                meta = {'doc_ids': skipped_ids}
 
             if parsed_output is None:
                 continue
 
-            yield from train_batcher.get_batch(*parsed_output)
+            skipped_ids = []
+            yield from train_batcher.get_batch(*parsed_output, meta)
 
         if train_batcher.doc_count == 0:
             raise ValueError("Batcher did not receive any data in the process.")
@@ -102,18 +162,15 @@ class HashedClozeReader:
         yield from train_batcher.flush()
 
     @staticmethod
-    def collect_features(doc_info):
-        # Collect all features.
-        features_by_eid = {}
-        for eid, content in doc_info['entities'].items():
-            features_by_eid[int(eid)] = content['features']
-        return features_by_eid
+    def collect_features(doc_info: HashedDoc):
+        # The features are collected when decoding the document.
+        return doc_info.features_by_eid
 
     @staticmethod
     def answer_from_arg(arg):
         return {
-            'span': (arg['arg_start'], arg['arg_end']),
-            'text': arg['arg_phrase']
+            'span': (arg.arg_start, arg.arg_end),
+            'text': arg.arg_phrase
         }
 
     def get_test_cases(self, event, possible_slots):
@@ -122,7 +179,7 @@ class HashedClozeReader:
         # First organize the roles by the gold role name, this will take every
         #   arg in the data, even in the case of duplication.
         arg_by_slot = defaultdict(list)
-        for dep_slot, args_per_dep in event['args'].items():
+        for dep_slot, args_per_dep in event.args.items():
             for arg in args_per_dep:
                 if self.gold_role_field in arg:
                     gold_role = arg[self.gold_role_field]
@@ -163,8 +220,8 @@ class HashedClozeReader:
             args = arg_by_slot[slot]
 
             for arg in args:
-                if arg['implicit'] and arg['source'] == 'gold' \
-                        and not arg['incorporated']:
+                if arg.implicit and arg.source == 'gold' \
+                        and not arg.incorporated:
                     # Case 2
                     answers.append(self.answer_from_arg(arg))
 
@@ -178,16 +235,13 @@ class HashedClozeReader:
             else:
                 for arg in args:
                     # We do not need to fill the explicit arguments.
-                    if arg['source'] == 'gold' and not arg['implicit']:
+                    if arg.source == 'gold' and not arg.implicit:
                         break
                 else:
                     # There are no explict and implicit either, but we need the
                     # system to guess whether it wanted to fill such case.
                     test_cases.append(copy.deepcopy(no_fill_case))
 
-
-        pdb.set_trace()
-
         return test_cases
 
     def get_args_by_role(self, event_args, ignore_implicit):
@@ -206,10 +260,10 @@ class HashedClozeReader:
             for a in l_arg:
                 use_this_arg = True
 
-                if ignore_implicit and a.get('implicit', False):
+                if ignore_implicit and a.implicit:
                     use_this_arg = False
 
-                source = a.get('source', 'automatic')
+                source = a.source
                 if source == 'gold':
                     if not self.use_gold_mention:
                         use_this_arg = False
@@ -245,44 +299,35 @@ class HashedClozeReader:
         arg_mentions = {}
 
         # For each event.
-        for evm_index, event in enumerate(doc_info['events']):
+        for evm_index, event in enumerate(doc_info.events):
             # For each dep based slot (subj, obj, prep), there might be a list
             # of arguments.
-            for dep_slot, l_arg in event['args'].items():
+            for dep_slot, l_arg in event.args.items():
                 # We iterate over all the arguments to collect distance data and
                 # candidate document arguments.
                 for arg in l_arg:
-                    if len(arg) == 0:
-                        continue
-
-                    eid = arg['entity_id']
-
-                    # TODO: event_index, dep not copied.
-                    doc_arg_info = self.copy_mention_info(arg)
-
-                    if self.gold_role_field in arg:
-                        doc_arg_info[self.gold_role_field] = arg[
-                            self.gold_role_field
-                        ]
+                    eid = arg.entity_id
 
-                    arg_span = (arg['arg_start'], arg['arg_end'])
-                    arg_mentions[arg_span] = doc_arg_info
+                    # The mention records are read only, so they are used
+                    # as the candidate mentions directly without copying.
+                    arg_span = (arg.arg_start, arg.arg_end)
+                    arg_mentions[arg_span] = arg
 
-                    if not arg.get('implicit', False):
+                    if not arg.implicit:
                         # We do not calculate distance features for implicit
                         # arguments.
-                        explicit_entity_positions[eid][arg_span] = arg[
-                            'sentence_id']
+                        explicit_entity_positions[eid][
+                            arg_span] = arg.sentence_id
 
         return explicit_entity_positions, arg_mentions
 
-    def get_one_test_doc(self, doc_info: Dict,
+    def get_one_test_doc(self, doc_info: HashedDoc,
                          nid_detector: NullArgDetector,
                          test_cloze_maker: TestClozeMaker):
         """Parse and get one test document.
 
         Args:
-          doc_info: The JSON data of one document.
+          doc_info: The decoded data of one document.
           nid_detector: NID detector to detect which slot to fill.
           test_cloze_maker: TestClozeMaker
 
@@ -293,22 +338,25 @@ class HashedClozeReader:
         features_by_eid = self.collect_features(doc_info)
         explicit_entity_positions, arg_mentions = self.populate_positions(
             doc_info)
+        entity_distances = EntityDistances(explicit_entity_positions)
 
         # The context used for resolving.
         all_event_reps = [
             self.event_struct.event_repr(
-                e['predicate'], e['frame'],
-                self.get_args_by_role(e['args'], True)) for
-            e in doc_info['events']
+                e.predicate, e.frame,
+                self.get_args_by_role(e.args, True)) for
+            e in doc_info.events
         ]
 
-        # This creates a list of candidate mentions for this document.
-        doc_mentions = [v for v in arg_mentions.values()]
+        # This creates a list of candidate mentions for this document, indexed
+        # by the sentences.
+        doc_mentions = SentenceMentionIndex(
+            [v for v in arg_mentions.values()])
 
-        for evm_index, event in enumerate(doc_info['events']):
-            pred_sent = event['sentence_id']
-            pred_id = event['predicate']
-            event_args = event['args']
+        for evm_index, event in enumerate(doc_info.events):
+            pred_sent = event.sentence_id
+            pred_id = event.predicate
+            event_args = event.args
             arg_by_slot = self.get_args_by_role(event_args, False)
             available_slots = self.frame_slots.get_predicate_slots(event)
             test_cases = self.get_test_cases(event, available_slots)
@@ -338,6 +386,10 @@ class HashedClozeReader:
                     cloze_event_indices = []
                     cloze_slot_indicator = []
 
+                    cand_event_reprs = []
+                    cand_filler_eids = []
+                    cand_labels = []
+
                     # To avoid have too many test cases that blow up memory.
                     limit = min(self.test_limit, len(test_rank_list))
 
@@ -363,15 +415,12 @@ class HashedClozeReader:
                         label = 1 if cand_arg_span in answer_spans else 0
 
                         # Create the event instance representation.
-                        instances.assemble_instance(
-                            features_by_eid,
-                            explicit_entity_positions,
-                            pred_sent,
+                        cand_event_reprs.append(
                             self.event_struct.event_repr(
-                                pred_id, event['frame'], candidate_args
-                            ),
-                            filler_eid, label=label
-                        )
+                                pred_id, event.frame, candidate_args
+                            ))
+                        cand_filler_eids.append(filler_eid)
+                        cand_labels.append(label)
 
                         cloze_event_indices.append(evm_index)
                         cloze_slot_indicator.append(target_slot)
@@ -393,9 +442,15 @@ class HashedClozeReader:
                                 ),
                                 'source': cand_arg['source']})
 
+                    # The distances of all candidates are computed at once.
+                    instances.assemble_instances(
+                        features_by_eid, entity_distances, pred_sent,
+                        cand_event_reprs, cand_filler_eids, cand_labels
+                    )
+
                     metadata['instance'] = {
-                        'docid': doc_info['docid'],
-                        'predicate': event['predicate_text'],
+                        'docid': doc_info.docid,
+                        'predicate': event.predicate_text,
                         'predicate_id': pred_id,
                         'target_slot_id': target_slot,
                         'answers': answers,
@@ -432,16 +487,41 @@ class HashedClozeReader:
         Returns:
 
         """
-        # At test time we can use a single doc batch.
-        batcher = ClozeBatcher(1)
+        # Each test case is a document in the batch, the metadata of the cases
+        # are listed in the batch in the same order.
+        batcher = ClozeBatcher(self.para.test_batch_size,
+                               group_key=self.test_batch_key)
         test_cloze_maker = TestClozeMaker(self.candidate_builder)
 
         for line in test_in:
-            doc_info = json.loads(line)
+            doc_info = self.decode_doc(line)
             for test_data in self.get_one_test_doc(doc_info, nid_detector,
                                                    test_cloze_maker):
                 yield from batcher.get_batch(*test_data)
 
+        yield from batcher.flush()
+
+    @staticmethod
+    def test_batch_key(instances: ClozeInstances, common_data):
+        """The padded shapes of a test case other than the number of
+        instances. The context events (and the slots) are not masked in the
+        model, so only the cases sharing these are batched together, the
+        padded instances are simply dropped from the scores.
+
+        Args:
+          instances: The instances of the test case.
+          common_data: The common data of the test case.
+
+        Returns:
+
+        """
+        _, context_size = ClozeBatcher.doc_sizes(common_data)
+        context_slots = max(
+            (len(l) for l in common_data.get('context_slot', [])), default=0)
+        instance_slots = max(
+            (len(l) for l in instances.data.get('slot', [])), default=0)
+        return context_size, context_slots, instance_slots
+
     def get_slot_index(self, slot):
         if self.fix_slot_mode:
             return self.event_struct.fix_slot_names.index(slot)
@@ -451,31 +531,18 @@ class HashedClozeReader:
             return self.event_emb_vocab.get_index(
                 slot, self.typed_event_vocab.unk_fe)
 
-    @staticmethod
-    def copy_mention_info(arg: Dict):
-        # Some minimum information for creating cloze tests.
-        # - Entity id is the target to predict.
-        # - Arg phrase, represent or text are different ways to
-        #   represent the argument mention.
-        # - source distinguish gold and automatic predicted args.
-        # - sentence_id is related to the distance based feature.
-        # - arg start and end are used to identify this unique
-        #   mention.
-        copy_keys = ('entity_id', 'arg_phrase', 'represent', 'text',
-                     'sentence_id', 'arg_start', 'arg_end')
-        mention_info = dict([(k, arg[k]) for k in copy_keys])
-        mention_info['source'] = arg.get('source', 'automatic')
-
-        if 'fe' in arg:
-            mention_info['fe'] = arg['fe']
-
-        if 'ner' in arg:
-            mention_info['ner'] = arg['ner']
-
-        return mention_info
+    def prepare_training_doc(self, data_line):
+        """Compute the parts of the training data that do not depend on the
+        sampling, which can be cached and reused across epochs.
 
-    def create_training_data(self, data_line):
-        doc_info = json.loads(data_line)
+        Args:
+          data_line: A hashed document, either a JSON line or a binary record.
+
+        Returns:
+          A PreparedDoc, or None if the document cannot create clozes.
+
+        """
+        doc_info = self.decode_doc(data_line)
         features_by_eid = self.collect_features(doc_info)
 
         # Map from: entity id (eid) ->
@@ -492,7 +559,7 @@ class HashedClozeReader:
         eid_count = Counter()
         event_subset = []
 
-        for evm_index, event in enumerate(doc_info['events']):
+        for evm_index, event in enumerate(doc_info.events):
             if evm_index == self.para.max_events:
                 # Skip the rest if the document is too long.
                 break
@@ -500,20 +567,20 @@ class HashedClozeReader:
             # Only a subset in a long document will be used for generating.
             event_subset.append(event)
 
-            for slot, arg in self.get_args_by_role(event['args'],
+            for slot, arg in self.get_args_by_role(event.args,
                                                    False).items():
-                if len(arg) > 0:
-                    # Argument for n-th event, at slot position 'slot'.
-                    eid = arg['entity_id']
-                    eid_count[eid] += 1
+                # Argument for n-th event, at slot position 'slot'.
+                eid = arg.entity_id
+                eid_count[eid] += 1
 
-                    span = (arg['arg_start'], arg['arg_end'])
+                span = (arg.arg_start, arg.arg_end)
 
-                    if not arg.get('implicit', False):
-                        explicit_entity_positions[eid][span] = arg[
-                            'sentence_id']
+                if not arg.implicit:
+                    explicit_entity_positions[eid][span] = arg.sentence_id
 
-                    arg_mentions[span] = self.copy_mention_info(arg)
+                # The mention records are shared, not copied, the candidates
+                # created from them are views (see CandidateArg).
+                arg_mentions[span] = arg
 
         # A set that contains some minimum argument entity mention information,
         # used for sampling a slot to create clozes.
@@ -521,28 +588,51 @@ class HashedClozeReader:
 
         all_event_reps = [
             self.event_struct.event_repr(
-                e['predicate'], e['frame'],
-                self.get_args_by_role(e['args'], True)) for
+                e.predicate, e.frame,
+                self.get_args_by_role(e.args, True)) for
             e in event_subset
         ]
 
-        # TODO: in this mixed mode, these indices are not correct.
-        common_data = {
-            'event_indices': [],
-            'slot_indicators': [],
-        }
-
+        context_data = {}
         for event_rep in all_event_reps:
             for key, value in event_rep.items():
                 try:
-                    common_data['context_' + key].append(value)
+                    context_data['context_' + key].append(value)
                 except KeyError:
-                    common_data['context_' + key] = [value]
+                    context_data['context_' + key] = [value]
 
         if len(t_doc_args) <= 1:
             # There no enough arguments to sample from.
             return None
 
+        return PreparedDoc(features_by_eid,
+                           EntityDistances(explicit_entity_positions),
+                           t_doc_args, eid_count, event_subset, context_data)
+
+    def create_training_data(self, data_line):
+        if self.doc_cache is None:
+            prepared = self.prepare_training_doc(data_line)
+        else:
+            prepared = self.doc_cache.get(data_line,
+                                          self.prepare_training_doc)
+
+        if prepared is None:
+            return None
+
+        features_by_eid = prepared.features_by_eid
+        entity_distances = prepared.entity_distances
+        cross_index = prepared.cross_index
+        eid_count = prepared.eid_count
+        event_subset = prepared.event_subset
+
+        # TODO: in this mixed mode, these indices are not correct.
+        common_data = {
+            'event_indices': [],
+            'slot_indicators': [],
+        }
+        # The context data is shared with the cache, but only read later.
+        common_data.update(prepared.context_data)
+
         # We current sample the predicate based on unigram distribution.
         # The other learning strategy is to select one difficult cross instance,
         # the options are:
@@ -559,7 +649,7 @@ class HashedClozeReader:
                 # Limit the number of instances generated.
                 break
 
-            pred = event['predicate']
+            pred = event.predicate
             if pred == self.unk_predicate_idx:
                 continue
 
@@ -570,20 +660,17 @@ class HashedClozeReader:
                 # Too frequent word will be down-sampled.
                 continue
 
-            current_sent = event['sentence_id']
+            current_sent = event.sentence_id
 
-            arg_list = list(self.get_args_by_role(event['args'], False).items())
+            arg_list = list(self.get_args_by_role(event.args, False).items())
 
             for arg_index, (slot, arg) in enumerate(arg_list):
-                # Empty args are not interesting.
-                if len(arg) == 0:
-                    continue
-
-                # Not training unk args.
-                if arg['represent'] == self.typed_event_vocab.unk_arg_word:
+                # Not training unk args, the empty args are already dropped
+                # when decoding.
+                if arg.represent == self.typed_event_vocab.unk_arg_word:
                     continue
 
-                correct_id = arg['entity_id']
+                correct_id = arg.entity_id
 
                 is_singleton = False
                 if eid_count[correct_id] <= 1:
@@ -596,7 +683,7 @@ class HashedClozeReader:
 
                 # TODO: arg_index is used at cloze, do we need it?
                 cross_sample = self.cloze_gen.cross_cloze(
-                    arg_list, t_doc_args, arg_index)
+                    arg_list, cross_index, arg_index)
                 inside_sample = self.cloze_gen.inside_cloze(
                     arg_list, arg_index)
 
@@ -610,10 +697,9 @@ class HashedClozeReader:
                         instances.add_ghost_instance(1)
                     else:
                         instances.assemble_instance(
-                            features_by_eid, explicit_entity_positions,
-                            current_sent,
+                            features_by_eid, entity_distances, current_sent,
                             self.event_struct.event_repr(
-                                pred, event['frame'], arg_list),
+                                pred, event.frame, arg_list),
                             correct_id, 1)
 
                         common_data['event_indices'].append(evm_index)
@@ -623,10 +709,10 @@ class HashedClozeReader:
                     cross_args, cross_filler_id = cross_sample
 
                     instances.assemble_instance(
-                        features_by_eid, explicit_entity_positions,
+                        features_by_eid, entity_distances,
                         current_sent,
                         self.event_struct.event_repr(
-                            pred, event['frame'], cross_args
+                            pred, event.frame, cross_args
                         ),
                         cross_filler_id, 0)
 
@@ -638,10 +724,10 @@ class HashedClozeReader:
                     inside_args, inside_filler_id, swap_slot = inside_sample
 
                     instances.assemble_instance(
-                        features_by_eid, explicit_entity_positions,
+                        features_by_eid, entity_distances,
                         current_sent,
                         self.event_struct.event_repr(
-                            pred, event['frame'], inside_args),
+                            pred, event.frame, inside_args),
                         inside_filler_id, 0
                     )
 
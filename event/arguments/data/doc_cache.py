@@ -0,0 +1,71 @@
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DocCache:
+    """Cache the results computed from the documents, keyed by the digest of
+    the raw document (a JSON line or a binary record), so that the cache is
+    valid regardless of the reading order.
+
+    The documents are read in cycles (epochs), for which evicting the old
+    entries gives no hit at all if the data is larger than the cache. So when
+    the cache is full, the new documents are simply not cached.
+
+    Args:
+      capacity: Max number of documents to cache.
+      log_freq: Log the hit rate every this number of lookups.
+    """
+
+    def __init__(self, capacity, log_freq=100000):
+        self.capacity = capacity
+        self.log_freq = log_freq
+        self.__entries = {}
+
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    @staticmethod
+    def digest(doc_data):
+        if isinstance(doc_data, str):
+            doc_data = doc_data.encode('utf-8')
+        return hashlib.blake2b(doc_data, digest_size=16).digest()
+
+    def get(self, doc_data, compute):
+        """Get the result of a document, compute and cache it if not cached.
+
+        Args:
+          doc_data: The raw document.
+          compute: The function to compute the result from the raw document.
+
+        Returns:
+
+        """
+        key = self.digest(doc_data)
+
+        self.num_lookups += 1
+        if self.num_lookups % self.log_freq == 0:
+            self.log_stats()
+
+        try:
+            result = self.__entries[key]
+            self.num_hits += 1
+            return result
+        except KeyError:
+            result = compute(doc_data)
+            if len(self.__entries) < self.capacity:
+                self.__entries[key] = result
+            return result
+
+    def log_stats(self):
+        if self.num_lookups == 0:
+            return
+
+        logger.info(
+            f"Document cache: {len(self.__entries)} cached, hit "
+            f"{self.num_hits} of {self.num_lookups} lookups "
+            f"({100.0 * self.num_hits / self.num_lookups:.1f}%).")
+
+    def __len__(self):
+        return len(self.__entries)
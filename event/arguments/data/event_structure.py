@@ -1,5 +1,4 @@
 import logging
-import pdb
 from pprint import pprint
 
 from event.arguments.prepare.event_vocab import EmbbedingVocab, TypedEventVocab
@@ -108,7 +107,8 @@ class EventStruct:
 
         if any([c < 0 for c in event_components]):
             logging.error("Non positive component found in event.")
-            pdb.set_trace()
+            raise ValueError(
+                f"Negative event component ids: {event_components}")
 
         return {
             'event_component': event_components,
@@ -0,0 +1,95 @@
+"""Typed records for the hashed documents produced by hash_cloze_data.
+
+The records are dictionaries with the schema fields exposed as attributes
+(e.g. arg.entity_id), the attribute reads are C level item lookups, and the
+records are built by a single dictionary copy. Since they are still
+dictionaries, code handling both the records and plain dictionaries (e.g. the
+test stubs) works with either. The records are treated as read only, so they
+are shared instead of copied, e.g. the candidate slots are views over them
+(see cloze_gen.CandidateArg).
+
+See hashed_io for decoding the records from the data files.
+"""
+from operator import itemgetter
+
+
+def field(name):
+    """A required field, a missing one raises KeyError."""
+    return property(itemgetter(name))
+
+
+def optional_field(name, default):
+    """An optional field, the default is returned if it is missing."""
+    return property(lambda self: self.get(name, default))
+
+
+class ArgMention(dict):
+    """An argument mention of an event, see hash_cloze_data.hash_arg.
+
+    The gold role fields and the NER type are only presented in some data, use
+    `in` to check them.
+    """
+    __slots__ = ()
+
+    entity_id = field('entity_id')
+    arg_start = field('arg_start')
+    arg_end = field('arg_end')
+    sentence_id = field('sentence_id')
+    text = field('text')
+    arg_phrase = field('arg_phrase')
+    represent = field('represent')
+    dep = field('dep')
+    fe = field('fe')
+    arg_role = field('arg_role')
+    arg_role_text = field('arg_role_text')
+    context = field('context')
+
+    source = optional_field('source', 'automatic')
+    implicit = optional_field('implicit', False)
+    incorporated = optional_field('incorporated', False)
+    succeeding = optional_field('succeeding', False)
+
+
+class HashedEvent(dict):
+    """An event in a hashed document, the args are a mapping from the
+    dependency slots to lists of ArgMention."""
+    __slots__ = ()
+
+    predicate = field('predicate')
+    predicate_text = field('predicate_text')
+    frame = field('frame')
+    context = field('context')
+    sentence_id = field('sentence_id')
+    args = field('args')
+
+    @classmethod
+    def from_dict(cls, data):
+        event = cls(data)
+        # Empty arguments are not written by the hasher, they are dropped
+        # here in case of older data.
+        event['args'] = dict(
+            (slot, [ArgMention(a) for a in l_arg if a])
+            for slot, l_arg in data['args'].items()
+        )
+        return event
+
+
+class HashedDoc(dict):
+    """A hashed document. The entity features are also indexed by the integer
+    entity ids in features_by_eid."""
+    __slots__ = ()
+
+    docid = field('docid')
+    events = field('events')
+    entities = field('entities')
+    features_by_eid = field('features_by_eid')
+
+    @classmethod
+    def from_dict(cls, data):
+        doc = cls(data)
+        doc['events'] = [HashedEvent.from_dict(e) for e in data['events']]
+        doc['features_by_eid'] = dict(
+            (int(eid), content['features'])
+            for eid, content in data['entities'].items()
+        )
+        return doc
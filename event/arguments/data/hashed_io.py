@@ -0,0 +1,644 @@
+"""Reading and writing the hashed documents, either as JSON lines or in a
+compact binary format.
+
+The binary data file starts with MAGIC, followed by the documents, each
+stored as a length-prefixed record. The file can be gzipped (by the .gz
+suffix). A record packs the integer fields of the events, slots, arguments
+and entities into typed arrays, the text fields are indices to a string
+table of the document. The binary record decodes into the same HashedDoc as
+the JSON line.
+
+Fields out of the schema, or values of unexpected types, are kept in a small
+JSON blob of the record, so the conversion is lossless, except that the
+entity features are always decoded as floats.
+
+Example (converting the existing JSON data):
+    python -m event.arguments.data.hashed_io --BinaryConverter.json_path=<in>
+        --BinaryConverter.output_path=<out>
+"""
+import json
+import logging
+import os
+import struct
+import sys
+
+import numpy as np
+from smart_open import open as smart_open
+from traitlets import Unicode
+from traitlets.config import Configurable
+
+from event import util
+
+from event.arguments.data.hashed_doc import ArgMention, HashedEvent, \
+    HashedDoc
+from event.arguments.data.line_index import shard_files, indexed_lines
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HASHDOC1'
+
+# Marks a missing integer field, or a missing string (as the index).
+_MISSING = np.iinfo(np.int32).min
+
+_EVENT_INT_FIELDS = ('predicate', 'frame', 'sentence_id')
+_EVENT_STR_FIELDS = ('predicate_text',)
+
+_ARG_INT_FIELDS = ('entity_id', 'arg_start', 'arg_end', 'sentence_id', 'fe',
+                   'arg_role', 'gold_role_id')
+_ARG_STR_FIELDS = ('text', 'arg_phrase', 'represent', 'arg_role_text', 'dep',
+                   'source', 'ner', 'gold_role')
+_ARG_BOOL_FIELDS = ('implicit', 'incorporated', 'succeeding', 'resolvable')
+
+_ENTITY_STR_FIELDS = ('entity_head',)
+
+_DOC_KNOWN = {'docid', 'events', 'entities'}
+_EVENT_KNOWN = set(_EVENT_INT_FIELDS + _EVENT_STR_FIELDS + ('context', 'args'))
+_ARG_KNOWN = set(
+    _ARG_INT_FIELDS + _ARG_STR_FIELDS + _ARG_BOOL_FIELDS + ('context',))
+_ENTITY_KNOWN = set(_ENTITY_STR_FIELDS + ('features',))
+
+# Number of: events, slots, args, entities, context lengths, context values,
+# feature values, strings, bytes of the strings, bytes of the extras.
+_HEADER = struct.Struct('<10i')
+_RECORD_SIZE = struct.Struct('<I')
+
+
+def get_json_loads(backend='auto'):
+    """Get the JSON decoding function.
+
+    Args:
+      backend: One of 'auto' (orjson if installed), 'orjson' or 'json'.
+
+    Returns:
+
+    """
+    if backend == 'json':
+        return json.loads
+    elif backend == 'orjson':
+        if orjson is None:
+            raise ImportError("The orjson decoder requires the orjson package.")
+        return orjson.loads
+    elif backend == 'auto':
+        return json.loads if orjson is None else orjson.loads
+    else:
+        raise ValueError(f"Unknown JSON decoder {backend}")
+
+
+class _StringTable:
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, s):
+        try:
+            return self.index[s]
+        except KeyError:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+            return self.index[s]
+
+
+def _is_int32(value):
+    return type(value) is int and _MISSING < value < 2 ** 31
+
+
+def _encode_fields(record, int_fields, str_fields, strings, extras):
+    row = []
+    for name in int_fields:
+        value = record.get(name)
+        if _is_int32(value):
+            row.append(value)
+        else:
+            row.append(_MISSING)
+            if name in record:
+                extras[name] = value
+
+    for name in str_fields:
+        value = record.get(name)
+        if type(value) is str:
+            row.append(strings.add(value))
+        else:
+            row.append(_MISSING)
+            if name in record:
+                extras[name] = value
+    return row
+
+
+def _encode_context(record, context_lengths, context_values, extras):
+    """The context is a pair of (left, right) word id lists."""
+    context = record.get('context')
+    try:
+        left, right = context
+        if all(_is_int32(v) for v in left) and all(
+                _is_int32(v) for v in right):
+            context_lengths.extend((len(left), len(right)))
+            context_values.extend(left)
+            context_values.extend(right)
+            return
+    except (TypeError, ValueError):
+        pass
+
+    context_lengths.extend((-1, -1))
+    if 'context' in record:
+        extras['context'] = context
+
+
+def encode_doc(doc):
+    """Encode a hashed document into a binary record.
+
+    Args:
+      doc: The hashed document, as produced by hash_cloze_data.hash_one_doc.
+
+    Returns:
+      The record in bytes.
+
+    """
+    strings = _StringTable()
+    extras = {}
+
+    event_rows = []
+    slot_rows = []
+    arg_rows = []
+    arg_flags = []
+    # The event contexts are stored before the argument contexts.
+    event_contexts = ([], [])
+    arg_contexts = ([], [])
+
+    # The doc id is kept in the extras since it can be of any type.
+    extras['doc'] = dict(
+        (k, v) for k, v in doc.items() if k not in _DOC_KNOWN)
+    extras['doc']['docid'] = doc['docid']
+
+    arg_index = 0
+    for event_index, event in enumerate(doc['events']):
+        event_extras = dict(
+            (k, v) for k, v in event.items() if k not in _EVENT_KNOWN)
+        event_rows.append(
+            _encode_fields(event, _EVENT_INT_FIELDS, _EVENT_STR_FIELDS,
+                           strings, event_extras) + [len(event['args'])])
+        _encode_context(event, *event_contexts, event_extras)
+        if event_extras:
+            extras.setdefault('events', {})[event_index] = event_extras
+
+        for slot, l_arg in event['args'].items():
+            slot_rows.append((strings.add(slot), len(l_arg)))
+            for arg in l_arg:
+                arg_extras = dict(
+                    (k, v) for k, v in arg.items() if k not in _ARG_KNOWN)
+                arg_rows.append(
+                    _encode_fields(arg, _ARG_INT_FIELDS, _ARG_STR_FIELDS,
+                                   strings, arg_extras))
+                flags = []
+                for name in _ARG_BOOL_FIELDS:
+                    value = arg.get(name)
+                    if type(value) is bool:
+                        flags.append(int(value))
+                    else:
+                        flags.append(-1)
+                        if name in arg:
+                            arg_extras[name] = value
+                arg_flags.append(flags)
+                _encode_context(arg, *arg_contexts, arg_extras)
+                if arg_extras:
+                    extras.setdefault('args', {})[arg_index] = arg_extras
+                arg_index += 1
+
+    entity_rows = []
+    feature_values = []
+    for eid, entity in doc['entities'].items():
+        entity_extras = dict(
+            (k, v) for k, v in entity.items() if k not in _ENTITY_KNOWN)
+        row = [strings.add(eid)] + _encode_fields(
+            entity, (), _ENTITY_STR_FIELDS, strings, entity_extras)
+        features = entity.get('features')
+        if type(features) is list and all(
+                type(v) in (int, float) for v in features):
+            row.append(len(features))
+            feature_values.extend(features)
+        else:
+            row.append(-1)
+            if 'features' in entity:
+                entity_extras['features'] = features
+        entity_rows.append(row)
+        if entity_extras:
+            extras.setdefault('entities', {})[eid] = entity_extras
+
+    context_lengths = event_contexts[0] + arg_contexts[0]
+    context_values = event_contexts[1] + arg_contexts[1]
+
+    extras_bytes = json.dumps(extras).encode('utf-8')
+    string_bytes = ''.join(strings.strings).encode('utf-8')
+
+    arrays = [
+        np.array(event_rows, dtype=np.int32),
+        np.array(slot_rows, dtype=np.int32),
+        np.array(arg_rows, dtype=np.int32),
+        np.array(arg_flags, dtype=np.int8),
+        np.array(entity_rows, dtype=np.int32),
+        np.array(context_lengths, dtype=np.int32),
+        np.array(context_values, dtype=np.int32),
+        np.array(feature_values, dtype=np.float64),
+        np.array([len(s) for s in strings.strings], dtype=np.int32),
+    ]
+
+    header = _HEADER.pack(
+        len(event_rows), len(slot_rows), len(arg_rows), len(entity_rows),
+        len(context_lengths), len(context_values), len(feature_values),
+        len(strings.strings), len(string_bytes), len(extras_bytes))
+
+    return b''.join(
+        [header] + [a.tobytes() for a in arrays] + [string_bytes,
+                                                    extras_bytes])
+
+
+def _decode_table(record_class, rows, int_fields, str_fields, strings):
+    """Decode the rows of a field table into records, column by column. The
+    tables of a document are small, so this works on lists, where the numpy
+    call overhead would dominate.
+
+    Args:
+      record_class: The record type.
+      rows: The rows of the integer fields then the string fields.
+      int_fields: Names of the integer fields.
+      str_fields: Names of the string fields.
+      strings: The string table.
+
+    Returns:
+
+    """
+    names = []
+    columns = []
+    partial = []
+    num_int_fields = len(int_fields)
+
+    for j, column in enumerate(zip(*rows)):
+        if j < num_int_fields:
+            name = int_fields[j]
+        else:
+            name = str_fields[j - num_int_fields]
+
+        num_missing = column.count(_MISSING)
+        if num_missing == len(column):
+            continue
+
+        if j >= num_int_fields:
+            column = [strings[v] if not v == _MISSING else None for v in
+                      column]
+
+        if num_missing == 0:
+            names.append(name)
+            columns.append(column)
+        else:
+            partial.append((name, column))
+
+    if columns:
+        records = [record_class(zip(names, row)) for row in zip(*columns)]
+    else:
+        records = [record_class() for _ in rows]
+
+    # The fields only presented in some records.
+    for name, column in partial:
+        for record, value in zip(records, column):
+            if not (value == _MISSING or value is None):
+                record[name] = value
+
+    return records
+
+
+def decode_doc(record):
+    """Decode a binary record into a HashedDoc.
+
+    Args:
+      record: The bytes produced by encode_doc.
+
+    Returns:
+
+    """
+    (num_events, num_slots, num_args, num_entities, num_context_lengths,
+     num_context_values, num_features, num_strings, num_string_bytes,
+     num_extras_bytes) = _HEADER.unpack_from(record)
+
+    pos = _HEADER.size
+
+    def take(dtype, count, width=None):
+        nonlocal pos
+        arr = np.frombuffer(record, dtype, count * (width or 1), pos)
+        pos += arr.nbytes
+        if width:
+            arr = arr.reshape(count, width)
+        return arr
+
+    event_table = take(np.int32, num_events,
+                       len(_EVENT_INT_FIELDS) + len(_EVENT_STR_FIELDS) + 1)
+    slot_table = take(np.int32, num_slots, 2)
+    arg_table = take(np.int32, num_args,
+                     len(_ARG_INT_FIELDS) + len(_ARG_STR_FIELDS))
+    arg_flags = take(np.int8, num_args, len(_ARG_BOOL_FIELDS))
+    entity_table = take(np.int32, num_entities, 2 + len(_ENTITY_STR_FIELDS))
+    context_lengths = take(np.int32, num_context_lengths)
+    context_values = take(np.int32, num_context_values).tolist()
+    feature_values = take(np.float64, num_features).tolist()
+    string_lengths = take(np.int32, num_strings)
+
+    # The string lengths are in characters.
+    all_strings = record[pos: pos + num_string_bytes].decode('utf-8')
+    pos += num_string_bytes
+    extras = json.loads(record[pos: pos + num_extras_bytes].decode('utf-8'))
+
+    string_ends = np.cumsum(string_lengths).tolist()
+    strings = [all_strings[end - length: end] for end, length in
+               zip(string_ends, string_lengths.tolist())]
+
+    # The (left, right) contexts of the events, then the arguments.
+    context_ends = np.cumsum(np.maximum(context_lengths, 0)).tolist()
+    context_lengths = context_lengths.tolist()
+    contexts = []
+    for i in range(0, num_context_lengths, 2):
+        if context_lengths[i] < 0:
+            contexts.append(None)
+        else:
+            middle, end = context_ends[i], context_ends[i + 1]
+            contexts.append([
+                context_values[middle - context_lengths[i]: middle],
+                context_values[middle: end]])
+
+    event_rows = event_table.tolist()
+    events = _decode_table(HashedEvent, [row[:-1] for row in event_rows],
+                           _EVENT_INT_FIELDS, _EVENT_STR_FIELDS, strings)
+    args = _decode_table(ArgMention, arg_table.tolist(), _ARG_INT_FIELDS,
+                         _ARG_STR_FIELDS, strings)
+
+    for name, flags in zip(_ARG_BOOL_FIELDS, zip(*arg_flags.tolist())):
+        if -1 in flags:
+            for arg, flag in zip(args, flags):
+                if flag >= 0:
+                    arg[name] = bool(flag)
+        else:
+            for arg, flag in zip(args, flags):
+                arg[name] = flag == 1
+
+    for arg, context in zip(args, contexts[num_events:]):
+        if context is not None:
+            arg['context'] = context
+
+    for arg_index, arg_extra in extras.get('args', {}).items():
+        args[int(arg_index)].update(arg_extra)
+
+    slot_rows = slot_table.tolist()
+    slot_index = 0
+    arg_index = 0
+    for event, context, event_row in zip(events, contexts, event_rows):
+        num_event_slots = event_row[-1]
+        if context is not None:
+            event['context'] = context
+
+        event_args = {}
+        for slot, size in slot_rows[
+                          slot_index: slot_index + num_event_slots]:
+            # Same as the JSON records, drop the empty arguments.
+            event_args[strings[slot]] = [
+                a for a in args[arg_index: arg_index + size] if a]
+            arg_index += size
+        slot_index += num_event_slots
+        event['args'] = event_args
+
+    for event_index, event_extra in extras.get('events', {}).items():
+        events[int(event_index)].update(event_extra)
+
+    entity_extras = extras.get('entities', {})
+    entities = {}
+    feature_pos = 0
+    for eid_index, entity_head, num_entity_features in entity_table.tolist():
+        eid = strings[eid_index]
+        entity = {}
+        if not entity_head == _MISSING:
+            entity['entity_head'] = strings[entity_head]
+        if num_entity_features >= 0:
+            entity['features'] = feature_values[
+                                 feature_pos: feature_pos + num_entity_features]
+            feature_pos += num_entity_features
+        entity.update(entity_extras.get(eid, ()))
+        entities[eid] = entity
+
+    doc = HashedDoc(extras['doc'])
+    doc['events'] = events
+    doc['entities'] = entities
+    doc['features_by_eid'] = dict(
+        (int(eid), content['features']) for eid, content in entities.items())
+    return doc
+
+
+def _open(path, mode):
+    # Gzipped if the path ends with .gz.
+    return smart_open(path, mode)
+
+
+def _open_read(path):
+    """Open a data file for binary reading, whether it is gzipped is told by
+    the content, since some shards named .gz are not actually compressed.
+    """
+    with smart_open(path, 'rb', compression='disable') as fin:
+        is_gzip = fin.read(2) == b'\x1f\x8b'
+    return smart_open(path, 'rb',
+                      compression='.gz' if is_gzip else 'disable')
+
+
+class BinaryDocWriter:
+    """Write the hashed documents into a binary data file.
+
+    Args:
+      path: The output path, gzipped if it ends with .gz.
+    """
+
+    def __init__(self, path):
+        self.out = _open(path, 'wb')
+        self.out.write(MAGIC)
+
+    def write(self, doc):
+        record = encode_doc(doc)
+        self.out.write(_RECORD_SIZE.pack(len(record)))
+        self.out.write(record)
+
+    def close(self):
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def is_binary_data(data_path):
+    """Whether the data (a file or a directory of shards) is in the binary
+    format, judged by the first file.
+
+    Args:
+      data_path: A file or a directory of shards.
+
+    Returns:
+
+    """
+    files = shard_files(data_path)
+    if not files:
+        return False
+    with _open_read(files[0]) as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+def read_records(path):
+    """Read the binary records of the documents in a binary data file, the
+    records are decoded by the reader (see HashedDocDecoder).
+
+    Args:
+      path: The binary data file.
+
+    Returns:
+
+    """
+    with _open_read(path) as fin:
+        if not fin.read(len(MAGIC)) == MAGIC:
+            raise ValueError(f"{path} is not a binary hashed data file.")
+
+        while True:
+            size_bytes = fin.read(_RECORD_SIZE.size)
+            if not size_bytes:
+                break
+            size, = _RECORD_SIZE.unpack(size_bytes)
+            record = fin.read(size)
+            if not len(record) == size:
+                raise ValueError(f"{path} is truncated.")
+            yield record
+
+
+def binary_data_gen(data_path, from_doc=None, until_doc=None):
+    """Same as data_gen, but read the binary records from the shards. The
+    document numbers work like the line numbers of the JSON data.
+
+    Args:
+      data_path: A file or a directory of shards.
+      from_doc: Skip this number of documents.
+      until_doc: Stop after this document number (1-based, inclusive).
+
+    Returns:
+
+    """
+    doc_num = 0
+    for path in shard_files(data_path):
+        logger.info("Reading from {}".format(path))
+        for record in read_records(path):
+            doc_num += 1
+            if from_doc and doc_num <= from_doc:
+                continue
+            if until_doc and doc_num > until_doc:
+                return
+            yield record
+
+
+def data_gen(data_path, from_line=None, until_line=None, use_index=False):
+    """Read the hashed documents from a file or a directory of .gz shards,
+    as JSON lines or binary records.
+
+    Args:
+      data_path: A file or a directory of shards.
+      from_line: Skip this number of documents.
+      until_line: Stop after this document number (1-based, inclusive).
+      use_index: Whether to seek with the line index (JSON lines only).
+
+    Returns:
+
+    """
+    if is_binary_data(data_path):
+        # The binary documents are read as records instead of lines.
+        yield from binary_data_gen(data_path, from_line, until_line)
+        return
+
+    if use_index:
+        # Seek to the lines directly with the line index.
+        yield from indexed_lines(data_path, from_line, until_line)
+        return
+
+    line_num = 0
+
+    if os.path.isdir(data_path):
+        last_file = None
+        for f in sorted(os.listdir(data_path)):
+            if not f.startswith('.') and f.endswith('.gz'):
+                with smart_open(os.path.join(data_path, f)) as fin:
+                    for line in fin:
+                        line_num += 1
+                        if from_line and line_num <= from_line:
+                            continue
+                        if until_line and line_num > until_line:
+                            break
+
+                        if not last_file == f:
+                            logger.info("Reading from {}".format(f))
+                            last_file = f
+                        yield line
+    else:
+        with smart_open(data_path) as fin:
+            logger.info("Reading from {}".format(data_path))
+            for line in fin:
+                line_num += 1
+                if from_line and line_num <= from_line:
+                    continue
+                if until_line and line_num > until_line:
+                    break
+                yield line
+
+
+class HashedDocDecoder:
+    """Decode the documents into HashedDoc records, the documents are either
+    JSON lines, or binary records from read_records.
+
+    Args:
+      backend: The JSON library, see get_json_loads.
+    """
+
+    def __init__(self, backend='auto'):
+        self._loads = get_json_loads(backend)
+
+    def __call__(self, doc_data):
+        if isinstance(doc_data, bytes):
+            return decode_doc(doc_data)
+        return HashedDoc.from_dict(self._loads(doc_data))
+
+
+def convert_to_binary(json_path, out_path):
+    """Convert a JSON lines hashed data file to the binary format.
+
+    Args:
+      json_path: The JSON data file, can be gzipped.
+      out_path: The binary data file.
+
+    Returns:
+
+    """
+    count = 0
+    with _open_read(json_path) as fin, BinaryDocWriter(out_path) as writer:
+        for line in fin:
+            writer.write(json.loads(line))
+            count += 1
+    logger.info(f"Converted {count} documents from {json_path} to {out_path}")
+    return count
+
+
+if __name__ == '__main__':
+    class BinaryConverter(Configurable):
+        json_path = Unicode(
+            help='The hashed data in JSON lines, can be gzipped.').tag(
+            config=True)
+        output_path = Unicode(
+            help='Output path of the binary data, gzipped if ends with .gz'
+        ).tag(config=True)
+
+
+    util.set_basic_log()
+    para = BinaryConverter(config=util.load_command_line_config(sys.argv[1:]))
+    convert_to_binary(para.json_path, para.output_path)
@@ -0,0 +1,336 @@
+"""Line index for the (gzipped) data shards, which allows seeking to a line
+without reading the lines before it.
+
+The index of a shard is stored next to it (<shard>.lidx.npz), and contains:
+    - line_starts: the uncompressed offset of each line, plus the end offset.
+    - members: the compressed and uncompressed offsets of each gzip member.
+
+To seek to a line, we jump to the gzip member containing it, and only
+decompress from the start of that member. A shard written as a single gzip
+member (e.g. by the `gzip` command) still needs to decompress from the file
+start, but not to split and decode the lines. Use `reblock` to rewrite such
+a shard into small members, the result is still a valid gzip file.
+
+Example:
+    python -m event.arguments.data.line_index --LineIndexer.data_path=<dir>
+"""
+import bisect
+import gzip
+import logging
+import os
+import sys
+import zlib
+
+import numpy as np
+from traitlets import Integer, Unicode, Bool
+from traitlets.config import Configurable
+
+from event import util
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 1 << 20
+
+
+def shard_files(data_path):
+    """The data files of a data path, either a single file or a directory of
+    gzipped shards, in the reading order of data_gen.
+
+    Args:
+      data_path: A file or a directory.
+
+    Returns:
+
+    """
+    if os.path.isdir(data_path):
+        return [os.path.join(data_path, f)
+                for f in sorted(os.listdir(data_path))
+                if not f.startswith('.') and f.endswith('.gz')]
+    else:
+        return [data_path]
+
+
+class LineIndex:
+    suffix = '.lidx.npz'
+
+    def __init__(self, path, line_starts, members):
+        self.path = path
+        self.line_starts = line_starts
+        self.members = members
+        self.is_gzip = path.endswith('.gz')
+
+    @property
+    def num_lines(self):
+        return len(self.line_starts) - 1
+
+    @classmethod
+    def index_path(cls, path):
+        return path + cls.suffix
+
+    @classmethod
+    def build(cls, path):
+        """Scan the file once, and record the line and gzip member offsets.
+
+        Args:
+          path: Path to the data file.
+
+        Returns:
+
+        """
+        newline_pos = []
+        members = []
+        uncompressed_size = 0
+
+        def record_lines(data):
+            nonlocal uncompressed_size
+            if len(data) > 0:
+                pos = np.flatnonzero(np.frombuffer(data, np.uint8) == 10)
+                newline_pos.append(pos + uncompressed_size + 1)
+                uncompressed_size += len(data)
+
+        with open(path, 'rb') as raw:
+            if path.endswith('.gz'):
+                decompressor = None
+                num_read = 0
+                buf = b''
+                while True:
+                    if len(buf) == 0:
+                        buf = raw.read(_CHUNK_SIZE)
+                        if len(buf) == 0:
+                            break
+                        num_read += len(buf)
+
+                    if decompressor is None:
+                        # Some writers pad zeros after the last member.
+                        if len(buf.strip(b'\0')) == 0:
+                            buf = b''
+                            continue
+                        members.append(
+                            (num_read - len(buf), uncompressed_size))
+                        decompressor = zlib.decompressobj(wbits=31)
+
+                    record_lines(decompressor.decompress(buf))
+
+                    if decompressor.eof:
+                        # The rest of the buffer belongs to the next member.
+                        buf = decompressor.unused_data
+                        decompressor = None
+                    else:
+                        buf = b''
+            else:
+                members.append((0, 0))
+                for chunk in iter(lambda: raw.read(_CHUNK_SIZE), b''):
+                    record_lines(chunk)
+
+        line_ends = np.concatenate(
+            newline_pos) if newline_pos else np.zeros(0, np.int64)
+        last_end = line_ends[-1] if len(line_ends) else 0
+        if uncompressed_size > last_end:
+            # The last line does not end with a new line, an empty file has
+            # no line at all.
+            line_ends = np.append(line_ends, uncompressed_size)
+
+        line_starts = np.concatenate([[0], line_ends]).astype(np.int64)
+        return cls(path, line_starts, np.asarray(members, dtype=np.int64))
+
+    def save(self):
+        np.savez(self.index_path(self.path), line_starts=self.line_starts,
+                 members=self.members)
+
+    @classmethod
+    def load(cls, path):
+        """Load the index of a data file, the index is built (and saved) if it
+        does not exist or is older than the file.
+
+        Args:
+          path: Path to the data file.
+
+        Returns:
+
+        """
+        index_path = cls.index_path(path)
+        if os.path.exists(index_path) and os.path.getmtime(
+                index_path) >= os.path.getmtime(path):
+            with np.load(index_path) as saved:
+                return cls(path, saved['line_starts'], saved['members'])
+
+        logger.info(f"Building line index for {path}")
+        index = cls.build(path)
+        try:
+            index.save()
+        except OSError:
+            logger.warning(f"Cannot save line index at {index_path}")
+        return index
+
+    def __open_at(self, line_num):
+        """Open the file at the start of a line.
+
+        Args:
+          line_num: The 0-based line number.
+
+        Returns:
+          The raw file, and the file positioned at the line.
+
+        """
+        target = int(self.line_starts[line_num])
+
+        raw = open(self.path, 'rb')
+        if self.is_gzip:
+            # The last member starting before the target.
+            m = bisect.bisect_right(self.members[:, 1], target) - 1
+            compressed_offset, uncompressed_offset = self.members[m]
+            raw.seek(int(compressed_offset))
+            f = gzip.GzipFile(fileobj=raw, mode='rb')
+            f.seek(target - int(uncompressed_offset))
+            return raw, f
+        else:
+            raw.seek(target)
+            return raw, raw
+
+    def read_lines(self, from_line=0, until_line=None):
+        """Read the lines in [from_line, until_line).
+
+        Args:
+          from_line: The first line to read (0-based).
+          until_line: The line to stop at (exclusive), read to the end if None.
+
+        Returns:
+
+        """
+        if until_line is None or until_line > self.num_lines:
+            until_line = self.num_lines
+
+        if from_line >= until_line:
+            return
+
+        raw, f = self.__open_at(from_line)
+        try:
+            for _ in range(until_line - from_line):
+                yield f.readline().decode('utf-8')
+        finally:
+            f.close()
+            raw.close()
+
+    def read_line(self, line_num):
+        return next(self.read_lines(line_num, line_num + 1))
+
+
+def indexed_lines(data_path, from_line=None, until_line=None):
+    """Same as reading the lines with data_gen, but seek to the start line
+    with the line indices, and skip the shards out of the range.
+
+    Args:
+      data_path: A file or a directory of shards.
+      from_line: Skip this number of lines.
+      until_line: Stop after this line number (1-based, inclusive).
+
+    Returns:
+
+    """
+    from_line = from_line or 0
+    shard_start = 0
+
+    for path in shard_files(data_path):
+        if until_line and shard_start >= until_line:
+            break
+
+        index = LineIndex.load(path)
+        shard_end = shard_start + index.num_lines
+
+        if from_line < shard_end:
+            logger.info("Reading from {}".format(path))
+            local_until = None
+            if until_line:
+                local_until = until_line - shard_start
+            yield from index.read_lines(max(from_line - shard_start, 0),
+                                        local_until)
+
+        shard_start = shard_end
+
+
+def count_lines(data_path):
+    return sum(LineIndex.load(p).num_lines for p in shard_files(data_path))
+
+
+def split_line_ranges(data_path, num_parts, from_line=0):
+    """Split the lines into disjoint ranges of similar sizes, for parallel
+    readers. Each range can be passed to `indexed_lines`.
+
+    Args:
+      data_path: A file or a directory of shards.
+      num_parts: Number of ranges.
+      from_line: Ignore the lines before this.
+
+    Returns:
+      A list of (from_line, until_line) pairs.
+
+    """
+    total = count_lines(data_path)
+    bounds = np.linspace(from_line, total, num_parts + 1).astype(int)
+    return [(int(b), int(e)) for b, e in zip(bounds[:-1], bounds[1:])]
+
+
+def read_line(data_path, line_num):
+    """Random access to a line (0-based) for debugging.
+
+    Args:
+      data_path: A file or a directory of shards.
+      line_num: The line number across all shards.
+
+    Returns:
+
+    """
+    shard_start = 0
+    for path in shard_files(data_path):
+        index = LineIndex.load(path)
+        if line_num < shard_start + index.num_lines:
+            return index.read_line(line_num - shard_start)
+        shard_start += index.num_lines
+    raise IndexError(f"Line {line_num} is out of range, there are only "
+                     f"{shard_start} lines.")
+
+
+def reblock(path, out_path, lines_per_member=1000):
+    """Rewrite a gzip file into multiple gzip members, each containing a block
+    of lines, so that the line index can seek to the nearby member.
+
+    Args:
+      path: The input gzip file.
+      out_path: The output gzip file.
+      lines_per_member: Number of lines per member.
+
+    Returns:
+
+    """
+    with gzip.open(path, 'rb') as fin, open(out_path, 'wb') as out:
+        block = []
+        for line in fin:
+            block.append(line)
+            if len(block) == lines_per_member:
+                out.write(gzip.compress(b''.join(block)))
+                block = []
+        if block:
+            out.write(gzip.compress(b''.join(block)))
+
+
+if __name__ == '__main__':
+    class LineIndexer(Configurable):
+        data_path = Unicode(help='A data file or a directory of shards.').tag(
+            config=True)
+        do_reblock = Bool(help='Rewrite the shards into small gzip members.',
+                          default_value=False).tag(config=True)
+        lines_per_member = Integer(help='Number of lines per gzip member.',
+                                   default_value=1000).tag(config=True)
+
+
+    util.set_basic_log()
+    para = LineIndexer(config=util.load_command_line_config(sys.argv[1:]))
+
+    for shard in shard_files(para.data_path):
+        if para.do_reblock and shard.endswith('.gz'):
+            tmp_path = shard + '.reblock'
+            reblock(shard, tmp_path, para.lines_per_member)
+            os.replace(tmp_path, shard)
+        shard_index = LineIndex.load(shard)
+        logger.info(f"{shard}: {shard_index.num_lines} lines in "
+                    f"{len(shard_index.members)} members.")
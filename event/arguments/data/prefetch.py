@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class BatchPrefetcher:
+    """Run a batch generator in a background thread, which keeps up to `depth`
+    batches ready while the current batch is used. If the generator moves the
+    batches to the device, the transfer also happens in the background.
+
+    The queue starvation (the consumer finds no batch ready) is logged, which
+    tells whether the data path or the computation is the bottleneck.
+
+    Args:
+      batch_gen: The generator of the batches.
+      depth: Max number of batches prepared ahead.
+      log_freq: Log the queue statistics every this number of batches.
+    """
+
+    def __init__(self, batch_gen, depth, log_freq=100):
+        self.batch_gen = batch_gen
+        self.depth = depth
+        self.log_freq = log_freq
+
+        self.num_batches = 0
+        self.num_starved = 0
+        self.wait_time = 0.0
+
+    def __produce(self, batch_queue, stop_event):
+        def put(item):
+            # Check the stop signal periodically so that this thread won't be
+            # blocked forever when the consumer quits early.
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.batch_gen:
+                if not put(batch):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
+
+    def log_stats(self):
+        if self.num_batches == 0:
+            return
+
+        logger.info(
+            f"Prefetch queue starved at {self.num_starved} of "
+            f"{self.num_batches} batches "
+            f"({100.0 * self.num_starved / self.num_batches:.1f}%), "
+            f"waited {self.wait_time:.2f}s for data.")
+
+    def __iter__(self):
+        batch_queue = queue.Queue(maxsize=self.depth)
+        stop_event = threading.Event()
+
+        producer = threading.Thread(
+            target=self.__produce, args=(batch_queue, stop_event), daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                if batch_queue.empty():
+                    self.num_starved += 1
+
+                start = time.time()
+                item = batch_queue.get()
+                self.wait_time += time.time() - start
+
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                self.num_batches += 1
+                if self.num_batches % self.log_freq == 0:
+                    self.log_stats()
+
+                yield item
+        finally:
+            stop_event.set()
+            producer.join()
+
+        self.log_stats()
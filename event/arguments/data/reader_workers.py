@@ -0,0 +1,144 @@
+import logging
+import multiprocessing as mp
+import threading
+import traceback
+
+from event.arguments.data.cloze_gen import ClozeSampler
+
+logger = logging.getLogger(__name__)
+
+
+def _feed_lines(lines, in_queues, feed_errors):
+    """Distribute the lines to the workers in a round robin fashion, so that
+    each worker always see the same subset of the data.
+
+    Args:
+      lines: The hashed data lines.
+      in_queues: The input queue for each worker.
+      feed_errors: A list to hold the error raised when reading the lines,
+        it is re-raised by the consumer.
+
+    Returns:
+
+    """
+    num_workers = len(in_queues)
+    try:
+        for line_idx, line in enumerate(lines):
+            in_queues[line_idx % num_workers].put((line_idx, line))
+    except Exception as e:
+        feed_errors.append(e)
+    finally:
+        # The workers must always be ended, or the consumer waits forever.
+        for q in in_queues:
+            q.put(None)
+
+
+def _training_worker(reader, sampler, in_queue, out_queue):
+    reader.set_sampler(sampler)
+
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+
+        line_idx, line = item
+        try:
+            out_queue.put(
+                (line_idx, reader.create_training_data(line), None))
+        except Exception:
+            out_queue.put((line_idx, None, traceback.format_exc()))
+            break
+
+    # Signal that this worker is done.
+    out_queue.put(None)
+
+
+class ParallelClozeMaker:
+    """Create the training cloze instances with multiple processes. The lines
+    are sharded across the workers, each worker owns a sampler derived from
+    the main sampler, hence the output is reproducible given a seed.
+
+    Args:
+      reader: The HashedClozeReader used to create the instances.
+      num_workers: Number of worker processes.
+      ordered: Whether to output the documents in the input order.
+      queue_size: Max number of items waiting in each worker queue.
+    """
+
+    def __init__(self, reader, num_workers, ordered=True, queue_size=64):
+        self.reader = reader
+        self.num_workers = num_workers
+        self.ordered = ordered
+        self.queue_size = queue_size
+
+    def training_data(self, lines, sampler: ClozeSampler):
+        """Generate the output of `create_training_data` for each line.
+
+        Args:
+          lines: The hashed data lines.
+          sampler: The main sampler, worker samplers are spawned from it.
+
+        Returns:
+
+        """
+        # Fork to share the resources (vocabularies) with the workers.
+        ctx = mp.get_context('fork')
+
+        in_queues = [ctx.Queue(self.queue_size)
+                     for _ in range(self.num_workers)]
+        out_queue = ctx.Queue(self.queue_size * self.num_workers)
+
+        workers = []
+        for worker_id in range(self.num_workers):
+            p = ctx.Process(
+                target=_training_worker,
+                args=(self.reader, sampler.spawn(worker_id),
+                      in_queues[worker_id], out_queue),
+                daemon=True,
+            )
+            p.start()
+            workers.append(p)
+
+        logger.info(f"Started {self.num_workers} reader workers, "
+                    f"ordered output: {self.ordered}.")
+
+        feed_errors = []
+        feeder = threading.Thread(target=_feed_lines,
+                                  args=(lines, in_queues, feed_errors),
+                                  daemon=True)
+        feeder.start()
+
+        num_finished = 0
+        next_idx = 0
+        pending = {}
+
+        try:
+            while num_finished < self.num_workers:
+                item = out_queue.get()
+
+                if item is None:
+                    num_finished += 1
+                    continue
+
+                line_idx, parsed_output, error = item
+
+                if error is not None:
+                    raise RuntimeError(
+                        f"Reader worker failed at line {line_idx}:\n{error}")
+
+                if self.ordered:
+                    pending[line_idx] = parsed_output
+                    while next_idx in pending:
+                        yield pending.pop(next_idx)
+                        next_idx += 1
+                else:
+                    yield parsed_output
+
+            if feed_errors:
+                # Reading the input failed, the workers stopped early.
+                raise feed_errors[0]
+        finally:
+            for p in workers:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
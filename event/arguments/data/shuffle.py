@@ -0,0 +1,77 @@
+import random
+
+
+class ShuffleBuffer:
+    """Shuffle a stream (e.g. documents or batches) with a bounded buffer.
+
+    The buffer is first filled with `buffer_size` items, after that each
+    incoming item replaces a randomly picked item in the buffer, which is
+    emitted. An item can then move ahead by up to `buffer_size` positions or
+    be delayed arbitrarily, which mixes much better than shuffling within the
+    fixed splits, while only keeping `buffer_size` items in memory.
+
+    Args:
+      buffer_size: Number of items kept in the buffer, no shuffling if less
+        than 2.
+      seed: The random seed, the order is reproducible given the seed.
+    """
+
+    def __init__(self, buffer_size, seed=None):
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.rng = random.Random(seed)
+        # The items currently held, which are read but not emitted yet.
+        self.buffer = []
+
+    def reset(self, epoch=None):
+        """Reseed the random generator, a different epoch gives a different
+        order.
+
+        Args:
+          epoch: The epoch number to derive the seed from.
+
+        Returns:
+
+        """
+        if self.seed is None or epoch is None:
+            self.rng = random.Random(self.seed)
+        else:
+            self.rng = random.Random(f'{self.seed}_{epoch}')
+
+    def shuffle(self, items, buffered=None):
+        """Shuffle the items.
+
+        Args:
+          items: The items to shuffle.
+          buffered: The items already in the buffer, e.g. to continue from
+            a saved `buffer` with the saved random state.
+
+        Returns:
+
+        """
+        self.buffer = buffer = list(buffered or [])
+
+        if self.buffer_size < 2:
+            while buffer:
+                yield buffer.pop(0)
+            yield from items
+            return
+
+        for item in items:
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+
+            # The buffer is updated before emitting, so it always holds all
+            # the items read but not emitted.
+            index = self.rng.randrange(self.buffer_size)
+            emitted = buffer[index]
+            buffer[index] = item
+            yield emitted
+
+        # Drain in a random order, one item at a time, so a saved buffer
+        # continues the same order.
+        while buffer:
+            index = self.rng.randrange(len(buffer))
+            buffer[index], buffer[-1] = buffer[-1], buffer[index]
+            yield buffer.pop()
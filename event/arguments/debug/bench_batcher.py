@@ -0,0 +1,224 @@
+"""Micro-benchmark of the batch assembly in ClozeBatcher, comparing with the
+previous implementation that pads the lists key by key and stacks the per
+document tensors.
+
+Example:
+    python -m event.arguments.debug.bench_batcher --Bench.batch_size=128
+"""
+import copy
+import random
+import sys
+import timeit
+
+import numpy as np
+import torch
+from traitlets import Integer
+from traitlets.config import Configurable
+
+from event import util
+from event.arguments.data.batcher import ClozeBatcher
+from event.io.io_utils import pad_2d_list, pad_last_axis
+
+
+class LegacyClozeBatcher(ClozeBatcher):
+    """The batch assembly before vectorization, kept for comparison."""
+
+    def _var_pad(self, key, data, pad_length):
+        pad_last_axis(data, self.data_dim[key], pad_length)
+
+    def _batch_pad(self, key, data, pad_size):
+        dim = self.data_dim[key]
+
+        if dim == 2:
+            return [pad_2d_list(v, pad_size) for v in data]
+        elif dim == 1:
+            return pad_2d_list(data, pad_size, axis=1)
+        else:
+            raise ValueError("Dimension unsupported %d" % dim)
+
+    def create_batch(self):
+        instance_data = {}
+        common_data = {}
+        data_len = []
+        sizes = {}
+
+        for key, value in self.b_common_data.items():
+            if key in self.slot_keys:
+                [self._var_pad(key, v, self.max_c_num_slots) for v in value]
+
+            if key.startswith('context_'):
+                padded = self._batch_pad(key, value, self.max_context_size)
+            else:
+                padded = self._batch_pad(key, value, self.max_instance_size)
+            vectorized = util.to_torch(padded, self.data_types[key])
+            common_data[key] = util.batch_combine(vectorized)
+
+            sizes[key] = len(padded)
+
+        for key, value in self.b_instance_data.items():
+            if key in self.slot_keys:
+                [self._var_pad(key, v, self.max_num_slots) for v in value]
+
+            data_len = [len(v) for v in value]
+            padded = self._batch_pad(key, value, self.max_instance_size)
+
+            vectorized = util.to_torch(padded, self.data_types[key])
+            instance_data[key] = util.batch_combine(vectorized)
+
+            sizes[key] = len(padded)
+
+        labels = util.to_torch(
+            pad_2d_list(self.b_labels, self.max_instance_size, axis=1),
+            np.float32)
+
+        data_size = len(self.b_labels)
+
+        mask = np.zeros([data_size, self.max_instance_size], dtype=int)
+        for i, l in enumerate(data_len):
+            mask[i][0: l] = 1
+
+        ins_mask = util.to_torch(mask, np.float32)
+
+        return (
+            labels, instance_data, common_data, data_size, ins_mask,
+            self.b_meta_data
+        )
+
+
+class SyntheticInstances:
+    def __init__(self, data, label):
+        self.data = data
+        self.label = label
+
+
+def synthetic_event(rng, vocab_size, num_slots):
+    return ([rng.randrange(vocab_size), rng.randrange(vocab_size)],
+            [rng.randrange(vocab_size) for _ in range(num_slots)],
+            [rng.randrange(vocab_size) for _ in range(num_slots)])
+
+
+def synthetic_doc(rng, max_events, vocab_size=60000):
+    """Create a document in the role_dynamic format, the context size and the
+    number of instances are skewed towards small documents as in the real
+    data.
+
+    Args:
+      rng: The random generator.
+      max_events: Max number of context events.
+      vocab_size: Size of the event vocabulary.
+
+    Returns:
+
+    """
+    num_context = min(max_events, int(rng.expovariate(1 / 30.0)) + 2)
+    num_instances = min(200, num_context * rng.randint(1, 3))
+
+    common_data = {
+        'event_indices': [],
+        'slot_indicators': [],
+        'context_predicate': [],
+        'context_slot': [],
+        'context_slot_value': [],
+        'context_slot_length': [],
+    }
+    for _ in range(num_context):
+        pred, slots, values = synthetic_event(rng, vocab_size,
+                                              rng.randint(1, 6))
+        common_data['context_predicate'].append(pred)
+        common_data['context_slot'].append(slots)
+        common_data['context_slot_value'].append(values)
+        common_data['context_slot_length'].append(len(slots))
+
+    data = {
+        'predicate': [],
+        'slot': [],
+        'slot_value': [],
+        'slot_length': [],
+        'distances': [],
+        'features': [],
+    }
+    labels = []
+    for _ in range(num_instances):
+        pred, slots, values = synthetic_event(rng, vocab_size,
+                                              rng.randint(1, 6))
+        data['predicate'].append(pred)
+        data['slot'].append(slots)
+        data['slot_value'].append(values)
+        data['slot_length'].append(len(slots))
+        data['distances'].append([rng.random() * 10 for _ in range(3)])
+        data['features'].append([rng.random() for _ in range(11)])
+        labels.append(rng.randint(0, 1))
+
+        common_data['event_indices'].append(rng.randrange(num_context))
+        common_data['slot_indicators'].append(rng.randrange(vocab_size))
+
+    return SyntheticInstances(data, labels), common_data
+
+
+def assemble(batcher_class, docs, batch_size):
+    batcher = batcher_class(batch_size)
+    batches = []
+    for instances, common_data in docs:
+        batches.extend(batcher.get_batch(instances, common_data))
+    batches.extend(batcher.flush())
+    return batches
+
+
+def same_batches(batches_a, batches_b):
+    for a, b in zip(batches_a, batches_b):
+        labels_a, ins_a, common_a, _, mask_a, _ = a
+        labels_b, ins_b, common_b, _, mask_b, _ = b
+        if not (torch.equal(labels_a, labels_b) and
+                torch.equal(mask_a, mask_b)):
+            return False
+        for key in ins_a:
+            if not torch.equal(ins_a[key], ins_b[key]):
+                return False
+        for key in common_a:
+            if not torch.equal(common_a[key], common_b[key]):
+                return False
+    return len(batches_a) == len(batches_b)
+
+
+def main(params):
+    rng = random.Random(params.seed)
+    docs = [synthetic_doc(rng, params.max_events) for _ in
+            range(params.batch_size * params.num_batches)]
+
+    # The legacy path pads the lists in place, so each run gets its own copy.
+    def run(batcher_class):
+        doc_copy = copy.deepcopy(docs)
+        start = timeit.default_timer()
+        batches = assemble(batcher_class, doc_copy, params.batch_size)
+        return timeit.default_timer() - start, batches
+
+    legacy_times, new_times = [], []
+    for _ in range(params.repeat):
+        t, legacy_batches = run(LegacyClozeBatcher)
+        legacy_times.append(t)
+        t, new_batches = run(ClozeBatcher)
+        new_times.append(t)
+
+    print(f"{params.num_batches} batches of {params.batch_size} documents, "
+          f"best of {params.repeat} runs.")
+    print(f"Legacy batch assembly: {min(legacy_times):.3f}s")
+    print(f"Vectorized batch assembly: {min(new_times):.3f}s")
+    print(f"Speed up: {min(legacy_times) / min(new_times):.2f}x")
+    print(f"Identical output: {same_batches(legacy_batches, new_batches)}")
+
+
+if __name__ == '__main__':
+    class Bench(Configurable):
+        batch_size = Integer(help='Documents per batch.',
+                             default_value=128).tag(config=True)
+        num_batches = Integer(help='Number of batches.',
+                              default_value=10).tag(config=True)
+        max_events = Integer(help='Max context events per document.',
+                             default_value=200).tag(config=True)
+        repeat = Integer(help='Number of repeated runs.',
+                         default_value=3).tag(config=True)
+        seed = Integer(help='Random seed.', default_value=1).tag(config=True)
+
+
+    conf = util.load_command_line_config(sys.argv[1:])
+    main(Bench(config=conf))
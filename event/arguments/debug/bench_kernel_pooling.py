@@ -0,0 +1,158 @@
+"""Benchmark of the kernel pooling: the fused KernelSumFunction against the
+pooling that expands the input to the K kernels, on a forward and backward
+pass over a batch x instance x context similarity tensor.
+
+The memory is reported as the bytes saved for the backward pass and the peak
+memory of a pass in a fresh process. The CPU peak is the growth of the
+resident memory (Linux only), the GPU peak is from the CUDA allocator.
+
+Example:
+    python -m event.arguments.debug.bench_kernel_pooling \
+        --Bench.batch_size=512 --Bench.context_size=200
+"""
+import multiprocessing
+import sys
+import timeit
+
+import torch
+from traitlets import Integer, Unicode
+from traitlets.config import Configurable
+
+from event import util
+from event.nn.models import KernelPooling
+
+IMPLEMENTATIONS = ('expanded', 'fused')
+
+
+def pooling(kp: KernelPooling, implementation):
+    if implementation == 'expanded':
+        return kp._pool
+    return kp
+
+
+def similarities(shape, device, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    # The cosine similarities, with some exact matches.
+    sim = torch.rand(shape, generator=generator) * 2 - 1
+    sim[..., 0] = 1
+    return sim.to(device).requires_grad_()
+
+
+def run_pass(kp, implementation, sim):
+    pooled = pooling(kp, implementation)(sim)
+    pooled.sum().backward()
+    return pooled
+
+
+def saved_bytes(kp, implementation, sim):
+    """The bytes of the distinct tensors saved for the backward pass."""
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.untyped_storage().data_ptr()] = \
+            tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        run_pass(kp, implementation, sim)
+    return sum(saved.values())
+
+
+def memory_status(key):
+    """A memory size in bytes from the process status, Linux only."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(key + ':'):
+                # The sizes are in kilobytes.
+                return int(line.split()[1]) * 1024
+
+
+def measure_peak(implementation, shape, device, queue):
+    kp = KernelPooling().to(device)
+    sim = similarities(shape, device)
+
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+        run_pass(kp, implementation, sim)
+        queue.put(torch.cuda.max_memory_allocated() - start)
+        return
+
+    # Reset the peak resident size to the current one.
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    start = memory_status('VmRSS')
+    run_pass(kp, implementation, sim)
+    queue.put(memory_status('VmHWM') - start)
+
+
+def peak_bytes(implementation, shape, device):
+    """The peak memory growth of a pass, measured in a fresh process, where
+    the allocators have not cached any memory yet."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure_peak,
+                              args=(implementation, shape, device, queue))
+    process.start()
+    peak = queue.get()
+    process.join()
+    return peak
+
+
+def main(params):
+    shape = (params.batch_size, params.instance_size, params.context_size)
+    device = params.device
+
+    kp = KernelPooling().to(device)
+    sim = similarities(shape, device)
+
+    outputs = {}
+    grads = {}
+    for implementation in IMPLEMENTATIONS:
+        sim.grad = None
+        kp.zero_grad()
+        outputs[implementation] = run_pass(kp, implementation, sim).detach()
+        grads[implementation] = [sim.grad.clone(), kp.v_mu.grad.clone(),
+                                 kp.v_sigma.grad.clone()]
+
+    print(f"Similarities of {'x'.join(str(s) for s in shape)} on {device}, "
+          f"{kp.K} kernels, {torch.get_num_threads()} threads.")
+
+    for implementation in IMPLEMENTATIONS:
+        def one_pass():
+            run_pass(kp, implementation, sim)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+        one_pass()
+        elapsed = timeit.timeit(one_pass, number=params.repeat)
+        print(f"{implementation}: {params.repeat / elapsed:.2f} passes/s, "
+              f"saved for backward "
+              f"{saved_bytes(kp, implementation, sim) / 2 ** 20:.1f} MB, "
+              f"peak {peak_bytes(implementation, shape, device) / 2 ** 20:.1f}"
+              f" MB")
+
+    print(f"Max difference of the pooled values: "
+          f"{(outputs['expanded'] - outputs['fused']).abs().max().item()}")
+    for name, expanded, fused in zip(('input', 'mu', 'sigma'),
+                                     grads['expanded'], grads['fused']):
+        print(f"Max relative difference of the {name} gradients: "
+              f"{((expanded - fused).abs().max() / expanded.abs().max()).item()}")
+
+
+if __name__ == '__main__':
+    class Bench(Configurable):
+        batch_size = Integer(help='Documents per batch.',
+                             default_value=128).tag(config=True)
+        instance_size = Integer(help='Instances per document.',
+                                default_value=40).tag(config=True)
+        context_size = Integer(help='Context events per document.',
+                               default_value=200).tag(config=True)
+        repeat = Integer(help='Number of timed passes.',
+                         default_value=5).tag(config=True)
+        device = Unicode(help='Device to run on.',
+                         default_value='cpu').tag(config=True)
+
+
+    conf = util.load_command_line_config(sys.argv[1:])
+    main(Bench(config=conf))
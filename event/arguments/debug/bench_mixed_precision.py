@@ -0,0 +1,183 @@
+"""Benchmark of the mixed precision mode on CPU: train the same model on the
+same synthetic batches in float32 and with bfloat16 autocast, and compare the
+throughput and the losses.
+
+Example:
+    python -m event.arguments.debug.bench_mixed_precision --Bench.steps=50
+"""
+import random
+import sys
+import timeit
+
+import torch
+from torch.nn import functional as F
+from traitlets import Integer
+from traitlets.config import Configurable
+
+from event import util
+from event.arguments.arg_models import EventCoherenceModel
+from event.arguments.data.batcher import ClozeBatcher
+from event.arguments.debug.bench_batcher import SyntheticInstances
+from event.arguments.implicit_arg_params import ArgModelPara
+
+
+class SyntheticVocab:
+    def __init__(self, size):
+        self.size = size
+
+    def get_size(self):
+        return self.size
+
+
+class SyntheticResources:
+    """The parts of ImplicitArgResources used to create the model, with
+    randomly initialized embeddings."""
+
+    def __init__(self, vocab_size):
+        self.event_embed_vocab = SyntheticVocab(vocab_size)
+        self.word_embed_vocab = SyntheticVocab(vocab_size)
+        self.event_embedding_path = None
+        self.word_embedding_path = None
+
+
+def synthetic_fix_slot_doc(rng, para: ArgModelPara, vocab_size, max_events,
+                           sample_id=None):
+    """Create a document in the fix_slots format.
+
+    Args:
+      rng: The random generator.
+      para: The model parameters.
+      vocab_size: Size of the event vocabulary.
+      max_events: Max number of context events.
+      sample_id: Sample an event id with the random generator, uniform by
+        default.
+
+    Returns:
+
+    """
+    if sample_id is None:
+        def sample_id(r):
+            return r.randrange(1, vocab_size)
+
+    num_components = (1 + para.num_slots) * (2 if para.use_frame else 1)
+    num_context = min(max_events, int(rng.expovariate(1 / 30.0)) + 2)
+    num_instances = min(200, num_context * rng.randint(1, 3))
+
+    def event():
+        return [sample_id(rng) for _ in range(num_components)]
+
+    common_data = {
+        'event_indices': [rng.randrange(num_context) for _ in
+                          range(num_instances)],
+        'slot_indicators': [rng.randrange(para.num_slots) for _ in
+                            range(num_instances)],
+        'context_event_component': [event() for _ in range(num_context)],
+    }
+
+    data = {
+        'event_component': [event() for _ in range(num_instances)],
+        'distances': [[rng.random() * 10 for _ in range(3)] for _ in
+                      range(num_instances)],
+        'features': [[rng.random() for _ in range(para.num_extracted_features)]
+                     for _ in range(num_instances)],
+    }
+    labels = [rng.randint(0, 1) for _ in range(num_instances)]
+
+    return SyntheticInstances(data, labels), common_data
+
+
+def get_loss(model, batch, mixed_precision):
+    labels, instances, common_data, _, mask, _ = batch
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16,
+                        enabled=mixed_precision):
+        coh = model.score(instances, common_data,
+                          model.encode_context(common_data))
+    return F.binary_cross_entropy(
+        coh.float() * mask, labels, reduction='sum') / mask.sum()
+
+
+def train(para, resources, batches, mixed_precision, seed):
+    torch.manual_seed(seed)
+    model = EventCoherenceModel(para, resources, 'cpu', 'bench')
+    optimizer = torch.optim.Adam(model.parameters())
+
+    losses = []
+    start = timeit.default_timer()
+    for batch in batches:
+        loss = get_loss(model, batch, mixed_precision)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return timeit.default_timer() - start, losses, model
+
+
+@torch.no_grad()
+def evaluate(model, batches, mixed_precision):
+    model.eval()
+    start = timeit.default_timer()
+    losses = [get_loss(model, b, mixed_precision).item() for b in batches]
+    return timeit.default_timer() - start, losses
+
+
+def main(params):
+    para = ArgModelPara(
+        arg_representation_method='fix_slots', use_frame=True, num_slots=3,
+        num_extracted_features=11, num_distance_features=3,
+        event_embedding_dim=params.embedding_dim,
+        word_embedding_dim=params.embedding_dim,
+    )
+    resources = SyntheticResources(params.vocab_size)
+
+    rng = random.Random(params.seed)
+    batcher = ClozeBatcher(params.batch_size)
+    batches = []
+    while len(batches) < params.steps:
+        doc = synthetic_fix_slot_doc(rng, para, params.vocab_size,
+                                     params.max_events)
+        batches.extend(batcher.get_batch(*doc))
+    batches = batches[:params.steps]
+
+    results = {}
+    for mixed_precision in (False, True):
+        train_time, train_losses, model = train(
+            para, resources, batches, mixed_precision, params.seed)
+        eval_time, eval_losses = evaluate(model, batches, mixed_precision)
+        results[mixed_precision] = (train_time, train_losses, eval_time,
+                                    eval_losses)
+
+    print(f"{params.steps} batches of {params.batch_size} documents, "
+          f"{torch.get_num_threads()} threads.")
+
+    for mixed_precision, name in ((False, 'float32'), (True, 'bfloat16')):
+        train_time, train_losses, eval_time, _ = results[mixed_precision]
+        print(f"{name}: train {params.steps / train_time:.2f} batches/s, "
+              f"eval {params.steps / eval_time:.2f} batches/s, "
+              f"final loss {train_losses[-1]:.5f}")
+
+    fp32_train, amp_train = results[False][1], results[True][1]
+    window = max(1, len(fp32_train) // 10)
+    print(f"Mean train loss of the last {window} steps: "
+          f"float32 {sum(fp32_train[-window:]) / window:.5f}, "
+          f"bfloat16 {sum(amp_train[-window:]) / window:.5f}")
+    print(f"Max train loss difference: "
+          f"{max(abs(a - b) for a, b in zip(fp32_train, amp_train)):.5f}")
+
+
+if __name__ == '__main__':
+    class Bench(Configurable):
+        batch_size = Integer(help='Documents per batch.',
+                             default_value=32).tag(config=True)
+        steps = Integer(help='Number of training steps.',
+                        default_value=30).tag(config=True)
+        max_events = Integer(help='Max context events per document.',
+                             default_value=200).tag(config=True)
+        embedding_dim = Integer(help='Event embedding dimension.',
+                                default_value=300).tag(config=True)
+        vocab_size = Integer(help='Size of the event vocabulary.',
+                             default_value=50000).tag(config=True)
+        seed = Integer(help='Random seed.', default_value=1).tag(config=True)
+
+
+    conf = util.load_command_line_config(sys.argv[1:])
+    main(Bench(config=conf))
@@ -0,0 +1,190 @@
+"""Parity and speed report of the int8 inference: test the trained model in
+full precision, with the linear layers quantized, and with the embedding
+tables quantized as well. The report compares the ImplicitEval results, the
+top candidates and the scores of the test cases, the scoring throughput and
+the model size.
+
+It takes the runner configs, e.g. on the NomBank test set:
+    python -m event.arguments.debug.bench_quantization \
+        conf/implicit/arg_para_basics.py conf/implicit/basic_frames.py \
+        conf/implicit/test_nombank.py --Bench.eval_dir=quantization_nombank
+"""
+import io
+import json
+import logging
+import os
+import timeit
+
+import numpy as np
+import torch
+from traitlets import Bool, Unicode, Integer
+from traitlets.config import Configurable
+
+from event.arguments.NIFDetector import GoldNullArgDetector, \
+    TrainableNullArgDetector
+from event.arguments.arg_models import EventCoherenceModel
+from event.arguments.data.cloze_readers import HashedClozeReader
+from event.arguments.data.hashed_io import data_gen
+from event.arguments.evaluation import ImplicitEval, case_scores
+from event.arguments.implicit_arg_params import ArgModelPara
+from event.arguments.implicit_arg_resources import ImplicitArgResources
+from event.arguments.quantization import quantize_for_inference
+from event.util import load_mixed_configs, set_basic_log
+
+logger = logging.getLogger(__name__)
+
+
+def model_size(model):
+    """Size of the serialized model parameters in bytes."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+@torch.no_grad()
+def test_model(model, batches, eval_dir=None):
+    """Score the test batches and evaluate the predictions.
+
+    Args:
+      model: The model to test.
+      batches: The test batches.
+      eval_dir: The evaluation output directory.
+
+    Returns:
+      The scoring time, the ImplicitEval and the scores of each test case.
+
+    """
+    evaluator = ImplicitEval(eval_dir)
+    all_scores = []
+    scoring_time = 0
+
+    for _, instances, common_data, _, _, metadata in batches:
+        start = timeit.default_timer()
+        coh = model(instances, common_data)
+        scoring_time += timeit.default_timer() - start
+
+        coh_scores = case_scores(coh.numpy(), metadata)
+        evaluator.add_prediction(coh_scores, metadata)
+        all_scores.extend(coh_scores)
+
+    evaluator.collect()
+    return scoring_time, evaluator, all_scores
+
+
+def top_candidates(all_scores):
+    """The index of the top candidate of each test case, -1 if there is no
+    candidate."""
+    return [int(np.argmax(scores)) if scores else -1 for scores in
+            all_scores]
+
+
+def system_results(evaluator):
+    return dict(
+        (name, group['results']['system']) for name, group in
+        evaluator.overall_results.get('basic', {}).items()
+    )
+
+
+def main(conf):
+    basic_para = Basic(config=conf)
+    bench_para = Bench(config=conf)
+    para = ArgModelPara(config=conf)
+    resources = ImplicitArgResources(config=conf)
+
+    reader = HashedClozeReader(resources, para)
+    reader.auto_test = False
+    reader.factor_role = basic_para.test_factor_role
+    reader.use_gold_mention = True
+    reader.use_auto_mention = False
+
+    if para.nid_method == 'gold':
+        nid_detector = GoldNullArgDetector()
+    elif para.nid_method == 'train':
+        nid_detector = TrainableNullArgDetector()
+    else:
+        raise ValueError(f"Unknown NID method {para.nid_method}")
+
+    test_lines = data_gen(basic_para.test_in, until_line=bench_para.max_docs
+                          if bench_para.max_docs > 0 else None)
+    batches = list(reader.read_test_docs(test_lines, nid_detector))
+    logger.info(f"Read {len(batches)} test batches from {basic_para.test_in}")
+
+    model = EventCoherenceModel(para, resources, 'cpu', basic_para.model_name)
+    best_model_path = os.path.join(basic_para.model_dir, basic_para.model_name,
+                                   'model_best.pth')
+    trained = os.path.exists(best_model_path)
+    if trained:
+        checkpoint = torch.load(best_model_path, map_location='cpu')
+        model.load_state_dict(checkpoint['state_dict'])
+    elif bench_para.allow_untrained:
+        logger.warning(f"No model at {best_model_path}, test the initial "
+                       f"parameters.")
+    else:
+        logger.error(f"No model at {best_model_path}, set "
+                     f"Bench.allow_untrained to test the initial parameters.")
+        return
+    model.eval()
+
+    models = {
+        'float32': model,
+        'int8': quantize_for_inference(model),
+        'int8_embeddings': quantize_for_inference(model, True),
+    }
+
+    results = {}
+    for name, m in models.items():
+        eval_dir = os.path.join(bench_para.eval_dir, name) if \
+            bench_para.eval_dir else None
+        results[name] = test_model(m, batches, eval_dir) + (model_size(m),)
+
+    print(f"{len(batches)} test batches, {torch.get_num_threads()} threads.")
+    if not trained:
+        print("The figures use the untrained initial parameters, the scores "
+              "are nearly tied, so the top-1 agreement is not meaningful.")
+
+    _, base_eval, base_scores = results['float32'][:3]
+    base_top = top_candidates(base_scores)
+    base_flat = np.array([v for s in base_scores for v in s])
+    base_results = system_results(base_eval)
+
+    for name, (scoring_time, evaluator, scores, size) in results.items():
+        agreement = np.mean(
+            [a == b for a, b in zip(base_top, top_candidates(scores))])
+        flat = np.array([v for s in scores for v in s])
+        max_diff = np.max(np.abs(flat - base_flat), initial=0)
+        print(f"{name}: {len(batches) / scoring_time:.2f} batches/s, "
+              f"{size / 2 ** 20:.1f} MB, top-1 agreement {agreement:.4f}, "
+              f"max score difference {max_diff:.5f}")
+
+        for group, group_results in system_results(evaluator).items():
+            diffs = dict(
+                (k, round(v - base_results[group][k], 5)) for k, v in
+                group_results.items())
+            print(f"    {group}: {json.dumps(group_results)}, "
+                  f"difference to float32: {json.dumps(diffs)}")
+
+
+if __name__ == '__main__':
+    class Basic(Configurable):
+        test_in = Unicode(help='Testing data.').tag(config=True)
+        model_dir = Unicode(help='Model directory.').tag(config=True)
+        model_name = Unicode(help='Model name.', default_value='basic').tag(
+            config=True)
+        test_factor_role = Unicode(
+            help='The field name of the role that is used to '
+                 'determine the slot type.').tag(config=True)
+
+
+    class Bench(Configurable):
+        eval_dir = Unicode(
+            help='Evaluation output directory, one sub directory per mode.'
+        ).tag(config=True)
+        max_docs = Integer(help='Max number of test documents, all if 0.',
+                           default_value=0).tag(config=True)
+        allow_untrained = Bool(
+            help='Run with the initial parameters when there is no trained '
+                 'model.', default_value=False).tag(config=True)
+
+
+    set_basic_log()
+    main(load_mixed_configs())
@@ -0,0 +1,104 @@
+"""Benchmark of the TorchScript scorer: score the same synthetic batches with
+the eager model and with the exported scorer, and compare the throughput and
+the scores. The scorer is traced on the first batch only, the other batches
+have different shapes.
+
+Example:
+    python -m event.arguments.debug.bench_scripted --Bench.steps=100
+"""
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+import torch
+from traitlets import Integer
+from traitlets.config import Configurable
+
+from event import util
+from event.arguments.arg_models import EventCoherenceModel
+from event.arguments.data.batcher import ClozeBatcher
+from event.arguments.debug.bench_mixed_precision import SyntheticResources, \
+    synthetic_fix_slot_doc
+from event.arguments.implicit_arg_params import ArgModelPara
+from event.arguments.scripted_scorer import ScriptedScorer, export_scorer
+
+
+@torch.no_grad()
+def eager_scores(model, batches):
+    return [model(instances, common_data) for
+            _, instances, common_data, _, _, _ in batches]
+
+
+@torch.no_grad()
+def scripted_scores(scorer, batches):
+    return [scorer(instances, common_data) for
+            _, instances, common_data, _, _, _ in batches]
+
+
+def main(params):
+    para = ArgModelPara(
+        arg_representation_method='fix_slots', use_frame=True, num_slots=3,
+        num_extracted_features=11, num_distance_features=3,
+        event_embedding_dim=params.embedding_dim,
+        word_embedding_dim=params.embedding_dim,
+    )
+    resources = SyntheticResources(params.vocab_size)
+
+    rng = random.Random(params.seed)
+    batcher = ClozeBatcher(params.batch_size)
+    batches = []
+    while len(batches) < params.steps + 1:
+        doc = synthetic_fix_slot_doc(rng, para, params.vocab_size,
+                                     params.max_events)
+        batches.extend(batcher.get_batch(*doc))
+    example, batches = batches[0], batches[1:params.steps + 1]
+
+    torch.manual_seed(params.seed)
+    model = EventCoherenceModel(para, resources, 'cpu', 'bench').eval()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'scorer.pt')
+        start = timeit.default_timer()
+        export_scorer(model, example[1], example[2], path)
+        export_time = timeit.default_timer() - start
+        scorer = ScriptedScorer(path)
+
+    # Warm up, the scripted module is optimized in the first runs.
+    eager_scores(model, batches[:3])
+    scripted_scores(scorer, batches[:3])
+
+    start = timeit.default_timer()
+    eager = eager_scores(model, batches)
+    eager_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    scripted = scripted_scores(scorer, batches)
+    scripted_time = timeit.default_timer() - start
+
+    print(f"{params.steps} batches of {params.batch_size} documents, "
+          f"{torch.get_num_threads()} threads, export in {export_time:.2f}s.")
+    print(f"eager: {params.steps / eager_time:.2f} batches/s")
+    print(f"scripted: {params.steps / scripted_time:.2f} batches/s")
+    print(f"Max score difference: "
+          f"{max((a - b).abs().max().item() for a, b in zip(eager, scripted))}")
+
+
+if __name__ == '__main__':
+    class Bench(Configurable):
+        batch_size = Integer(help='Documents per batch.',
+                             default_value=32).tag(config=True)
+        steps = Integer(help='Number of scored batches.',
+                        default_value=50).tag(config=True)
+        max_events = Integer(help='Max context events per document.',
+                             default_value=200).tag(config=True)
+        embedding_dim = Integer(help='Event embedding dimension.',
+                                default_value=300).tag(config=True)
+        vocab_size = Integer(help='Size of the event vocabulary.',
+                             default_value=50000).tag(config=True)
+        seed = Integer(help='Random seed.', default_value=1).tag(config=True)
+
+
+    conf = util.load_command_line_config(sys.argv[1:])
+    main(Bench(config=conf))
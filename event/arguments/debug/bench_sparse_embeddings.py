@@ -0,0 +1,168 @@
+"""Benchmark of the sparse embeddings: train the same model on the same
+synthetic batches with dense embeddings and Adam, and with sparse embeddings
+and LazyAdam, and compare the step time, the optimizer state and the losses.
+The synthetic event ids follow a power law, as the real ones.
+
+Example:
+    python -m event.arguments.debug.bench_sparse_embeddings --Bench.steps=50
+"""
+import io
+import random
+import sys
+import timeit
+
+import torch
+from traitlets import Integer
+from traitlets.config import Configurable
+
+from event import util
+from event.arguments.arg_models import EventCoherenceModel
+from event.arguments.data.batcher import ClozeBatcher
+from event.arguments.debug.bench_mixed_precision import SyntheticResources, \
+    synthetic_fix_slot_doc, get_loss
+from event.arguments.implicit_arg_params import ArgModelPara
+from event.nn.optim import LazyAdam
+
+
+def state_bytes(optimizer):
+    return sum(v.nelement() * v.element_size() for state in
+               optimizer.state.values() for v in state.values() if
+               torch.is_tensor(v))
+
+
+def train(para, resources, batches, seed):
+    torch.manual_seed(seed)
+    model = EventCoherenceModel(para, resources, 'cpu', 'bench')
+    if para.sparse_embeddings:
+        optimizer = LazyAdam(model.parameters())
+    else:
+        optimizer = torch.optim.Adam(model.parameters())
+
+    losses = []
+    step_time = 0
+    for batch in batches:
+        loss = get_loss(model, batch, False)
+        optimizer.zero_grad()
+        loss.backward()
+
+        start = timeit.default_timer()
+        optimizer.step()
+        step_time += timeit.default_timer() - start
+
+        losses.append(loss.item())
+    return step_time, losses, state_bytes(optimizer)
+
+
+def run_steps(model, optimizer, batches):
+    for batch in batches:
+        loss = get_loss(model, batch, False)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+
+def resume_difference(para, resources, batches, seed):
+    """Train with LazyAdam, saving and loading the model and the optimizer in
+    the middle, and return the max parameter difference to the training
+    without the interruption."""
+
+    def make():
+        torch.manual_seed(seed)
+        m = EventCoherenceModel(para, resources, 'cpu', 'bench')
+        return m, LazyAdam(m.parameters())
+
+    model, optimizer = make()
+    run_steps(model, optimizer, batches)
+
+    half = len(batches) // 2
+    first, first_optimizer = make()
+    run_steps(first, first_optimizer, batches[:half])
+
+    buffer = io.BytesIO()
+    torch.save({
+        'state_dict': first.state_dict(),
+        'optimizer_state_dict': first_optimizer.state_dict(),
+        'rng_state': torch.get_rng_state(),
+    }, buffer)
+    buffer.seek(0)
+    checkpoint = torch.load(buffer)
+
+    resumed, resumed_optimizer = make()
+    resumed.load_state_dict(checkpoint['state_dict'])
+    resumed_optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    torch.set_rng_state(checkpoint['rng_state'])
+    run_steps(resumed, resumed_optimizer, batches[half:])
+
+    return max((p - q).abs().max().item() for p, q in
+               zip(model.parameters(), resumed.parameters()))
+
+
+def main(params):
+    def sample_id(rng):
+        # The event frequencies follow a power law, about Zipf's law.
+        return min(int(rng.paretovariate(1.0)), params.vocab_size - 1)
+
+    results = {}
+    for sparse in (False, True):
+        para = ArgModelPara(
+            arg_representation_method='fix_slots', use_frame=True,
+            num_slots=3, num_extracted_features=11, num_distance_features=3,
+            event_embedding_dim=params.embedding_dim,
+            word_embedding_dim=params.embedding_dim,
+            sparse_embeddings=sparse,
+        )
+        resources = SyntheticResources(params.vocab_size)
+
+        rng = random.Random(params.seed)
+        batcher = ClozeBatcher(params.batch_size)
+        batches = []
+        while len(batches) < params.steps:
+            doc = synthetic_fix_slot_doc(rng, para, params.vocab_size,
+                                         params.max_events, sample_id)
+            batches.extend(batcher.get_batch(*doc))
+        batches = batches[:params.steps]
+
+        start = timeit.default_timer()
+        step_time, losses, optimizer_bytes = train(para, resources, batches,
+                                                   params.seed)
+        results[sparse] = (timeit.default_timer() - start, step_time, losses,
+                           optimizer_bytes)
+
+        if sparse:
+            resumed_diff = resume_difference(para, resources, batches,
+                                             params.seed)
+
+    print(f"{params.steps} batches of {params.batch_size} documents, "
+          f"{params.vocab_size} x {params.embedding_dim} embeddings, "
+          f"{torch.get_num_threads()} threads.")
+
+    for sparse, name in ((False, 'dense Adam'), (True, 'sparse LazyAdam')):
+        total_time, step_time, losses, optimizer_bytes = results[sparse]
+        print(f"{name}: {params.steps / total_time:.2f} batches/s, "
+              f"optimizer step {1000 * step_time / params.steps:.1f} ms, "
+              f"optimizer state {optimizer_bytes / 2 ** 20:.1f} MB, "
+              f"final loss {losses[-1]:.5f}")
+
+    print(f"Max train loss difference: "
+          f"{max(abs(a - b) for a, b in zip(results[False][2], results[True][2])):.5f}")
+    print(f"Max parameter difference after a save and load of LazyAdam in "
+          f"the middle: {resumed_diff}")
+
+
+if __name__ == '__main__':
+    class Bench(Configurable):
+        batch_size = Integer(help='Documents per batch.',
+                             default_value=32).tag(config=True)
+        steps = Integer(help='Number of training steps.',
+                        default_value=30).tag(config=True)
+        max_events = Integer(help='Max context events per document.',
+                             default_value=200).tag(config=True)
+        embedding_dim = Integer(help='Event embedding dimension.',
+                                default_value=300).tag(config=True)
+        vocab_size = Integer(help='Size of the event vocabulary.',
+                             default_value=59000).tag(config=True)
+        seed = Integer(help='Random seed.', default_value=1).tag(config=True)
+
+
+    conf = util.load_command_line_config(sys.argv[1:])
+    main(Bench(config=conf))
@@ -0,0 +1,156 @@
+"""Benchmark of the sparse context voting: each instance votes with all the
+context events, with a window of events around its event, or with the events
+at its nearest positions. It times the context vote layer alone on full size documents, and the
+training passes of the same model on the same synthetic batches, and compares
+the coherence scores to the ones with all the context.
+
+Example:
+    python -m event.arguments.debug.bench_sparse_voting \
+        --Bench.vote_pooling=kernel --Bench.vote_context_size=10
+"""
+import random
+import sys
+import timeit
+
+import torch
+from traitlets import Integer, Unicode
+from traitlets.config import Configurable
+
+from event import util
+from event.arguments.arg_models import EventCoherenceModel
+from event.arguments.data.batcher import ClozeBatcher
+from event.arguments.debug.bench_mixed_precision import SyntheticResources, \
+    synthetic_fix_slot_doc, get_loss
+from event.arguments.implicit_arg_params import ArgModelPara
+
+VOTE_CONTEXTS = ('all', 'window', 'nearest_positions')
+
+
+def make_para(params, vote_context):
+    return ArgModelPara(
+        arg_representation_method='fix_slots', use_frame=True,
+        num_slots=3, num_extracted_features=11, num_distance_features=3,
+        event_embedding_dim=params.embedding_dim,
+        word_embedding_dim=params.embedding_dim,
+        vote_pooling=params.vote_pooling,
+        vote_context=vote_context,
+        vote_context_size=params.vote_context_size,
+    )
+
+
+def vote_pass(model, event_repr, context_repr, event_indices):
+    """A forward and backward pass of the context vote layer."""
+    _, context_size, _ = context_repr.shape
+    if model.para.vote_context == 'all':
+        mask = model.self_event_mask(event_indices, context_size)
+        votes = model.context_vote_layer(event_repr, context_repr, mask)
+    else:
+        positions, mask = model.context_positions(event_indices, context_size)
+        votes = model.context_vote_layer(event_repr, context_repr, mask,
+                                         positions)
+    votes.sum().backward()
+
+
+def bench_vote_layer(params, models):
+    """Time the vote layer with the full instance and context size."""
+    generator = torch.Generator().manual_seed(params.seed)
+    shape = (params.batch_size, params.max_events)
+    dim = models['all'].para.event_composition_layer_sizes[-1]
+    event_repr = torch.randn(shape + (dim,), generator=generator,
+                             requires_grad=True)
+    context_repr = torch.randn(shape + (dim,), generator=generator,
+                               requires_grad=True)
+    event_indices = torch.randint(params.max_events, shape,
+                                  generator=generator)
+
+    results = {}
+    for vote_context, model in models.items():
+        def one_pass():
+            vote_pass(model, event_repr, context_repr, event_indices)
+
+        one_pass()
+        elapsed = timeit.timeit(one_pass, number=params.repeat)
+        results[vote_context] = params.repeat / elapsed
+    return results
+
+
+def train_passes(model, batches):
+    """Time the training passes and collect the scores."""
+    scores = []
+    start = timeit.default_timer()
+    for batch in batches:
+        _, instances, common_data, _, mask, _ = batch
+        loss = get_loss(model, batch, False)
+        loss.backward()
+        with torch.no_grad():
+            coh = model(instances, common_data)
+        scores.append(coh[mask.bool()])
+    return timeit.default_timer() - start, torch.cat(scores)
+
+
+def main(params):
+    resources = SyntheticResources(params.vocab_size)
+
+    rng = random.Random(params.seed)
+    batcher = ClozeBatcher(params.batch_size)
+    batches = []
+    para = make_para(params, 'all')
+    while len(batches) < params.steps:
+        doc = synthetic_fix_slot_doc(rng, para, params.vocab_size,
+                                     params.max_events)
+        batches.extend(batcher.get_batch(*doc))
+    batches = batches[:params.steps]
+
+    models = {}
+    for vote_context in VOTE_CONTEXTS:
+        torch.manual_seed(params.seed)
+        models[vote_context] = EventCoherenceModel(
+            make_para(params, vote_context), resources, 'cpu', 'bench')
+
+    print(f"{params.vote_pooling} pooling, vote context size "
+          f"{params.vote_context_size}, {torch.get_num_threads()} threads.")
+
+    vote_speeds = bench_vote_layer(params, models)
+    print(f"Vote layer on {params.batch_size} documents of "
+          f"{params.max_events} instances and {params.max_events} context "
+          f"events:")
+    for vote_context in VOTE_CONTEXTS:
+        print(f"    {vote_context}: {vote_speeds[vote_context]:.2f} passes/s")
+
+    train_results = dict(
+        (vote_context, train_passes(model, batches)) for vote_context, model in
+        models.items())
+    print(f"Training passes on {params.steps} synthetic batches:")
+    all_scores = train_results['all'][1]
+    for vote_context in VOTE_CONTEXTS:
+        elapsed, scores = train_results[vote_context]
+        diff = (scores - all_scores).abs()
+        print(f"    {vote_context}: {params.steps / elapsed:.2f} batches/s, "
+              f"score difference to all: mean {diff.mean().item():.5f}, "
+              f"max {diff.max().item():.5f}")
+
+
+if __name__ == '__main__':
+    class Bench(Configurable):
+        batch_size = Integer(help='Documents per batch.',
+                             default_value=32).tag(config=True)
+        steps = Integer(help='Number of training batches.',
+                        default_value=20).tag(config=True)
+        repeat = Integer(help='Number of timed vote layer passes.',
+                         default_value=5).tag(config=True)
+        max_events = Integer(help='Max context events per document.',
+                             default_value=200).tag(config=True)
+        embedding_dim = Integer(help='Event embedding dimension.',
+                                default_value=300).tag(config=True)
+        vocab_size = Integer(help='Size of the event vocabulary.',
+                             default_value=59000).tag(config=True)
+        vote_pooling = Unicode(help='Method to pool the votes.',
+                               default_value='kernel').tag(config=True)
+        vote_context_size = Integer(
+            help='Events on each side of the window, or nearest positions.',
+            default_value=10).tag(config=True)
+        seed = Integer(help='Random seed.', default_value=1).tag(config=True)
+
+
+    conf = util.load_command_line_config(sys.argv[1:])
+    main(Bench(config=conf))
@@ -12,6 +12,25 @@ def save_div(a, b):
     return a / b if b > 0 else 0
 
 
+def case_scores(batch_scores, metadata):
+    """Split the scores of a test batch into the candidate scores of each test
+    case, the padded instances are dropped.
+
+    Args:
+      batch_scores: The numpy scores of the batch, batch x instance_size.
+      metadata: The batch metadata.
+
+    Returns:
+      The list of candidate scores of each test case.
+
+    """
+    batch_scores = batch_scores.reshape(len(metadata['instance']), -1)
+    return [
+        scores[:len(l_candidate_meta)].tolist() for scores, l_candidate_meta
+        in zip(batch_scores, metadata['candidate'])
+    ]
+
+
 class ImplicitEval:
     def __init__(self, out_dir=None):
         self.out_dir = out_dir
@@ -112,12 +131,22 @@ class ImplicitEval:
         return this_res
 
     def add_prediction(self, coh_scores, metadata):
-        for l_candidate_meta, instance_meta in zip(metadata['candidate'],
-                                                   metadata['instance']):
+        """Add the predictions of a batch of test cases.
+
+        Args:
+          coh_scores: The candidate scores of each test case in the batch.
+          metadata: The batch metadata, the candidate and instance metadata
+            are listed in the same order as the test cases.
+
+        Returns:
+
+        """
+        for l_candidate_meta, instance_meta, scores in zip(
+                metadata['candidate'], metadata['instance'], coh_scores):
             self.add_result(
                 instance_meta,
                 l_candidate_meta,
-                coh_scores
+                scores
             )
 
     @staticmethod
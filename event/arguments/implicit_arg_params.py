@@ -13,6 +13,20 @@ class ArgModelPara(Configurable):
         config=True)
     model_type = Unicode(help='Type of the model.', default_value='').tag(
         config=True)
+    mixed_precision = Bool(
+        help='Whether to train and test with mixed precision: bfloat16 '
+             'autocast on CPU, float16 autocast with gradient scaling on GPU. '
+             'The context voting, the final scoring and the loss stay in '
+             'float32.',
+        default_value=False).tag(config=True)
+    int8_inference = Bool(
+        help='Whether to test with dynamic int8 quantization of the linear '
+             'layers, on CPU only.',
+        default_value=False).tag(config=True)
+    int8_embeddings = Bool(
+        help='Whether to also quantize the event and word embedding tables '
+             'in the int8 inference mode.',
+        default_value=False).tag(config=True)
 
     # Input size configs.
     event_arg_vocab_size = Int(
@@ -30,6 +44,32 @@ class ArgModelPara(Configurable):
         help='Early stop patience', default_value=1).tag(config=True)
     nb_epochs = Int(help='Number of epochs').tag(config=True)
     batch_size = Int(help='Batch size', default_value=128).tag(config=True)
+    batch_bucket_size = Int(
+        help='Number of batches buffered to group documents of similar '
+             'sizes, bucketing is disabled if 0.',
+        default_value=0).tag(config=True)
+    batch_cell_budget = Int(
+        help='Max number of padded cells per batch, the batch size is then '
+             'only an upper bound of the documents. Disabled if 0.',
+        default_value=0).tag(config=True)
+    batch_budget_unit = Unicode(
+        help='The cells counted in the batch budget: instance_context or '
+             'instance_slot.',
+        default_value='instance_context').tag(config=True)
+
+    sparse_embeddings = Bool(
+        help='Whether the embedding tables get sparse gradients, with an '
+             'optimizer that only updates the rows in the batch and keeps '
+             'the moments of the updated rows only.',
+        default_value=False).tag(config=True)
+
+    test_batch_size = Int(
+        help='Number of test cases per batch at test time. Only the cases '
+             'with the same context shapes are batched together, so no '
+             'padding enters the scores. The scores may still differ from '
+             'testing the cases one by one in the last float bit, since the '
+             'BLAS kernels depend on the matrix sizes.',
+        default_value=1).tag(config=True)
 
     multi_context = Bool(
         help='Whether to use only one context, '
@@ -41,6 +81,33 @@ class ArgModelPara(Configurable):
     max_cloze = Int(
         help='Maximum number of cloze to extract per document',
         default_value=150).tag(config=True)
+    cross_sample_method = Unicode(
+        help='How to sample the arguments of the cross clozes: uniform, '
+             'weighted (by the entity mention counts), or nearby (hard '
+             'negatives from the nearby sentences).',
+        default_value='uniform').tag(config=True)
+    cross_sample_window = Int(
+        help='Max sentence distance of the nearby cross cloze arguments.',
+        default_value=1).tag(config=True)
+
+    # Reader controls.
+    num_reader_workers = Int(
+        help='Number of processes to create the training clozes, the '
+             'clozes are created in the main process if less than 2. Cannot '
+             'be used with the batch prefetching.',
+        default_value=0).tag(config=True)
+    ordered_reading = Bool(
+        help='Whether the reader workers keep the order of the documents.',
+        default_value=True).tag(config=True)
+    doc_cache_size = Int(
+        help='Number of training documents to cache the sampling '
+             'independent data across epochs, 0 to disable. Only effective '
+             'when the clozes are created in the main process.',
+        default_value=0).tag(config=True)
+    json_decoder = Unicode(
+        help='JSON library to decode the hashed documents: auto (orjson if '
+             'installed), orjson or json.',
+        default_value='auto').tag(config=True)
 
     # Model architecture related parameters.
     loss = Unicode(
@@ -127,6 +194,20 @@ class ArgModelPara(Configurable):
         default_value=3
     ).tag(config=True)
 
+    vote_context = Unicode(
+        help='The context events each instance votes with: "all" of them, '
+             'a "window" of events around the instance event, or the events '
+             'at its "nearest_positions", both in the document order.',
+        default_value='all'
+    ).tag(config=True)
+
+    vote_context_size = Int(
+        help='The number of events on each side of the window, or the number '
+             'of events at the nearest positions, when voting with the sparse '
+             'context.',
+        default_value=10
+    ).tag(config=True)
+
     # Null Instantiation Detector.
     nid_method = Unicode(
         help='The method for Null Instantiation Detector',
@@ -31,10 +31,24 @@ class ImplicitArgResources(Configurable):
     min_vocab_count = Int(help='The min vocab cutoff threshold.',
                           default_value=50).tag(config=True)
 
-    def __init__(self, **kwargs):
+    def __init__(self, load_embeddings=True, **kwargs):
         super(ImplicitArgResources, self).__init__(**kwargs)
-        self.event_embedding = np.load(self.event_embedding_path)
-        self.word_embedding = np.load(self.word_embedding_path)
+        # The embeddings are only needed to create the model, the readers
+        # only use the vocabularies.
+        self.event_embedding = None
+        self.word_embedding = None
+        if load_embeddings:
+            # Memory-mapped read-only, the trained models copy them into
+            # their own tables, the others read them directly, see
+            # ArgCompatibleModel.
+            self.event_embedding = np.load(self.event_embedding_path,
+                                           mmap_mode='r')
+            self.word_embedding = np.load(self.word_embedding_path,
+                                          mmap_mode='r')
+
+        # The frozen embedding tables shared by the models that are not
+        # trained, by the embedding name and the device.
+        self.shared_embedding_tables = {}
 
         # Add padding and two unk to the vocab.
         self.event_embed_vocab = EmbbedingVocab.with_extras(
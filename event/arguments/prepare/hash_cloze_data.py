@@ -3,6 +3,7 @@ from event.io.readers import EventReader
 import gzip
 from event.arguments.prepare.event_vocab import TypedEventVocab, EmbbedingVocab
 from event.arguments.prepare import word_vocab
+from event.arguments.data.hashed_io import BinaryDocWriter
 from event.arguments.prepare.slot_processor import (
     SlotHandler, get_simple_dep, is_propbank_dep)
 from collections import Counter
@@ -272,9 +273,15 @@ def hash_data():
     doc_count = 0
     event_count = 0
 
+    if hash_params.output_format == 'binary':
+        data_out = BinaryDocWriter(hash_params.output_path)
+    elif hash_params.output_format == 'json':
+        data_out = gzip.open(hash_params.output_path, 'w')
+    else:
+        raise ValueError(f"Unknown output format {hash_params.output_format}")
+
     print(f"{event.util.get_time()}: Start hashing")
-    with gzip.open(hash_params.raw_data) as data_in, gzip.open(
-            hash_params.output_path, 'w') as data_out:
+    with gzip.open(hash_params.raw_data) as data_in, data_out:
         for docid, events, entities, sentences in reader.read_events(
                 data_in, 'goldRole'):
 
@@ -288,7 +295,10 @@ def hash_data():
                 docid, events, entities, event_emb_vocab, word_emb_vocab,
                 typed_event_vocab, slot_handler)
 
-            data_out.write((json.dumps(hashed_doc) + '\n').encode())
+            if hash_params.output_format == 'binary':
+                data_out.write(hashed_doc)
+            else:
+                data_out.write((json.dumps(hashed_doc) + '\n').encode())
 
             doc_count += 1
             event_count += len(hashed_doc['events'])
@@ -337,6 +347,10 @@ class HashParam(Configurable):
         default_value=False).tag(config=True)
     strict_arg_count = Bool(help='Force lossless number of arguments',
                             default_value=False).tag(config=True)
+    output_format = Unicode(
+        help='Format of the hashed data: json (gzipped JSON lines) or binary '
+             '(see event.arguments.data.hashed_io)', default_value='json'
+    ).tag(config=True)
 
 
 if __name__ == '__main__':
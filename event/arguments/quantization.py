@@ -0,0 +1,70 @@
+"""Dynamic int8 quantization of the implicit argument models for CPU
+inference."""
+import copy
+import logging
+
+import torch
+from torch import nn
+from torch.ao.quantization import (
+    default_dynamic_qconfig,
+    float_qparams_weight_only_qconfig,
+    quantize_dynamic,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class FlatIndexEmbedding(nn.Module):
+    """The quantized embedding only looks up 1-d or 2-d indices, this looks up
+    the indices of any shape by flattening them.
+
+    Args:
+      embedding: The quantized embedding.
+    """
+
+    def __init__(self, embedding):
+        super().__init__()
+        self.embedding = embedding
+
+    def forward(self, indices):
+        emb = self.embedding(indices.reshape(-1))
+        return emb.view(indices.shape + emb.shape[-1:])
+
+
+def quantize_for_inference(model, quantize_embeddings=False):
+    """Create an int8 copy of the model for CPU inference. The weights of the
+    linear layers (the MLPs, the biaffine voting, the final combination and
+    the transformer projections) are quantized ahead, the activations are
+    quantized on the fly. The embedding tables are optionally quantized row
+    by row. The other parameters, such as the kernels, are kept.
+
+    Args:
+      model: The model, it is not modified.
+      quantize_embeddings: Whether to also quantize the event and word
+        embedding tables.
+
+    Returns:
+      The quantized model, in eval mode.
+
+    """
+    qconfig_spec = {nn.Linear: default_dynamic_qconfig}
+
+    embedding_names = []
+    if quantize_embeddings:
+        for name in 'event_embedding', 'word_embedding':
+            if isinstance(getattr(model, name, None), nn.Embedding):
+                qconfig_spec[name] = float_qparams_weight_only_qconfig
+                embedding_names.append(name)
+
+    q_model = quantize_dynamic(copy.deepcopy(model).cpu().eval(),
+                               qconfig_spec, dtype=torch.qint8, inplace=True)
+
+    for name in embedding_names:
+        setattr(q_model, name, FlatIndexEmbedding(getattr(q_model, name)))
+
+    logger.info(f"Quantized the linear layers and {len(embedding_names)} "
+                f"embedding tables to int8.")
+
+    # The masks are created on the model device.
+    q_model.device = 'cpu'
+    return q_model
@@ -0,0 +1,201 @@
+"""Export the EventCoherenceModel as a TorchScript scorer, and score the hashed
+test documents with it.
+
+The scorer is traced on an example batch, so the branches on the model
+configuration (the argument representation, the vote method and the vote
+pooling) are resolved at export time, and loading it needs neither the model
+code nor texar. The reader still needs the vocabularies, so the resources are
+created without loading the embeddings.
+
+Example:
+    python -m event.arguments.scripted_scorer conf/implicit/pair.py \
+        --ScorerPara.scorer_path=scorer.pt --ScorerPara.test_in=test.gz \
+        --ScorerPara.eval_dir=eval_out
+"""
+import copy
+import json
+import logging
+
+import torch
+from torch import nn
+from traitlets import Unicode
+from traitlets.config import Configurable
+
+from event.arguments.NIFDetector import GoldNullArgDetector, \
+    TrainableNullArgDetector
+from event.arguments.data.cloze_readers import HashedClozeReader
+from event.arguments.data.hashed_io import data_gen
+from event.arguments.evaluation import ImplicitEval, case_scores
+from event.arguments.implicit_arg_params import ArgModelPara
+from event.arguments.implicit_arg_resources import ImplicitArgResources
+from event.util import load_mixed_configs, set_basic_log
+
+logger = logging.getLogger(__name__)
+
+# The extra file in the scorer that records the order of the inputs.
+_INPUT_KEYS_FILE = 'input_keys.json'
+
+
+class _ScoringModule(nn.Module):
+    """Take the batch tensors as positional inputs, since the traced module
+    cannot take the batch dictionaries of arbitrary keys."""
+
+    def __init__(self, model, instance_keys, common_keys):
+        super().__init__()
+        self.model = model
+        self.instance_keys = instance_keys
+        self.common_keys = common_keys
+
+    def forward(self, *tensors):
+        num_instance_keys = len(self.instance_keys)
+        instances = dict(zip(self.instance_keys, tensors[:num_instance_keys]))
+        common_data = dict(zip(self.common_keys, tensors[num_instance_keys:]))
+        return self.model.score(instances, common_data,
+                                self.model.encode_context(common_data))
+
+
+def export_scorer(model, instances, common_data, path):
+    """Trace the scores of the model and save them as a TorchScript module.
+    The scorer runs on CPU in full precision.
+
+    Args:
+      model: The EventCoherenceModel to export, it is not modified.
+      instances: The instance data of an example batch.
+      common_data: The common data of the example batch.
+      path: Path of the exported scorer.
+
+    Returns:
+
+    """
+    if model.para.vote_pooling == 'topk':
+        logger.warning("The top k pooling depends on the context size, the "
+                       "exported scorer only follows the branch of the "
+                       "example batch.")
+
+    model = copy.deepcopy(model).cpu().eval()
+    # The masks are created on the model device.
+    model.device = 'cpu'
+
+    instance_keys = sorted(instances)
+    common_keys = sorted(common_data)
+
+    module = _ScoringModule(model, instance_keys, common_keys).eval()
+    inputs = tuple(instances[k].cpu() for k in instance_keys) + tuple(
+        common_data[k].cpu() for k in common_keys)
+
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(module, inputs))
+
+    input_keys = {'instance': instance_keys, 'common': common_keys}
+    torch.jit.save(traced, path,
+                   _extra_files={_INPUT_KEYS_FILE: json.dumps(input_keys)})
+
+
+class ScriptedScorer:
+    """Load the scorer exported by export_scorer.
+
+    Args:
+      path: Path of the exported scorer.
+    """
+
+    def __init__(self, path):
+        extra_files = {_INPUT_KEYS_FILE: ''}
+        self.module = torch.jit.load(path, map_location='cpu',
+                                     _extra_files=extra_files)
+        input_keys = json.loads(extra_files[_INPUT_KEYS_FILE])
+        self.instance_keys = input_keys['instance']
+        self.common_keys = input_keys['common']
+
+    @torch.no_grad()
+    def __call__(self, instances, common_data):
+        """Score a batch.
+
+        Args:
+          instances: The instance data of the batch.
+          common_data: The common data of the batch.
+
+        Returns:
+          The scores, batch x instance_size.
+
+        """
+        inputs = [instances[k] for k in self.instance_keys] + [
+            common_data[k] for k in self.common_keys]
+        return self.module(*inputs)
+
+
+def score_test_docs(scorer, reader, test_lines, nid_detector, eval_dir=None):
+    """Score the test documents and evaluate the predictions, as the runner
+    tests the eager model.
+
+    Args:
+      scorer: The ScriptedScorer.
+      reader: The HashedClozeReader, set up for testing.
+      test_lines: The hashed test documents.
+      nid_detector: The Null Instantiation detector.
+      eval_dir: The evaluation output directory.
+
+    Returns:
+      The number of test cases.
+
+    """
+    evaluator = ImplicitEval(eval_dir)
+    instance_count = 0
+
+    for test_data in reader.read_test_docs(test_lines, nid_detector):
+        _, instances, common_data, _, _, metadata = test_data
+
+        coh_scores = case_scores(
+            scorer(instances, common_data).numpy(), metadata)
+        evaluator.add_prediction(coh_scores, metadata)
+
+        for _ in coh_scores:
+            instance_count += 1
+
+            if instance_count % 1000 == 0:
+                logger.info("Tested %d instances." % instance_count)
+
+    logger.info("Finish testing %d instances." % instance_count)
+    evaluator.collect()
+    return instance_count
+
+
+def main(conf):
+    scorer_para = ScorerPara(config=conf)
+    para = ArgModelPara(config=conf)
+    resources = ImplicitArgResources(load_embeddings=False, config=conf)
+
+    reader = HashedClozeReader(resources, para)
+    reader.auto_test = False
+    reader.factor_role = scorer_para.test_factor_role
+    reader.use_gold_mention = True
+    reader.use_auto_mention = False
+
+    if para.nid_method == 'gold':
+        nid_detector = GoldNullArgDetector()
+    elif para.nid_method == 'train':
+        nid_detector = TrainableNullArgDetector()
+    else:
+        raise ValueError(f"Unknown NID method {para.nid_method}")
+
+    scorer = ScriptedScorer(scorer_para.scorer_path)
+    logger.info(f"Loaded the scorer from {scorer_para.scorer_path}, test on "
+                f"[{scorer_para.test_in}].")
+
+    score_test_docs(scorer, reader, data_gen(scorer_para.test_in),
+                    nid_detector, scorer_para.eval_dir or None)
+
+
+if __name__ == '__main__':
+    class ScorerPara(Configurable):
+        scorer_path = Unicode(help='Path of the exported scorer.').tag(
+            config=True)
+        test_in = Unicode(help='Testing data.').tag(config=True)
+        eval_dir = Unicode(help='Evaluation output directory.').tag(
+            config=True)
+        test_factor_role = Unicode(
+            help='The field name of the role that is used to '
+                 'determine the slot type.').tag(config=True)
+
+
+    set_basic_log()
+    main(load_mixed_configs())
@@ -1,10 +1,42 @@
 from torch import nn
+from torch.nn import functional as F
 import torch
 import json
 import logging
 from torch.nn.parameter import Parameter
 
 
+class FrozenEmbedding(nn.Module):
+    """A frozen embedding table in two parts: the leading rows (e.g. the
+    padding and the extra vocab) and the pretrained rows. The rows are used as
+    given, so the pretrained rows can be a memory-mapped array that is never
+    copied. Both parts are read only.
+
+    Args:
+      head: The leading rows, num_head x dim.
+      pretrained: The pretrained rows, num_pretrained x dim.
+    """
+
+    def __init__(self, head, pretrained):
+        super(FrozenEmbedding, self).__init__()
+        # The tables are given by the caller, they are not saved with the
+        # model.
+        self.register_buffer('head', head, persistent=False)
+        self.register_buffer('pretrained', pretrained, persistent=False)
+
+    @property
+    def num_embeddings(self):
+        return self.head.shape[0] + self.pretrained.shape[0]
+
+    def forward(self, indices):
+        num_head = self.head.shape[0]
+        head_rows = F.embedding(indices.clamp(max=num_head - 1), self.head)
+        pretrained_rows = F.embedding((indices - num_head).clamp(min=0),
+                                      self.pretrained)
+        return torch.where((indices < num_head).unsqueeze(-1), head_rows,
+                           pretrained_rows)
+
+
 class KernelPooling(nn.Module):
     """kernel pooling layer
     init:
@@ -39,6 +71,28 @@ class KernelPooling(nn.Module):
         return
 
     def forward(self, in_tensor, mtx_score=None):
+        # The exp and log overflow in half precision, so always pool in full
+        # precision, even under autocast.
+        with torch.autocast(device_type=in_tensor.device.type, enabled=False):
+            in_tensor = in_tensor.float()
+            if mtx_score is not None:
+                return self._pool(in_tensor, mtx_score)
+
+            if torch.is_grad_enabled() and not torch.jit.is_tracing():
+                sum_kernel_value = KernelSumFunction.apply(
+                    in_tensor, self.v_mu, self.v_sigma)
+            else:
+                # Nothing to save for backward, and the tracer cannot
+                # record the custom function.
+                sum_kernel_value = kernel_sums(in_tensor, self.v_mu,
+                                               self.v_sigma)
+            # TODO: The sum here causes nan.
+            return torch.log(sum_kernel_value.clamp(min=1e-10))
+
+    def _pool(self, in_tensor, mtx_score=None):
+        """Pool by expanding the input to the K kernels, which materializes
+        several tensors K times the size of the input. Only used for the
+        weighted pooling."""
         in_tensor = in_tensor.unsqueeze(-1)
         in_tensor = in_tensor.expand(in_tensor.size()[:-1] + (self.K,))
         score = -(in_tensor - self.v_mu) * (in_tensor - self.v_mu)
@@ -56,3 +110,63 @@ class KernelPooling(nn.Module):
             min=1e-10)  # add freq/weight
         sum_kernel_value = torch.log(sum_kernel_value)
         return sum_kernel_value
+
+
+def _kernel(in_tensor, mu, sigma):
+    diff = in_tensor - mu
+    return torch.exp(-diff * diff / (2.0 * sigma * sigma)), diff
+
+
+def kernel_sums(in_tensor, v_mu, v_sigma):
+    """Sum the kernel values over the last dimension, one kernel at a time,
+    without the expansion to the K kernels. The kernel value of x with the
+    kernel (mu, sigma) is exp(-(x - mu)^2 / (2 * sigma^2)).
+
+    Args:
+      in_tensor: The input, ... x n.
+      v_mu: The K kernel centers.
+      v_sigma: The K kernel widths.
+
+    Returns:
+      The sum of the kernel values, ... x K.
+
+    """
+    sums = []
+    for mu, sigma in zip(v_mu, v_sigma):
+        sums.append(_kernel(in_tensor, mu, sigma)[0].sum(-1))
+    return torch.stack(sums, -1)
+
+
+class KernelSumFunction(torch.autograd.Function):
+    """The autograd function of kernel_sums. Only the input is kept for the
+    backward pass, where the kernel values are recomputed, so neither pass
+    holds a tensor larger than the input, instead of K times the input when
+    the kernels are expanded."""
+
+    @staticmethod
+    def forward(ctx, in_tensor, v_mu, v_sigma):
+        ctx.save_for_backward(in_tensor, v_mu, v_sigma)
+        return kernel_sums(in_tensor, v_mu, v_sigma)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_sums):
+        in_tensor, v_mu, v_sigma = ctx.saved_tensors
+
+        grad_in = torch.zeros_like(in_tensor) if \
+            ctx.needs_input_grad[0] else None
+        grad_mu = torch.zeros_like(v_mu)
+        grad_sigma = torch.zeros_like(v_sigma)
+
+        for k, (mu, sigma) in enumerate(zip(v_mu, v_sigma)):
+            kernel_value, diff = _kernel(in_tensor, mu, sigma)
+            # The gradient of the kernel value to mu, the gradients to the
+            # input and sigma follow from it.
+            grad_k = grad_sums[..., k].unsqueeze(-1) * kernel_value * diff / (
+                    sigma * sigma)
+            if grad_in is not None:
+                grad_in -= grad_k
+            grad_mu[k] = grad_k.sum()
+            grad_sigma[k] = (grad_k * diff).sum() / sigma
+
+        return grad_in, grad_mu, grad_sigma
@@ -0,0 +1,138 @@
+import math
+
+import torch
+from torch.optim import Optimizer
+
+
+class LazyAdam(Optimizer):
+    """Adam that also takes sparse gradients, such as the ones of the sparse
+    embeddings, and then only updates the rows in the gradient.
+
+    The moments of a sparse parameter are only kept for the rows that have
+    been updated, so the state grows with the rows used instead of the full
+    table, and the time of a step with the rows in the batch. A row that is
+    updated at every step follows the same trajectory as with Adam, the other
+    rows keep their moments until they are updated again. The dense
+    parameters are updated as with Adam.
+
+    Args:
+      params: The parameters or parameter groups.
+      lr: The learning rate.
+      betas: The decay rates of the moments.
+      eps: Added to the denominator for numerical stability.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        if not 0.0 < lr:
+            raise ValueError(f"Invalid learning rate: {lr}")
+        if not 0.0 <= eps:
+            raise ValueError(f"Invalid epsilon value: {eps}")
+        if not all(0.0 <= beta < 1.0 for beta in betas):
+            raise ValueError(f"Invalid beta parameters: {betas}")
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps))
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        # The state tensors are cast to the parameter dtype when loaded,
+        # the row slots are indices.
+        for state in self.state.values():
+            if 'row_slots' in state:
+                state['row_slots'] = state['row_slots'].long()
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    self._sparse_step(p, group)
+                else:
+                    self._dense_step(p, group)
+
+        return loss
+
+    @staticmethod
+    def _adam_update(exp_avg, exp_avg_sq, grad, step, group):
+        """Update the moments in place and return the parameter update."""
+        beta1, beta2 = group['betas']
+        exp_avg.lerp_(grad, 1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+
+        denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(
+            group['eps'])
+        return exp_avg / denom * (-group['lr'] / bias_correction1)
+
+    def _dense_step(self, p, group):
+        state = self.state[p]
+        if not state:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p)
+            state['exp_avg_sq'] = torch.zeros_like(p)
+
+        state['step'] += 1
+        p.add_(self._adam_update(state['exp_avg'], state['exp_avg_sq'],
+                                 p.grad, state['step'], group))
+
+    def _sparse_step(self, p, group):
+        state = self.state[p]
+        if not state:
+            state['step'] = 0
+            # The moment slot of each row, -1 for the rows never updated.
+            state['row_slots'] = torch.full((p.shape[0],), -1,
+                                            dtype=torch.long, device=p.device)
+            state['num_slots'] = 0
+            state['exp_avg'] = p.new_zeros((0,) + p.shape[1:])
+            state['exp_avg_sq'] = p.new_zeros((0,) + p.shape[1:])
+
+        grad = p.grad.coalesce()
+        rows = grad.indices()[0]
+        values = grad.values()
+
+        slots = self._row_slots(state, rows)
+        exp_avg = state['exp_avg'][slots]
+        exp_avg_sq = state['exp_avg_sq'][slots]
+
+        state['step'] += 1
+        update = self._adam_update(exp_avg, exp_avg_sq, values, state['step'],
+                                   group)
+
+        state['exp_avg'][slots] = exp_avg
+        state['exp_avg_sq'][slots] = exp_avg_sq
+        p.index_add_(0, rows, update)
+
+    @staticmethod
+    def _row_slots(state, rows):
+        """The moment slots of the rows, the new rows get new slots."""
+        row_slots = state['row_slots']
+        slots = row_slots[rows]
+
+        new_rows = rows[slots < 0]
+        if new_rows.numel() > 0:
+            num_slots = state['num_slots'] + new_rows.numel()
+            row_slots[new_rows] = torch.arange(
+                state['num_slots'], num_slots, device=row_slots.device)
+            state['num_slots'] = num_slots
+
+            # Grow the moments geometrically, so the copies are amortized.
+            capacity = state['exp_avg'].shape[0]
+            if num_slots > capacity:
+                capacity = min(max(num_slots, 2 * capacity),
+                               row_slots.shape[0])
+                for key in 'exp_avg', 'exp_avg_sq':
+                    moment = state[key]
+                    grown = moment.new_zeros((capacity,) + moment.shape[1:])
+                    grown[:moment.shape[0]] = moment
+                    state[key] = grown
+
+            slots = row_slots[rows]
+
+        return slots
@@ -1,6 +1,8 @@
 #!/usr/bin/env bash
 
 if [[ ! -d ${implicit_corpus}/gigaword_frames/nyt_all_frames_shuffled ]]; then
+    # The lines are shuffled within each split here, and mixed across the
+    # splits at training time, see --Basic.shuffle_buffer_size
     echo 'Spliting into smaller files'
     cd ${implicit_corpus}/gigaword_frames/
     mkdir -p ${implicit_corpus}/gigaword_frames/nyt_all_frames_shuffled